@@ -0,0 +1,922 @@
+"""
+Benchmarks for the data processing in this project, each benchmark compares the current implementation with the implementation it replaced.
+The suite times the whole pipeline (parsing, joining, data_prep, training and predicting) on synthetic data from fixtures.py at several scales
+and adds the results to benchmark_results.csv with the commit they were run at, compare shows how the times changed between two commits.
+
+Run from the flare_classifier directory:
+    python benchmarks.py hessi [path to hessi_flare_list.txt]
+    python benchmarks.py goes [path to a goes-xrs-report_YYYY.txt]
+    python benchmarks.py join
+    python benchmarks.py filter [path to hessi_flare_list.txt]
+    python benchmarks.py schema
+    python benchmarks.py incremental
+    python benchmarks.py frames [hessi_goes_flare_data.csv] [snap seconds]
+    python benchmarks.py storage
+    python benchmarks.py cutout path/to/aia_image.fits x y
+    python benchmarks.py calibration path/to/aia_image.fits x y
+    python benchmarks.py scoring flare_cnn_RGB.h5 data
+    python benchmarks.py training data [intra op threads] [inter op threads]
+    python benchmarks.py suite [scales, e.g. 1000,10000,100000] [stages, e.g. hessi,goes,join]
+    python benchmarks.py compare [base commit] [head commit]
+if no path is given synthetic data in the same layout is used.
+"""
+
+import io
+import sys
+import time
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import datetime as dt
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import hessi_df as hdf
+import goes_df as gdf
+import intersect_hessi_goes as ihg
+import catalog_schema
+import fixtures
+import instrument
+
+RESULTS_FILE = 'benchmark_results.csv'
+SCALES = (1000, 10000, 100000)
+SUITE_STAGES = ('hessi', 'goes', 'join', 'data_prep', 'train', 'predict')
+
+def legacy_hessi_flare_dataframe(source):
+    """
+    The original per row implementation of hessi_df.hessi_flare_dataframe, kept to benchmark against.
+
+    Param:
+          source, a path or file like object for the HESSI flare list
+
+    Return:
+           df pandas dataframe, Dataframe containing HESSI flare data
+    """
+
+    header = ['Flare', 'Start_time', 'Peak_time', 'End_time', 'Dur (s)', 'Peak (c/s)', 'Total (Counts)', 'Energy (keV)', 'X Pos (asec)', 'Y Pos (asec)', 'Radial (asec)', 'AR', 'Flags']
+    int_indexes = [0, 4, 5, 6, 8, 9, 10, 11]
+    dt_indexes = [1, 2, 3]
+
+    df = pd.read_csv(source, sep='\t', header=None, skiprows=6, engine='python', skipfooter=39)
+
+    data = []
+    for row_index in range(len(df)):
+        row_data = df.iat[row_index, 0].split()
+        not_flag_col = row_data[:13]
+        flag_col = '-'.join(row_data[13:])
+        start_date = not_flag_col.pop(1)
+        for i in dt_indexes:
+            not_flag_col[i] = start_date + ' ' + not_flag_col[i]
+        data.append(not_flag_col+[flag_col])
+    df = pd.DataFrame(np.array(data), columns=header)
+
+    for i in int_indexes:
+        df[header[i]] = pd.to_numeric(df[header[i]])
+    for i in dt_indexes:
+        df[header[i]] = pd.to_datetime(df[header[i]])
+
+    for idx, row in df.iterrows():
+        if row['End_time'] < row['Start_time']:
+            row.loc['End_time'] = row['End_time'] + dt.timedelta(days=1)
+        if row['Peak_time'] < row['Start_time']:
+            row.loc['Peak_time'] = row['Peak_time'] + dt.timedelta(days=1)
+
+    return df
+
+def benchmark_hessi(text):
+    """
+    Times the legacy and the vectorised HESSI parsers on the same text and checks they give the same frame
+    (apart from flares that go over midnight, which the legacy parser never managed to correct)
+
+    Param:
+          text string, the contents of a HESSI flare list
+
+    Return:
+           dictionary of timings in seconds and the speed up
+    """
+
+    t0 = time.perf_counter()
+    legacy = legacy_hessi_flare_dataframe(io.StringIO(text))
+    legacy_time = time.perf_counter() - t0
+
+    # the new parser is quick enough that it is worth taking the best of a few runs, without the instrument timer around it
+    parse = hdf.parse_hessi_flare_list.__wrapped__
+    new_time = float('inf')
+    for i in range(3):
+        t0 = time.perf_counter()
+        new = parse(text)
+        new_time = min(new_time, time.perf_counter() - t0)
+
+    # the legacy frame still has the wrong date for times after midnight so correct it before comparing
+    for column in ['Peak_time', 'End_time']:
+        legacy[column] = legacy[column].where(legacy[column] >= legacy['Start_time'], legacy[column] + pd.Timedelta(days=1))
+    # the new frame also has the flag columns and keeps the catalog in the compact types, so compare in the legacy types
+    pd.testing.assert_frame_equal(legacy, new[legacy.columns].astype(legacy.dtypes.to_dict()), check_dtype=False)
+
+    return {'rows': len(new.index), 'legacy (s)': legacy_time, 'vectorised (s)': new_time, 'speed up': legacy_time / new_time}
+
+def legacy_parse_goes_report(goes):
+    """
+    The original per row processing of a GOES report from goes_df.goes_dataframe, kept to benchmark against.
+
+    Param:
+          goes pandas dataframe, the report as read by pandas read_fwf
+
+    Return:
+           goes pandas dataframe
+    """
+
+    def goes_times(goes, idx):
+        e = []
+        for code in goes.iloc[:, idx].values:
+            time_string = str(code).split('.')[0]
+            if time_string != 'nan':
+                while len(time_string) < 4:
+                    time_string = '0' + time_string
+            e.append(time_string)
+        return e
+
+    header = ['Date', 'Start_time', 'End_time', 'Peak_time', 'Class']
+    d = pd.Series([str(code)[5:11] for code in goes.iloc[:, 0].values])
+    s = pd.Series(goes_times(goes, 1))
+    e = pd.Series(goes_times(goes, 2))
+    p = pd.Series(goes_times(goes, 3))
+    c = goes.iloc[:, 5]
+    goes = pd.concat([d, s, e, p, c], axis=1)
+    goes.columns = header
+    goes.dropna(inplace=True)
+    goes = goes[goes['Peak_time'] != '////']
+    goes['Date'] = pd.to_datetime(goes['Date'], format='%y%m%d')
+    for i in range(1, 4):
+        goes[header[i]] = pd.to_datetime(goes[header[i]], format='%H%M')
+        for idx, row in goes.iterrows():
+            date = row['Date']
+            goes.iat[idx-1, i] = row[header[i]].replace(day = date.day, month=date.month, year=date.year)
+    for idx, row in goes.iterrows():
+        if row['End_time'] < row['Start_time']:
+            row.loc['End_time'] = row['End_time'] + dt.timedelta(days=1)
+        if row['Peak_time'] < row['Start_time']:
+            row.loc['Peak_time'] = row['Peak_time'] + dt.timedelta(days=1)
+    goes.drop(columns='Date', inplace=True)
+
+    return goes
+
+def legacy_filter(df, remove_flags):
+    """
+    hessi_df.filter before the flags were parsed into bits, with the drop result kept so it gives the same rows
+    """
+
+    df = df[df['Radial (asec)'] <= np.percentile(df['Radial (asec)'].values, 99)]
+    bad_indexes = []
+    for idx, row in df.iterrows():
+        for f in row['Flags'].split('-'):
+            if f in remove_flags:
+                bad_indexes.append(idx)
+    df = df.drop(set(bad_indexes))
+    return df[df['AR'] > 0]
+
+def benchmark_filter(hessi, remove_flags=('NS', 'SD'), legacy=True):
+    """
+    Times filtering the HESSI catalog with the flag bits against splitting the Flags of every row
+
+    Param:
+          hessi pandas dataframe, from hessi_df.parse_hessi_flare_list
+          remove_flags tuple of strings, the flags to filter out
+          legacy boolean, False to skip the (slow) legacy filter
+
+    Return:
+           dictionary of timings in seconds and the speed up
+    """
+
+    remove_flags = list(remove_flags)
+    new_time = float('inf')
+    for i in range(3):
+        t0 = time.perf_counter()
+        new = hdf.filter(hessi, remove_flags)
+        new_time = min(new_time, time.perf_counter() - t0)
+    results = {'rows': len(hessi.index), 'kept': len(new.index), 'bits (s)': new_time}
+    if legacy:
+        t0 = time.perf_counter()
+        old = legacy_filter(hessi.astype({'AR': np.int64, 'Flags': object}), remove_flags) # the legacy filter needs the old column types
+        results['legacy (s)'] = time.perf_counter() - t0
+        results['speed up'] = results['legacy (s)'] / new_time
+        assert old.index.equals(new.index)
+    return results
+
+def benchmark_goes(text):
+    """
+    Times the legacy and the vectorised processing of a GOES report on the same text
+    (the frames are not compared because the legacy code wrote each row's date into the row above it)
+
+    Param:
+          text string, the contents of a GOES XRS report
+
+    Return:
+           dictionary of timings in seconds and the speed up
+    """
+
+    t0 = time.perf_counter()
+    legacy = legacy_parse_goes_report(pd.read_fwf(io.StringIO(text), sep='\t', lineterminator='\n', header=None))
+    legacy_time = time.perf_counter() - t0
+
+    new_time = float('inf')
+    for i in range(3):
+        t0 = time.perf_counter()
+        new = gdf.parse_goes_report(pd.read_fwf(io.StringIO(text), sep='\t', lineterminator='\n', header=None))
+        new_time = min(new_time, time.perf_counter() - t0)
+
+    return {'rows': len(new.index), 'legacy rows': len(legacy.index), 'legacy (s)': legacy_time, 'vectorised (s)': new_time, 'speed up': legacy_time / new_time}
+
+def legacy_join_flares(hessi, goes):
+    """
+    The original matching loop from intersect_hessi_goes.intersect_hessi_goes, kept to benchmark against.
+
+    Param:
+          hessi pandas dataframe, HESSI flares
+          goes pandas dataframe, GOES flares
+
+    Return:
+           data pandas dataframe, the flares that matched exactly one HESSI flare
+    """
+
+    data = {'Peak_time': [], 'X_pos': [], 'Y_pos': [], 'Class': []}
+    for idx, row in goes.iterrows():
+        match = hessi[hessi['Peak_time'].between(row['Start_time'], row['End_time'])]
+        if len(match.index) == 1:
+            data['Peak_time'].append(match['Peak_time'].to_numpy()[0])
+            data['X_pos'].append(match['X Pos (asec)'].to_numpy()[0])
+            data['Y_pos'].append(match['Y Pos (asec)'].to_numpy()[0])
+            data['Class'].append(row['Class'])
+    return pd.DataFrame.from_dict(data)
+
+def benchmark_join(hessi, goes, legacy=True):
+    """
+    Times the legacy scan and the sorted interval join on the same catalogs and checks they find the same flares
+
+    Param:
+          hessi pandas dataframe, HESSI flares
+          goes pandas dataframe, GOES flares
+          legacy boolean, False to skip the (slow) legacy scan
+
+    Return:
+           dictionary of timings in seconds
+    """
+
+    result = {'HESSI rows': len(hessi.index), 'GOES rows': len(goes.index)}
+
+    t0 = time.perf_counter()
+    new = ihg.join_flares(hessi, goes)
+    result['interval join (s)'] = time.perf_counter() - t0
+    result['matches'] = len(new.index)
+
+    t0 = time.perf_counter()
+    candidates = ihg.candidate_flares(hessi, goes)
+    result['candidates (s)'] = time.perf_counter() - t0
+    result['candidates'] = len(candidates.index)
+
+    if legacy:
+        t0 = time.perf_counter()
+        old = legacy_join_flares(hessi, goes)
+        result['legacy (s)'] = time.perf_counter() - t0
+        pd.testing.assert_frame_equal(old, new, check_dtype=False, check_categorical=False, check_exact=False) # the new frame has the compact types
+        result['speed up'] = result['legacy (s)'] / result['interval join (s)']
+
+    return result
+
+def legacy_cutout(path, x, y):
+    """
+    The original cutout from download_images, which plotted the full disk and the cutout before the caller plotted the cutout again to save it.
+    Kept to benchmark against, needs sunpy.
+
+    Param:
+          path string, an AIA FITS file
+          x, y numbers, the flare position in arcsec
+
+    Return:
+           numpy array, the cropped image
+    """
+
+    import download_images as di
+    from matplotlib import pyplot as plt
+
+    aia = di.calibrate_image(path)
+    aia.plot()
+    plt.colorbar()
+    aia_sub = di.cutout_image(aia, x, y, 100)
+    aia_sub.plot_settings['cmap'] = plt.get_cmap('Greys_r')
+    ax = plt.subplot(projection=aia_sub)
+    aia_sub.plot()
+    aia_sub.plot()
+    return aia_sub.data
+
+def headless_cutout(path, x, y):
+    """
+    The cutout from download_images.get_cutout without any plotting (needs sunpy)
+    """
+
+    import download_images as di
+
+    data, meta = di.get_cutout(None, x, y, fetcher=lambda t: path)
+    return data
+
+def time_in_fresh_process(function, *args, repeats=3):
+    """
+    Runs a function a few times in a new process and measures it, a new process is used so the peak memory is only from this function
+
+    Param:
+          function, a module level function (it has to be pickled to send to the process)
+          args, the arguments for the function
+          repeats integer, how many times to run it
+
+    Return:
+           seconds float, the mean time per call
+           peak_rss float, the peak resident memory of the process in MB
+    """
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(measure, function, args, repeats).result()
+
+def measure(function, args, repeats):
+    """
+    Times a function and reads the peak memory of the process (used by time_in_fresh_process)
+    """
+
+    t0 = time.perf_counter()
+    for i in range(repeats):
+        function(*args)
+    seconds = (time.perf_counter() - t0) / repeats
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in kB on linux
+
+def benchmark_cutout(path, x, y, repeats=3):
+    """
+    Times making a cutout from an AIA FITS file with the old plotting path and the headless path, each in its own process
+
+    Param:
+          path string, an AIA FITS file
+          x, y numbers, the flare position in arcsec
+          repeats integer, how many cutouts to time
+
+    Return:
+           dictionary of the time per image and peak memory for each path
+    """
+
+    legacy_time, legacy_rss = time_in_fresh_process(legacy_cutout, path, x, y, repeats=repeats)
+    headless_time, headless_rss = time_in_fresh_process(headless_cutout, path, x, y, repeats=repeats)
+
+    return {'plotted (s/image)': legacy_time, 'plotted peak RSS (MB)': legacy_rss,
+            'headless (s/image)': headless_time, 'headless peak RSS (MB)': headless_rss,
+            'speed up': legacy_time / headless_time}
+
+def compare_calibration(path, x, y, box_size=100):
+    """
+    Compares calibrating the full disk with aiaprep and then cropping against only calibrating the cutout (download_images.calibrate_cutout).
+    Needs sunpy.
+
+    Param:
+          path string, a level 1 AIA FITS file
+          x, y numbers, the flare position in arcsec
+          box_size number, the length of the sides of the box in arcsec
+
+    Return:
+           dictionary of the time for each method, the offset between the two boxes in pixels
+           and the largest difference of the overlapping pixels relative to the range of the full disk crop
+    """
+
+    import sunpy.map
+    import download_images as di
+    from astropy import units as u
+
+    aia1 = sunpy.map.Map(path)
+
+    t0 = time.perf_counter()
+    full = di.cutout_image(di.calibrate_image(aia1), x, y, box_size)
+    full_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    cut = di.calibrate_cutout(aia1, x, y, box_size)
+    cut_time = time.perf_counter() - t0
+
+    # line the boxes up using the sky position of their first pixel
+    corner = cut.pixel_to_world(0*u.pix, 0*u.pix)
+    shift = np.round(np.array([value.value for value in full.world_to_pixel(corner)])).astype(int)[::-1]
+    rows = slice(max(shift[0], 0), min(full.data.shape[0], cut.data.shape[0] + shift[0]))
+    cols = slice(max(shift[1], 0), min(full.data.shape[1], cut.data.shape[1] + shift[1]))
+    overlap_full = full.data[rows, cols]
+    overlap_cut = cut.data[rows.start - shift[0]:rows.stop - shift[0], cols.start - shift[1]:cols.stop - shift[1]]
+    difference = np.abs(overlap_full - overlap_cut).max() / (full.data.max() - full.data.min())
+
+    return {'full disk (s)': full_time, 'cutout (s)': cut_time, 'speed up': full_time / cut_time,
+            'full shape': full.data.shape, 'cutout shape': cut.data.shape, 'offset (pixels)': tuple(shift),
+            'max difference (fraction of range)': difference}
+
+def benchmark_scoring(model_filename, path, batch_sizes=(1, 16, 64, 256), workers=4, class_names=None):
+    """
+    Times scoring a directory of images with score.py for different batch sizes (the model is loaded once and warmed up first)
+
+    Param:
+          model_filename string, the .h5 file saved by cnn.py
+          path string, a directory of images
+          batch_sizes tuple of integers, the batch sizes to time
+          workers integer, the number of threads decoding images
+          class_names list of strings, the classes of the model (None for the sub directories of path, see cnn.class_names)
+
+    Return:
+           results dictionary, images per second for each batch size
+    """
+
+    import cnn # tensorflow is only needed for this benchmark
+    import score
+
+    model, shape = score.load_model(model_filename)
+    class_names = cnn.class_names(path) if class_names is None else class_names
+    files = score.list_files(path)
+    model.predict(np.zeros((1,) + shape, dtype=np.float32), verbose=0)
+    results = {'images': len(files)}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        score.score(model, shape, files, class_names, batch_size=batch_size, workers=workers)
+        results['batch size {} (images/s)'.format(batch_size)] = len(files) / (time.perf_counter() - start)
+    return results
+
+def train_architecture(path, architecture, img_rows=150, img_cols=150, color=True, batch_size=50, epochs=1, intra_op=0, inter_op=0):
+    """
+    Trains one architecture from cnn.build_CNN and measures it (used by benchmark_training in a fresh process so the threads can be set)
+
+    Return:
+           results dictionary, parameter count, time per training step, test accuracy and peak RSS
+    """
+
+    import cnn # tensorflow is only needed for this benchmark
+    from sklearn.model_selection import train_test_split
+
+    cnn.configure_threads(intra_op, inter_op)
+    x, y = cnn.data_prep(path, img_rows, img_cols, color, cache_dir=cnn.image_cache.IMAGE_CACHE_DIR)[:2] # the memory mapped cache, split with a fixed seed below
+    rows_train, rows_test = train_test_split(np.arange(len(y)), random_state=0)
+    model = cnn.build_CNN(img_rows, img_cols, color=color, num_classes=y.shape[1], architecture=architecture)
+
+    batches = cnn.image_cache.cached_batches(x, y, y.shape[1], batch_size, seed=0, rows=rows_train)
+    model.train_on_batch(*next(batches)) # the first step builds the graph
+    t0 = time.perf_counter()
+    steps = epochs * int(np.ceil(len(rows_train) / batch_size))
+    model.fit(batches, steps_per_epoch=steps // epochs, epochs=epochs, verbose=0)
+    step_time = (time.perf_counter() - t0) / steps
+    rows_test = np.sort(rows_test)
+    test = cnn.image_cache.cached_batches(x, y, y.shape[1], batch_size, shuffle=False, rows=rows_test)
+    predicted = model.predict(test, steps=int(np.ceil(len(rows_test) / batch_size)), verbose=0)
+    accuracy = np.mean(np.argmax(predicted, axis=1) == np.argmax(y[rows_test], axis=1))
+
+    return {'parameters': model.count_params(), 'step time (s)': step_time, 'accuracy': accuracy,
+            'peak RSS (MB)': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+def benchmark_training(path, architectures=('flatten', 'pooled'), intra_op=0, inter_op=0, **kwargs):
+    """
+    Compares the CNN architectures in cnn.build_CNN on the CPU, each is trained in its own process so the peak memory is only from that model
+
+    Param:
+          path string, the directory with a sub directory of images for each class
+          architectures tuple of strings, the architectures to compare
+          intra_op integer, threads used inside one operation (0 lets tensorflow choose)
+          inter_op integer, operations run at the same time (0 lets tensorflow choose)
+          kwargs, passed to train_architecture (img_rows, img_cols, color, batch_size, epochs)
+
+    Return:
+           pandas dataframe with a row for each architecture
+    """
+
+    results = {}
+    for architecture in architectures:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[architecture] = executor.submit(train_architecture, path, architecture, intra_op=intra_op, inter_op=inter_op, **kwargs).result()
+    return pd.DataFrame(results).T
+
+def benchmark_schema(hessi_text, goes_text):
+    """
+    Compares the memory of the catalogs in the types the legacy parsers gave with the compact types from catalog_schema,
+    and times a typical scan (flares near disk centre in a class or active region) on both
+
+    Param:
+          hessi_text string, the contents of a HESSI flare list
+          goes_text string, the contents of a GOES XRS report
+
+    Return:
+           hessi_report, goes_report pandas dataframes, memory per column before and after (see catalog_schema.memory_report)
+           scans dictionary, the time of a scan on each version in seconds
+    """
+
+    loose_hessi = legacy_hessi_flare_dataframe(io.StringIO(hessi_text))
+    hessi = hdf.parse_hessi_flare_list(hessi_text)
+    loose_goes = legacy_parse_goes_report(pd.read_fwf(io.StringIO(goes_text), header=None))
+    goes = gdf.parse_goes_text(goes_text)
+
+    def scan_hessi(df):
+        return df[(df['X Pos (asec)'].abs() < 500) & (df['Y Pos (asec)'].abs() < 500) & (df['AR'] == df['AR'].iloc[0])]
+
+    def scan_goes(df):
+        return df[df['Class'].isin(['M', 'X'])]
+
+    scans = {}
+    for name, scan, before, after in [('HESSI', scan_hessi, loose_hessi, hessi), ('GOES', scan_goes, loose_goes, goes)]:
+        for version, df in [('before', before), ('after', after)]:
+            seconds = float('inf')
+            for i in range(5):
+                t0 = time.perf_counter()
+                scan(df)
+                seconds = min(seconds, time.perf_counter() - t0)
+            scans['{} scan {} (s)'.format(name, version)] = seconds
+
+    return catalog_schema.memory_report(loose_hessi, hessi), catalog_schema.memory_report(loose_goes, goes), scans
+
+def benchmark_incremental(hessi, goes, updates=30, margin=pd.Timedelta(days=1)):
+    """
+    Builds the matched flares with a series of incremental updates (intersect_hessi_goes.incremental_join, going through the csv each time)
+    as if the catalogs were growing, and checks the result is the same as one full build
+
+    Param:
+          hessi pandas dataframe, from hessi_df.parse_hessi_flare_list
+          goes pandas dataframe, GOES flares
+          updates integer, the number of incremental updates
+          margin pandas timedelta, how far before the high water mark to join again
+
+    Return:
+           dictionary of the time of the full build and of the updates in seconds
+    """
+
+    import tempfile
+    import os
+
+    limit = hdf.radial_limit(hessi)
+    hessi = hdf.filter(hessi, ihg.BAD_FLAGS, limit)
+    t0 = time.perf_counter()
+    full = ihg.sort_flares(ihg.join_flares(hessi, goes))
+    full_time = time.perf_counter() - t0
+
+    # the catalogs as they were at the start of the last few days of data, then a day is added for each update
+    end = goes['End_time'].max()
+    times = [end - pd.Timedelta(days=updates - i) for i in range(updates)] + [end]
+    update_times = []
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'flares.csv')
+        data = None
+        for t in times:
+            hessi_now = hessi[hessi['End_time'] <= t]
+            goes_now = goes[goes['End_time'] <= t]
+            t0 = time.perf_counter()
+            if data is None:
+                data = ihg.sort_flares(ihg.join_flares(hessi_now, goes_now))
+            else:
+                old = catalog_schema.read_flare_data(filename)
+                data, window_hessi, window_goes = ihg.incremental_join(old, hessi_now, goes_now, state['high_water_mark'] - margin)
+                update_times.append(time.perf_counter() - t0)
+            ihg.write_flare_data(data, filename, {'radial_limit': limit, 'bad_flags': ihg.BAD_FLAGS})
+            state = ihg.load_state(filename)
+        data = catalog_schema.read_flare_data(filename)
+
+    pd.testing.assert_frame_equal(catalog_schema.read_flare_data(io.StringIO(full.to_csv(index=False))), data)
+    return {'flares': len(full.index), 'full build (s)': full_time, 'updates': len(update_times),
+            'mean update (s)': float(np.mean(update_times)), 'same as full build': True}
+
+def benchmark_frame_reuse(data, leads=(3600, 2400, 1200, 600, 0), snap=12, cache_frames=2000):
+    """
+    Counts the frames the time series of every flare need and how many of them the frame cache has to download
+    (a 1 byte stand in file is used for each frame so nothing is downloaded)
+
+    Param:
+          data pandas dataframe, flares with a Peak_time column (see catalog_schema.read_flare_data)
+          leads tuple of numbers, seconds before the peak time
+          snap number, the width of the frame time slots in seconds
+          cache_frames integer, the size cap of the cache in frames
+
+    Return:
+           dictionary of the frames wanted, downloaded and evicted
+    """
+
+    import tempfile
+    import os
+    import frame_cache
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'frame.fits')
+        with open(source, 'wb') as f:
+            f.write(b'0')
+        fetcher, stats = frame_cache.cached_fetcher(lambda t: source, os.path.join(directory, 'cache'), max_bytes=cache_frames, snap=snap)
+        t0 = time.perf_counter()
+        for t in data['Peak_time'].sort_values():
+            for lead in leads:
+                fetcher(t - pd.Timedelta(seconds=lead))
+        seconds = time.perf_counter() - t0
+
+    wanted = len(data.index) * len(leads)
+    return {'flares': len(data.index), 'frames wanted': wanted, 'downloads': stats['misses'], 'evictions': stats['evictions'],
+            'downloads saved': 1 - stats['misses'] / wanted, 'cache overhead (s/frame)': seconds / wanted}
+
+def benchmark_storage(n=500, img_rows=150, img_cols=150, dtype=None, whole=False):
+    """
+    Compares saving cutouts as png (plt.imsave, read back like cnn.data_prep) with the HDF5 cutout store on size, load throughput
+    and how much of the data survives (the png are scaled to 8 bits)
+
+    Param:
+          n integer, the number of synthetic cutouts
+          img_rows, img_cols integers, the size the cutouts are resized to when loaded
+          dtype numpy type, the type the store keeps the cutouts in (None for the lossless store, np.uint16 to quantize)
+          whole boolean, True to round the cutouts to whole data numbers (like uncalibrated AIA data) or False to keep them as calibrated floats
+
+    Return:
+           dictionary of the sizes in MB, load rates in cutouts per second and the largest error of each format (as a fraction of the cutout's range)
+    """
+
+    import tempfile
+    import os
+    import cv2
+    from matplotlib import pyplot as plt
+    import cutout_store
+
+    cutouts = fixtures.synthetic_cutouts(n)
+    if whole:
+        cutouts = [np.rint(img) for img in cutouts]
+    results = {'cutouts': n, 'whole data numbers': whole}
+    with tempfile.TemporaryDirectory() as directory:
+        png_dir = os.path.join(directory, 'B_class')
+        os.makedirs(png_dir)
+        t0 = time.perf_counter()
+        for i, img in enumerate(cutouts):
+            plt.imsave(fname=os.path.join(png_dir, '{:05d}.png'.format(i)), arr=img, cmap=plt.cm.gray)
+        results['png write (cutouts/s)'] = n / (time.perf_counter() - t0)
+        results['png size (MB)'] = sum(os.path.getsize(os.path.join(png_dir, name)) for name in os.listdir(png_dir)) / 2**20
+
+        store_path = os.path.join(directory, 'cutouts.h5')
+        t0 = time.perf_counter()
+        with cutout_store.open_store(store_path) as store:
+            for i, img in enumerate(cutouts):
+                cutout_store.write_cutout(store, '{:05d}'.format(i), img, 'B', {'Peak_time': pd.Timestamp('2012-01-01'), 'X_pos': 0.0, 'Y_pos': 0.0}, dtype=dtype)
+        results['store write (cutouts/s)'] = n / (time.perf_counter() - t0)
+        results['store size (MB)'] = os.path.getsize(store_path) / 2**20
+
+        # the png path of cnn.data_prep, decoded as 3 chanels and divided by 255
+        t0 = time.perf_counter()
+        png = [cv2.resize(cv2.imread(os.path.join(png_dir, name), 1).astype(np.float32) / 255.0, (img_cols, img_rows), interpolation=cv2.INTER_AREA)
+               for name in sorted(os.listdir(png_dir))]
+        results['png load (cutouts/s)'] = n / (time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        images, labels, classes = cutout_store.load_store(store_path, img_rows, img_cols, color=False)
+        results['store load (cutouts/s)'] = n / (time.perf_counter() - t0)
+
+        # how close each format is to the original data scaled to 0-1
+        png_error = 0.0
+        store_error = 0.0
+        with cutout_store.open_store(store_path, 'r') as store:
+            for i, img in enumerate(cutouts):
+                scaled = (img - img.min()) / (img.max() - img.min())
+                decoded = cv2.imread(os.path.join(png_dir, '{:05d}.png'.format(i)), 0).astype(np.float64) / 255.0
+                png_error = max(png_error, np.abs(decoded - scaled).max())
+                stored = cutout_store.read_cutout(store, 'B_class/{:05d}'.format(i))
+                store_error = max(store_error, np.abs((stored - stored.min()) / (stored.max() - stored.min()) - scaled).max())
+        results['png max error'] = png_error
+        results['store max error'] = store_error
+
+    results['size ratio'] = results['png size (MB)'] / results['store size (MB)']
+    results['load speed up'] = results['store load (cutouts/s)'] / results['png load (cutouts/s)']
+    return results
+
+def git_commit():
+    """
+    The short hash of the commit being benchmarked, with a + if there are uncommitted changes (unknown outside a git repository)
+    """
+
+    import subprocess
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], stderr=subprocess.DEVNULL) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+' if dirty else '')
+
+def suite_stage(results, stage, scale, function, *args, repeats=3):
+    """
+    Runs one stage of the suite a few times in an instrument timer and keeps the quickest run
+
+    Param:
+          results list, the result of the stage is added to it
+          stage string, the name of the stage
+          scale integer, the number of flares the stage was given
+          function, the stage
+          args, the arguments for the function
+          repeats integer, how many times to run it
+
+    Return:
+           the result of the function (from the last run)
+    """
+
+    best = None
+    for i in range(repeats):
+        with instrument.timer('suite ' + stage, scale=scale) as record:
+            result = function(*args)
+        if best is None or record['seconds'] < best['seconds']:
+            best = record
+    rows = instrument.size_of(result)
+    results.append({'stage': stage, 'scale': scale, 'rows': rows, 'seconds': best['seconds'],
+                    'rows per second': rows / best['seconds'] if rows else None,
+                    'memory (MB)': best['peak_rss_mb'] - best['rss_mb']})
+    return result
+
+def suite_catalogs(scale, repeats=3):
+    """
+    Times reading the HESSI and GOES catalogs and joining them (what intersect_hessi_goes does) on synthetic catalogs served from a mirror
+
+    Param:
+          scale integer, the number of HESSI flares (there is a GOES flare for a quarter of them)
+          repeats integer, how many times to run each stage
+
+    Return:
+           results list of dictionaries, one per stage
+    """
+
+    import tempfile
+    import catalog_cache
+
+    results = []
+    mirror = catalog_cache.MIRROR_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        years = fixtures.write_catalog_mirror(directory, scale)
+        catalog_cache.MIRROR_DIR = directory
+        try:
+            # the catalog cache is skipped, it would keep the synthetic frames under the real web addresses
+            hessi = suite_stage(results, 'hessi', scale, partial(hdf.hessi_flare_dataframe, cache=False), repeats=repeats)
+            goes = suite_stage(results, 'goes', scale, partial(gdf.goes_dataframe, years, cache=False), repeats=repeats)
+        finally:
+            catalog_cache.MIRROR_DIR = mirror
+
+    def join(hessi, goes):
+        hessi = hdf.filter(hessi, ihg.BAD_FLAGS, hdf.radial_limit(hessi))
+        return ihg.sort_flares(ihg.join_flares(hessi, goes))
+
+    suite_stage(results, 'join', scale, join, hessi, goes, repeats=repeats)
+    return results
+
+def suite_cnn(path, scale, img_size=32, architecture='pooled', batch_size=50):
+    """
+    Times cnn.data_prep, training for one epoch and predicting on a directory of synthetic png (run in a fresh process by benchmark_suite)
+
+    Param:
+          path string, the directory with a sub directory of images for each class
+          scale integer, the number of images
+          img_size integer, the rows and columns the images are resized to
+          architecture string, see cnn.build_CNN
+          batch_size integer, the training and prediction batch size
+
+    Return:
+           results list of dictionaries, one per stage
+    """
+
+    import cnn # tensorflow is only needed for these stages
+
+    results = []
+    x, y = suite_stage(results, 'data_prep', scale, partial(cnn.data_prep, cache_dir=None), path, img_size, img_size, True, repeats=1)
+    model = cnn.build_CNN(img_size, img_size, color=True, num_classes=y.shape[1], architecture=architecture, channels=x.shape[-1])
+
+    def train():
+        model.fit(x, y, batch_size=batch_size, epochs=1, verbose=0)
+        return x
+
+    suite_stage(results, 'train', scale, train, repeats=1)
+    suite_stage(results, 'predict', scale, partial(model.predict, batch_size=batch_size), x, repeats=1)
+    return results
+
+def benchmark_suite(scales=SCALES, stages=SUITE_STAGES, filename=RESULTS_FILE, repeats=3, img_size=32):
+    """
+    Runs the pipeline on synthetic data at several scales and appends the results to a csv with the commit they were run at (see compare_results).
+    Everything runs offline, the catalogs come from a mirror of synthetic catalogs and the CNN is trained on synthetic png cutouts
+    (kept in fixtures.FIXTURE_DIR so they are only written once for each scale).
+    The CNN stages run in a fresh process for each scale, 100k images of 32x32 RGB are ~1.2 GB once loaded.
+
+    Param:
+          scales tuple of integers, the number of flares (and cutouts) to run at
+          stages tuple of strings, the stages to run, from hessi, goes, join, data_prep, train and predict (the catalog stages go together as do the CNN stages)
+          filename string, the csv the results are added to (None to not save them)
+          repeats integer, how many times to run the catalog stages (the quickest is kept)
+          img_size integer, the rows and columns the cutouts are resized to for the CNN
+
+    Return:
+           pandas dataframe, one row per stage and scale with the time, rows per second and the memory the stage added
+    """
+
+    import os
+
+    results = []
+    for scale in scales:
+        print('scale {}'.format(scale))
+        if set(stages) & {'hessi', 'goes', 'join'}:
+            results += suite_catalogs(scale, repeats)
+        if set(stages) & {'data_prep', 'train', 'predict'}:
+            path = fixtures.write_png_cutouts(os.path.join(fixtures.FIXTURE_DIR, 'png_{}'.format(scale)), scale)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results += executor.submit(suite_cnn, path, scale, img_size).result()
+
+    df = pd.DataFrame([result for result in results if result['stage'] in stages])
+    df.insert(0, 'commit', git_commit())
+    df.insert(1, 'date', pd.Timestamp.now().floor('s'))
+    if filename is not None:
+        df.to_csv(filename, mode='a', header=not os.path.exists(filename), index=False)
+    return df
+
+def compare_results(filename=RESULTS_FILE, base=None, head=None):
+    """
+    Compares the suite results of two commits, the latest run of each stage and scale at each commit is used
+
+    Param:
+          filename string, the csv written by benchmark_suite
+          base string, the commit to compare against (None for the commit run before head)
+          head string, the commit to compare (None for the last commit run)
+
+    Return:
+           pandas dataframe, the seconds at each commit and head / base for each stage and scale (under 1 is quicker)
+    """
+
+    df = pd.read_csv(filename, parse_dates=['date'])
+    commits = list(df.sort_values('date', kind='mergesort')['commit'].drop_duplicates(keep='last'))
+    head = head or commits[-1]
+    if base is None:
+        if commits.index(head) == 0:
+            raise ValueError('there are no results from before {} to compare with'.format(head))
+        base = commits[commits.index(head) - 1]
+    latest = df.sort_values('date', kind='mergesort').drop_duplicates(['commit', 'stage', 'scale'], keep='last')
+    table = latest[latest['commit'].isin([base, head])].pivot_table(index=['stage', 'scale'], columns='commit', values='seconds')
+    table = table[[base, head]]
+    table['ratio'] = table[head] / table[base]
+    return table
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] == 'hessi':
+        if len(sys.argv) > 2:
+            with open(sys.argv[2]) as f:
+                text = f.read()
+        else:
+            text = fixtures.synthetic_hessi_text(120000)
+        print(benchmark_hessi(text))
+
+    elif sys.argv[1] == 'goes':
+        if len(sys.argv) > 2:
+            with open(sys.argv[2]) as f:
+                text = f.read()
+        else:
+            text = fixtures.synthetic_goes_text(2000)
+        print(benchmark_goes(text))
+
+    elif sys.argv[1] == 'filter':
+        if len(sys.argv) > 2:
+            with open(sys.argv[2]) as f:
+                text = f.read()
+        else:
+            text = fixtures.synthetic_hessi_text(120000)
+        print(benchmark_filter(hdf.parse_hessi_flare_list(text)))
+
+    elif sys.argv[1] == 'join':
+        hessi = hdf.parse_hessi_flare_list(fixtures.synthetic_hessi_text(120000))
+        goes = pd.concat([gdf.parse_goes_report(pd.read_fwf(io.StringIO(fixtures.synthetic_goes_text(2000, year, seed=year)), header=None)) for year in range(2002, 2018)])
+        print(benchmark_join(hessi.iloc[::10], goes.iloc[::10])) # the legacy scan is too slow for the full catalogs
+        print(benchmark_join(hessi, goes, legacy=False))
+
+    elif sys.argv[1] == 'cutout':
+        print(benchmark_cutout(sys.argv[2], float(sys.argv[3]), float(sys.argv[4])))
+
+    elif sys.argv[1] == 'calibration':
+        print(compare_calibration(sys.argv[2], float(sys.argv[3]), float(sys.argv[4])))
+
+    elif sys.argv[1] == 'scoring':
+        print(benchmark_scoring(sys.argv[2], sys.argv[3]))
+
+    elif sys.argv[1] == 'training':
+        intra_op = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        inter_op = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+        print(benchmark_training(sys.argv[2], intra_op=intra_op, inter_op=inter_op))
+
+    elif sys.argv[1] == 'schema':
+        hessi_report, goes_report, scans = benchmark_schema(fixtures.synthetic_hessi_text(120000), fixtures.synthetic_goes_text(2000))
+        print(hessi_report.to_string())
+        print(goes_report.to_string())
+        print(scans)
+
+    elif sys.argv[1] == 'incremental':
+        hessi = hdf.parse_hessi_flare_list(fixtures.synthetic_hessi_text(120000))
+        goes = catalog_schema.compact(pd.concat([gdf.parse_goes_text(fixtures.synthetic_goes_text(2000, year, seed=year)) for year in range(2002, 2018)]), catalog_schema.GOES_SCHEMA)
+        print(benchmark_incremental(hessi, goes))
+
+    elif sys.argv[1] == 'frames':
+        data = catalog_schema.read_flare_data(sys.argv[2] if len(sys.argv) > 2 else catalog_schema.FLARE_DATA_FILE)
+        print(benchmark_frame_reuse(data, snap=float(sys.argv[3]) if len(sys.argv) > 3 else 12))
+
+    elif sys.argv[1] == 'storage':
+        print(benchmark_storage())
+        print(benchmark_storage(whole=True))
+        print(benchmark_storage(dtype=np.uint16))
+
+    elif sys.argv[1] == 'suite':
+        scales = tuple(int(scale) for scale in sys.argv[2].split(',')) if len(sys.argv) > 2 else SCALES
+        stages = tuple(sys.argv[3].split(',')) if len(sys.argv) > 3 else SUITE_STAGES
+        print(benchmark_suite(scales, stages).to_string())
+
+    elif sys.argv[1] == 'compare':
+        print(compare_results(base=sys.argv[2] if len(sys.argv) > 2 else None, head=sys.argv[3] if len(sys.argv) > 3 else None).to_string())
@@ -0,0 +1,237 @@
+"""
+A local on-disk cache for the HESSI and GOES catalogs so they are not downloaded and parsed every time they are used.
+
+The raw text of each source is kept along with the parsed dataframe (as parquet, so the column types are kept).
+Raw text is keyed by the source and the dataframe by the source and the version of the parser that made it,
+so changing a parser only needs its version number to go up for old frames to be ignored.
+Remote sources are only downloaded again once they are older than max_age, and then with a conditional request
+so nothing is downloaded if the file on the server hasn't changed. Local files are checked against their size and modification time.
+
+Setting the FLARE_CATALOG_MIRROR environment variable (or passing mirror) to a directory makes every web address read the file with the same name from that directory,
+this is a stand in for the real sources so everything can be run offline. The cache is keyed by where the text was actually read from,
+so mirrored text is never served as the real source once the mirror is unset.
+"""
+
+import os
+import json
+import time
+import hashlib
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+
+import pandas as pd
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog_cache')
+MIRROR_DIR = os.environ.get('FLARE_CATALOG_MIRROR')
+
+def cache_key(source, version=None):
+    """
+    The name used for the files of a source in the cache
+
+    Param:
+          source string, a web address or path
+          version, the parser version for a dataframe or None for the raw text
+
+    Return:
+           key string
+    """
+
+    name = source if version is None else '{}#{}'.format(source, version)
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+def is_remote(source):
+    """
+    True if the source is a web address rather than a path
+    """
+
+    return source.startswith('http://') or source.startswith('https://')
+
+def mirrored(source, mirror=None):
+    """
+    Where to actually read a source from, a web address is swapped for the file with the same name in the mirror directory if there is one
+
+    Param:
+          source string, a web address or path
+          mirror string, the mirror directory (defaults to FLARE_CATALOG_MIRROR)
+
+    Return:
+           source string
+    """
+
+    mirror = mirror or MIRROR_DIR
+    if mirror and is_remote(source):
+        return os.path.join(mirror, source.rstrip('/').split('/')[-1])
+    return source
+
+def read_source(source, meta=None):
+    """
+    Reads the text of a source, if meta from a previous read is given the source is only read if it has changed
+
+    Param:
+          source string, a web address or path
+          meta dictionary, the meta data saved with the cached text (or None)
+
+    Return:
+           text string, or None if the source hasn't changed
+           meta dictionary, validators for the next read (etag, last modified or size and modification time)
+    """
+
+    meta = meta or {}
+    if is_remote(source):
+        request = Request(source)
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            with urlopen(request) as response:
+                text = response.read().decode('utf-8', errors='replace')
+                validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        except HTTPError as error:
+            if error.code == 304:
+                return None, meta
+            raise
+    else:
+        stat = os.stat(source)
+        validators = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if meta.get('size') == validators['size'] and meta.get('mtime') == validators['mtime']:
+            return None, meta
+        with open(source) as f:
+            text = f.read()
+
+    validators['digest'] = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return text, validators
+
+def load_meta(path):
+    """
+    Reads the meta data saved in a json file, None if there isn't one
+    """
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_meta(path, meta):
+    """
+    Writes meta data to a json file (replaces the old file in one go so a crash can't leave half a file)
+    """
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.tmp', path)
+
+def refresh(source, max_age=None, cache_dir=None, mirror=None):
+    """
+    Makes sure the cached raw text of a source is up to date
+
+    Param:
+          source string, a web address or path
+          max_age number, seconds before a remote source is checked again (None never checks a cached remote source)
+          cache_dir string, the cache directory (defaults to CACHE_DIR)
+          mirror string, a directory to read web addresses from instead of the web
+
+    Return:
+           meta dictionary, meta data for the cached text (the digest changes when the text does)
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    location = mirrored(source, mirror)
+    key = cache_key(location)
+    meta_path = os.path.join(cache_dir, key + '.json')
+    text_path = os.path.join(cache_dir, key + '.txt')
+    meta = load_meta(meta_path)
+
+    if meta is not None and os.path.exists(text_path):
+        age = time.time() - meta['fetched']
+        if is_remote(location) and (max_age is None or age < max_age):
+            return meta
+    else:
+        meta = None
+
+    text, validators = read_source(location, meta)
+    if text is not None:
+        with open(text_path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(text_path + '.tmp', text_path)
+    meta = dict(validators, source=location, fetched=time.time())
+    save_meta(meta_path, meta)
+
+    return meta
+
+def cached_text(source, max_age=None, cache_dir=None, mirror=None):
+    """
+    The raw text of a source, read from the cache when it is up to date
+
+    Param:
+          source string, a web address or path
+          max_age number, seconds before a remote source is checked again (None never checks a cached remote source)
+          cache_dir string, the cache directory (defaults to CACHE_DIR)
+          mirror string, a directory to read web addresses from instead of the web
+
+    Return:
+           text string
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    meta = refresh(source, max_age, cache_dir, mirror)
+    with open(os.path.join(cache_dir, cache_key(meta['source']) + '.txt')) as f:
+        return f.read()
+
+def cached_frame(source, parser, version, max_age=None, cache_dir=None, mirror=None):
+    """
+    The parsed dataframe of a source, the source is only read and parsed again when its text has changed or the parser version is different
+
+    Param:
+          source string, a web address or path
+          parser function, makes a dataframe from the text of the source
+          version, the version of the parser (change it whenever the parser output changes)
+          max_age number, seconds before a remote source is checked again (None never checks a cached remote source)
+          cache_dir string, the cache directory (defaults to CACHE_DIR)
+          mirror string, a directory to read web addresses from instead of the web
+
+    Return:
+           df pandas dataframe
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    meta = refresh(source, max_age, cache_dir, mirror)
+    location = meta['source'] # the mirrored file if there is a mirror
+    key = cache_key(location, version)
+    frame_path = os.path.join(cache_dir, key + '.parquet')
+    frame_meta = load_meta(os.path.join(cache_dir, key + '.json'))
+
+    if frame_meta is not None and frame_meta['digest'] == meta['digest'] and os.path.exists(frame_path):
+        return pd.read_parquet(frame_path)
+
+    with open(os.path.join(cache_dir, cache_key(location) + '.txt')) as f:
+        df = parser(f.read())
+    df.to_parquet(frame_path + '.tmp')
+    os.replace(frame_path + '.tmp', frame_path)
+    save_meta(os.path.join(cache_dir, key + '.json'), {'source': location, 'version': version, 'digest': meta['digest']})
+
+    return df
+
+def invalidate(source=None, cache_dir=None, mirror=None):
+    """
+    Removes a source (its text and every parsed version of it) from the cache, or everything if no source is given
+
+    Param:
+          source string, a web address or path (None for everything)
+          cache_dir string, the cache directory (defaults to CACHE_DIR)
+          mirror string, a mirror directory, its copy of the source is removed too (defaults to FLARE_CATALOG_MIRROR)
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.json'):
+            continue
+        meta = load_meta(os.path.join(cache_dir, name))
+        if source is None or meta.get('source') in (source, mirrored(source, mirror)):
+            key = name[:-len('.json')]
+            for extension in ['.txt', '.parquet', '.json']:
+                if os.path.exists(os.path.join(cache_dir, key + extension)):
+                    os.remove(os.path.join(cache_dir, key + extension))
@@ -0,0 +1,99 @@
+"""
+Compact column types for the HESSI and GOES catalogs and the matched flares in hessi_goes_flare_data.csv.
+
+Integers are stored in the smallest type that fits the catalogs, HESSI positions as float32, the matched positions as int16
+(the HESSI list only gives whole arcsec, so the csv keeps them as whole numbers), and columns with only a few different values
+(the GOES class, active region, energy range and flags) as categoricals so each row only stores a small code.
+The times stay as datetime64. Frames are cast to these types as they are parsed, so the cached parquet frames keep them too.
+
+Run from the flare_classifier directory to see the memory used by each column of hessi_goes_flare_data.csv before and after:
+    python catalog_schema.py [hessi_goes_flare_data.csv]
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+FLARE_DATA_FILE = 'hessi_goes_flare_data.csv'
+
+HESSI_SCHEMA = {'Flare': np.int32,
+                'Dur (s)': np.int32,
+                'Peak (c/s)': np.int32,
+                'Total (Counts)': np.int64, # counts of long flares can go over the int32 limit
+                'Energy (keV)': 'category',
+                'X Pos (asec)': np.float32,
+                'Y Pos (asec)': np.float32,
+                'Radial (asec)': np.float32,
+                'AR': 'category',
+                'Flags': 'category',
+                'Flag_bits': np.int32,
+                'A_level': np.int8,
+                'P_level': np.int8,
+                'Q_level': np.int8}
+
+GOES_SCHEMA = {'Class': 'category'}
+
+FLARE_SCHEMA = {'X_pos': np.int16,
+                'Y_pos': np.int16,
+                'Class': 'category'}
+
+def compact(df, schema):
+    """
+    Casts the columns of a dataframe to the types in a schema, columns that aren't in the schema (e.g. the times) are left as they are
+
+    Param:
+          df pandas dataframe, a catalog
+          schema dictionary, column name -> type (see HESSI_SCHEMA, GOES_SCHEMA and FLARE_SCHEMA)
+
+    Return:
+           df pandas dataframe, the same data in the compact types
+    """
+
+    return df.astype({column: dtype for column, dtype in schema.items() if column in df.columns})
+
+def read_flare_data(filename=FLARE_DATA_FILE):
+    """
+    Reads the matched flares (as written by intersect_hessi_goes) straight into the compact types, the strings are never kept as python objects
+
+    Param:
+          filename string, the csv file
+
+    Return:
+           data pandas dataframe, Peak_time (datetime64), X_pos and Y_pos (int16) and Class (categorical)
+    """
+
+    data = pd.read_csv(filename, dtype=FLARE_SCHEMA)
+    data['Peak_time'] = pd.to_datetime(data['Peak_time'], format='%Y-%m-%d %H:%M:%S')
+    return data
+
+def memory_report(before, after):
+    """
+    The memory used by each column of two versions of the same dataframe (includes the python strings in object columns)
+
+    Param:
+          before pandas dataframe, e.g. as read without a schema
+          after pandas dataframe, the same data with the compact types
+
+    Return:
+           report pandas dataframe, the type and MB of each column before and after, with a total row
+    """
+
+    columns = [column for column in before.columns if column in after.columns]
+    before_bytes = before[columns].memory_usage(index=False, deep=True)
+    after_bytes = after[columns].memory_usage(index=False, deep=True)
+    report = pd.DataFrame({'Before type': before[columns].dtypes.astype(str),
+                           'After type': after[columns].dtypes.astype(str),
+                           'Before (MB)': before_bytes / 2**20,
+                           'After (MB)': after_bytes / 2**20})
+    report.loc['total'] = ['', '', before_bytes.sum() / 2**20, after_bytes.sum() / 2**20]
+    report['Saving'] = report['Before (MB)'] / report['After (MB)']
+    return report
+
+if __name__ == '__main__':
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else FLARE_DATA_FILE
+    before = pd.read_csv(filename)
+    before['Peak_time'] = pd.to_datetime(before['Peak_time'], format='%Y-%m-%d %H:%M:%S')
+    after = read_flare_data(filename)
+    print(memory_report(before, after))
@@ -1,62 +1,246 @@
+import tensorflow as tf
 from tensorflow.keras import Sequential
-from tensorflow.keras.layers import Conv2D, Flatten, Dense, Dropout
+from tensorflow.keras.layers import Conv2D, Flatten, Dense, MaxPooling2D, GlobalAveragePooling2D
 import tensorflow.keras as keras
 import os
 import cv2
 import numpy as np
+
+import image_cache
+import cutout_store
+import instrument
 from sklearn.model_selection import train_test_split
 
-def data_prep(path, img_rows, img_cols, color):
+@instrument.timed('data_prep')
+def data_prep(path, img_rows, img_cols, color, cache_dir=None):
     """
     A function to preprocess the input data for a CNN.
     The images are resized, normalised to have pixel values between 0-1, converted into greyscale if required and put into a numpy array.
+    Multi channel tensors saved as .npy (see download_images.run_channels) can be used instead of png, any number of channels is kept and each channel is normalised on its own (color is ignored).
+    path can also be a cutout store (.h5, see cutout_store), the raw cutouts are normalised by their own minimum and maximum.
     Each class label is turned into a one hot pixel array and added to an ordered numpy array such that the order for the labels is the same as the images.
     The data is shuffled to make sure each batch is representative of the overall data during training which will reduce overfitting to each batch.
     This function requires that the images for each class are in a seperate directory.
     
     param:
-           - path, a string of the path to the directory containing the images
+           - path, a string of the path to the directory containing the images (or of a .h5 cutout store)
            - img_rows, an integer for the number of rows the resized image should have
            - img_cols, an integer for the number of columns the resized image should have
            - color, a boolean that is set to true if the image should be in RGB colour space or false for greyscale
+           - cache_dir, a string of the directory of the decoded image cache (see image_cache), None to decode every png (not used for .npy tensors or a cutout store)
+             with the cache nothing is copied into memory, the images are the cache's read only uint8 memory map (0-255, in the cache's order)
+             and the shuffled order is returned as well, train from it a batch at a time with image_cache.cached_batches (see uses_cache)
     return:
-           - images, a numpy array of images with pixel values normalised to be between 0 and 1.
+           - images, a numpy array of images with pixel values normalised to be between 0 and 1 (the uint8 memory map with the cache).
              numpy array dimensions are [number of images, number of rows, number of columns, number of chanels]
            - labels, a numpy array of labels associated with each image (labels are a one hot pixel numpy array [1, 0, 0, ...] or [0, 1, 0, ...], etc)
+           - order, only with the cache, a numpy array of the rows of images and labels in a random order
     """
     
+    if path.endswith('.h5'):
+        images, labels, names = cutout_store.load_store(path, img_rows, img_cols, color)
+        order = np.random.permutation(len(labels))
+        return images[order], keras.utils.to_categorical(labels[order], num_classes=len(names))
+    
+    if uses_cache(path, cache_dir):
+        images, labels, names = image_cache.load_image_cache(path, img_rows, img_cols, color, cache_dir)
+        return images, keras.utils.to_categorical(labels, num_classes=len(names)), np.random.permutation(len(labels))
+    
     images = []
     labels = []
-    for image_class in os.listdir(path):
+    names = class_names(path)
+    for label, image_class in enumerate(names):
         print('image_class =', image_class)
         path_to_class_directory = os.path.join(path, image_class)
         for img_name in os.listdir(path_to_class_directory):
             true_path = os.path.join(path_to_class_directory, img_name)
-            if color:
-                images.append(cv2.imread(true_path, 1)/255.0)
+            if img_name.endswith('.npy'):
+                images.append(load_tensor(true_path))
+            elif color:
+                images.append(cv2.imread(true_path, 1).astype(np.float32)/255.0)
             else:
-                images.append(cv2.imread(true_path, 0)/255.0) # greyscale
-            labels.append(os.listdir(path).index(image_class))
+                images.append(cv2.imread(true_path, 0).astype(np.float32)/255.0) # greyscale
+            labels.append(label)
     data = list(zip(images, labels))
     np.random.shuffle(data)
     images, labels = zip(*data)
-    images = [cv2.resize(img, (img_rows, img_cols), cv2.INTER_AREA) for img in images] # resize images to all be the same
-    if color:
-        images = np.array(images).reshape(len(images), img_rows, img_cols, 3)
-    else:
-        images = np.array(images).reshape(len(images), img_rows, img_cols, 1)
-    labels = keras.utils.to_categorical(labels, num_classes=len(os.listdir(path)))
+    images = [resize_image(img, img_rows, img_cols) for img in images] # resize images to all be the same
+    channels = images[0].shape[2] if images[0].ndim == 3 else 1
+    images = np.array(images).reshape(len(images), img_rows, img_cols, channels)
+    labels = keras.utils.to_categorical(labels, num_classes=len(names))
     return images, labels
 
-def build_CNN(img_rows, img_cols, color=False):
+def resize_image(img, img_rows, img_cols):
+    """
+    Resizes an image or a tensor, cv2 can only resize up to 4 channels at once so tensors with more are resized a channel at a time
+    """
+    
+    if img.ndim == 3 and img.shape[2] > 4:
+        return np.stack([cv2.resize(img[:, :, c], (img_cols, img_rows), interpolation=cv2.INTER_AREA) for c in range(img.shape[2])], axis=-1)
+    return cv2.resize(img, (img_cols, img_rows), interpolation=cv2.INTER_AREA) # cv2 takes (width, height)
+
+def uses_cache(path, cache_dir):
+    """
+    True if data_prep reads path from the image cache (and so returns the memory map and the shuffled order), the cache is only for png class directories
+    """
+    
+    return cache_dir is not None and not path.endswith('.h5') and not has_tensors(path)
+
+def has_tensors(path):
+    """
+    True if the class directories in path have .npy tensors rather than images
+    """
+    
+    for image_class in class_names(path):
+        names = os.listdir(os.path.join(path, image_class))
+        if names:
+            return names[0].endswith('.npy')
+    return False
+
+def load_tensor(path):
+    """
+    Loads a multi channel tensor and normalises each channel to be between 0 and 1 (the channels have very different ranges)
+    
+    Param:
+           - path, a string of the path to a .npy file [rows, columns, chanels]
+    Return:
+           - a float32 numpy array of the same shape
+    """
+    
+    tensor = np.nan_to_num(np.load(path).astype(np.float32))
+    low = tensor.min(axis=(0, 1), keepdims=True)
+    span = tensor.max(axis=(0, 1), keepdims=True) - low
+    return (tensor - low) / np.where(span > 0, span, 1)
+
+def class_names(path):
+    """
+    The names of the classes (the sub directories of path) in the order they are coded in (alphabetical)
+    
+    Param:
+           - path, a string of the path to the directory containing a directory of images for each class (or of a .h5 cutout store)
+    Return:
+           - a list of class names
+    """
+    
+    if path.endswith('.h5'):
+        with cutout_store.open_store(path, 'r') as store:
+            return sorted(store.keys())
+    return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+
+def list_images(path):
+    """
+    Lists the image files for each class without loading them.
+    
+    Param:
+           - path, a string of the path to the directory containing a directory of images for each class
+    Return:
+           - paths, a list of the paths of the images
+           - labels, a list of the class number of each image (the position of its class in class_names)
+           - names, the list of class names
+    """
+    
+    paths = []
+    labels = []
+    names = class_names(path)
+    for label, image_class in enumerate(names):
+        path_to_class_directory = os.path.join(path, image_class)
+        for img_name in sorted(os.listdir(path_to_class_directory)):
+            paths.append(os.path.join(path_to_class_directory, img_name))
+            labels.append(label)
+    return paths, labels, names
+
+def image_dataset(paths, labels, num_classes, img_rows, img_cols, color, batch_size=50, shuffle=True, repeat=False):
+    """
+    A streaming alternative to data_prep, images are read, decoded, resized and normalised in parallel as they are needed
+    and prefetched in float32 batches so memory use doesn't grow with the size of the dataset.
+    The images and labels are the same as data_prep gives (colour images are in BGR order like cv2.imread).
+    
+    param:
+           - paths, a list of image paths (see list_images)
+           - labels, a list of the class number of each image
+           - num_classes, an integer for the number of classes
+           - img_rows, an integer for the number of rows the resized image should have
+           - img_cols, an integer for the number of columns the resized image should have
+           - color, a boolean that is set to true if the image should be in colour or false for greyscale
+           - batch_size, an integer for the number of images in a batch
+           - shuffle, a boolean that is set to true to shuffle the images (reshuffled every epoch)
+           - repeat, a boolean that is set to true to repeat the dataset forever (use with steps_per_epoch in fit)
+    return:
+           - a tf.data.Dataset of (images, one hot labels) batches, images are [batch size, number of rows, number of columns, number of chanels]
+    """
+    
+    channels = 3 if color else 1
+    
+    def load(path, label):
+        img = tf.image.decode_png(tf.io.read_file(path), channels=channels)
+        if color:
+            img = tf.reverse(img, axis=[-1]) # RGB -> BGR to match cv2
+        img = tf.image.convert_image_dtype(img, tf.float32) # scales to 0-1
+        img = tf.image.resize(img, [img_rows, img_cols], method=tf.image.ResizeMethod.AREA)
+        return img, tf.one_hot(label, num_classes)
+    
+    dataset = tf.data.Dataset.from_tensor_slices((list(paths), list(labels)))
+    if shuffle:
+        dataset = dataset.shuffle(len(paths), reshuffle_each_iteration=True)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset
+
+def configure_threads(intra_op=0, inter_op=0):
+    """
+    Sets the number of threads tensorflow uses on the CPU, has to be called before the first model is built.
+    
+    Param:
+          - intra_op, an integer for the threads used inside one operation (e.g. a convolution), 0 lets tensorflow choose (the number of cores)
+          - inter_op, an integer for the number of operations that can run at the same time, 0 lets tensorflow choose
+    """
+    
+    if hasattr(tf.config, 'threading'):
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+    else: # tensorflow 1
+        config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=intra_op, inter_op_parallelism_threads=inter_op)
+        tf.compat.v1.keras.backend.set_session(tf.compat.v1.Session(config=config))
+
+def build_CNN(img_rows, img_cols, color=False, num_classes=2, architecture='flatten', channels=None, filters=20):
+    """
+    Builds and compiles the CNN.
+    
+    The 'flatten' architecture is the original model, two 3x3 convolutions at full resolution flattened into a dense layer.
+    At 150x150x3 the flatten has ~430,000 units so the dense layer has ~55M weights and dominates the step time and memory.
+    The 'pooled' architecture halves the resolution after each convolution (max pooling) and uses global average pooling before the dense layer
+    so the number of weights doesn't depend on the image size, it is much faster to train on the CPU.
+    
+    Param:
+          - img_rows, an integer for the number of rows of the images
+          - img_cols, an integer for the number of columns of the images
+          - color, a boolean that is set to true for colour images or false for greyscale
+          - num_classes, an integer for the number of classes
+          - architecture, a string 'flatten' (the original model) or 'pooled'
+          - channels, an integer for the number of channels of the input (e.g. 6 for the multi wavelength tensors), None uses color (3 or 1)
+          - filters, an integer for the number of filters in the first convolution (the width of the model), the pooled architecture doubles it after each pooling
+    Return:
+          - model, a compiled keras model
+    """
+    
+    if channels is None:
+        channels = 3 if color else 1
     model = Sequential()
-    if color:
-        model.add(Conv2D(20, kernel_size=(3, 3), strides=1, activation='relu', input_shape=(img_rows, img_cols, 3)))
+    if architecture == 'flatten':
+        model.add(Conv2D(filters, kernel_size=(3, 3), strides=1, activation='relu', input_shape=(img_rows, img_cols, channels)))
+        model.add(Conv2D(filters, kernel_size=(3, 3), strides=1, activation='relu'))
+        model.add(Flatten())
+    elif architecture == 'pooled':
+        model.add(Conv2D(filters, kernel_size=(3, 3), strides=1, padding='same', activation='relu', input_shape=(img_rows, img_cols, channels)))
+        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(Conv2D(2 * filters, kernel_size=(3, 3), strides=1, padding='same', activation='relu'))
+        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(Conv2D(4 * filters, kernel_size=(3, 3), strides=1, padding='same', activation='relu'))
+        model.add(GlobalAveragePooling2D())
     else:
-        model.add(Conv2D(20, kernel_size=(3, 3), strides=1, activation='relu', input_shape=(img_rows, img_cols, 1)))
-    model.add(Conv2D(20, kernel_size=(3, 3), strides=1, activation='relu'))
-    model.add(Flatten())
-    #model.add(Dropout(0.25))
+        raise ValueError('unknown architecture {}'.format(architecture))
     model.add(Dense(128, activation='relu'))
     model.add(Dense(num_classes, activation='softmax'))
     model.compile(loss=keras.losses.categorical_crossentropy, optimizer='adam', metrics=['accuracy'])
@@ -65,9 +249,9 @@ def build_CNN(img_rows, img_cols, color=False):
 def decode_labels(coded, class_names):
     """
     A funtion to get the name of the class by decoding a one hot pixel array.
-    Uses a list comprehension and boolean indexing.
-    The list comprehension returns the index of the variable with the highest value in each one hot pixel array.
-    That list is then used for boolean indexing with a numpy array to get a list of class_names for each label in coded.
+    Uses argmax along the class axis and integer indexing.
+    argmax returns the index of the variable with the highest value in each one hot pixel array (for the whole array at once).
+    Those indexes are then used to index a numpy array to get a list of class_names for each label in coded.
     
     Param:
           - coded, a numpy array of coded labels
@@ -76,7 +260,7 @@ def decode_labels(coded, class_names):
           - numpy array of class names for each label in coded
     """
     
-    return np.array(class_names)[[np.argmax(example) for example in coded]]
+    return np.array(class_names)[np.argmax(np.asarray(coded), axis=1)]
 
 def calc_accuracy(pred, real):
     """
@@ -93,22 +277,55 @@ def calc_accuracy(pred, real):
 
 if __name__ == '__main__':
 
-    path = 'data'
+    path = 'data' # 'channels' for the multi wavelength tensors from download_images.run_channels or 'cutouts.h5' for a cutout store
     img_rows = 150
     img_cols = 150
     is_color = True
     model_filename = 'flare_cnn'
+    batch_size = 50
+    streaming = False # True to stream the images from disk with tf.data instead of loading them all into memory
+    cache_dir = image_cache.IMAGE_CACHE_DIR # keeps the decoded images between runs and trains from them a batch at a time, None to decode every png each time
+    architecture = 'flatten' # 'pooled' is much quicker to train on the CPU
+    intra_op_threads = 0 # 0 lets tensorflow use every core
+    inter_op_threads = 0
+
+    configure_threads(intra_op_threads, inter_op_threads)
 
     print('\nloading training data\n')
-    num_classes = len(os.listdir(path))
-    x, y = data_prep(path, img_rows, img_cols, color=is_color)
-    x_train, x_test, y_train, y_test = train_test_split(x, y)
+    names = class_names(path)
+    num_classes = len(names)
+    cached = not streaming and uses_cache(path, cache_dir) # train from the memory mapped cache a batch at a time
+    if streaming:
+        paths, labels, names = list_images(path)
+        paths_train, paths_test, labels_train, labels_test = train_test_split(paths, labels)
+        paths_train, paths_val, labels_train, labels_val = train_test_split(paths_train, labels_train, test_size=0.2)
+        train = image_dataset(paths_train, labels_train, num_classes, img_rows, img_cols, is_color, batch_size=batch_size, repeat=True)
+        val = image_dataset(paths_val, labels_val, num_classes, img_rows, img_cols, is_color, batch_size=batch_size, shuffle=False, repeat=True)
+        test = image_dataset(paths_test, labels_test, num_classes, img_rows, img_cols, is_color, batch_size=batch_size, shuffle=False)
+    elif cached:
+        x, y, order = data_prep(path, img_rows, img_cols, color=is_color, cache_dir=cache_dir)
+        rows_train, rows_test = train_test_split(order, shuffle=False) # order is already shuffled
+        rows_train, rows_val = train_test_split(rows_train, test_size=0.2, shuffle=False)
+        rows_test = np.sort(rows_test)
+        train = image_cache.cached_batches(x, y, num_classes, batch_size, rows=rows_train)
+        val = image_cache.cached_batches(x, y, num_classes, batch_size, shuffle=False, rows=rows_val)
+        test = image_cache.cached_batches(x, y, num_classes, batch_size, shuffle=False, rows=rows_test)
+        y_test = y[rows_test]
+    else:
+        x, y = data_prep(path, img_rows, img_cols, color=is_color, cache_dir=cache_dir)
+        x_train, x_test, y_train, y_test = train_test_split(x, y)
+    train_count = len(paths_train) if streaming else len(rows_train) if cached else len(x_train)
 
     print('\nbuilding model\n')
-    cnn = build_CNN(img_rows, img_cols, color=is_color)
+    cnn = build_CNN(img_rows, img_cols, color=is_color, num_classes=num_classes, architecture=architecture, channels=None if streaming else x.shape[-1])
 
     print('\ntraining model\n')
-    cnn.fit(x_train, y_train, batch_size=50, epochs=1, validation_split=0.2)
+    with instrument.timer('training', rows=train_count, architecture=architecture):
+        if streaming or cached:
+            cnn.fit(train, steps_per_epoch=int(np.ceil(train_count / batch_size)), epochs=1,
+                    validation_data=val, validation_steps=int(np.ceil(len(paths_val if streaming else rows_val) / batch_size)))
+        else:
+            cnn.fit(x_train, y_train, batch_size=batch_size, epochs=1, validation_split=0.2)
     
     print('\nsaving model\n')
     if is_color:
@@ -122,9 +339,18 @@ if __name__ == '__main__':
     loaded_cnn = keras.models.load_model(model_filename)
 
     print('\ngenerating predictions\n')
-    predictions = loaded_cnn.predict(x_test)
-    dec_preds = decode_labels(predictions, os.listdir(path))
-    dec_ytest = decode_labels(y_test, os.listdir(path))
+    with instrument.timer('inference', rows=len(y_test) if cached else len(paths_test) if streaming else len(x_test)):
+        if streaming:
+            predictions = loaded_cnn.predict(test)
+            y_test = keras.utils.to_categorical(labels_test, num_classes=num_classes)
+        elif cached:
+            predictions = loaded_cnn.predict(test, steps=int(np.ceil(len(rows_test) / batch_size)))
+        else:
+            predictions = loaded_cnn.predict(x_test)
+    dec_preds = decode_labels(predictions, names)
+    dec_ytest = decode_labels(y_test, names)
     
-    # F1 score would probably be a better metric due to skew of training expample (num B > num C)
-    print('\naccuracy =', calc_accuracy(dec_preds, dec_ytest))
\ No newline at end of file
+    # F1 score would probably be a better metric due to skew of training expample (num B > num C), sweep.py cross validates with it
+    print('\naccuracy =', calc_accuracy(dec_preds, dec_ytest))
+    print('\nstage times\n')
+    print(instrument.summary())
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+Keeps cutouts in one compressed HDF5 file instead of a png per cutout.
+
+The png written by plt.imsave are the cutout scaled to 8 bits and coloured into 4 chanels (RGBA), and the CNN then decodes them back as 3 chanels.
+Here each cutout is kept as its raw single chanel data without losing anything, gzip compressed with the shuffle filter and chunked as one chunk per cutout,
+under a group for its class, with the flare's row of hessi_goes_flare_data.csv (and the cutout's offset and box size) as attributes.
+Whole data numbers (uncalibrated AIA data) are kept in the smallest integer type that holds them and anything else (calibrated data) as float32.
+Passing an integer dtype (e.g. np.uint16) to write_cutout opts in to quantizing each cutout over its own range instead,
+data = stored * scale + offset with the scale and offset as attributes of the cutout (1 and 0 for the lossless store), which is smaller but not exact.
+The CNN normalises each cutout by its own minimum and maximum when it is loaded, the same scaling imsave did but without losing the detail to 8 bits.
+
+    store.h5
+        B_class/
+            2012_03_04_10_29_21            [rows, columns] int16 or float32, attributes scale, offset, Peak_time, X_pos, Y_pos, Class, Offset, Box_size
+            2012_03_04_10_29_21_m600s_100arcsec
+        C_class/
+            ...
+"""
+
+import h5py
+import cv2
+import numpy as np
+import pandas as pd
+
+STORE_FILE = 'cutouts.h5'
+
+def open_store(path=STORE_FILE, mode='a'):
+    """
+    Opens the store, keep it open while writing many cutouts (opening it is slow compared to writing one cutout)
+
+    Param:
+          path string, the HDF5 file
+          mode string, 'a' to read and write (made if it doesn't exist) or 'r' to only read
+
+    Return:
+           store h5py File
+    """
+
+    return h5py.File(path, mode)
+
+def write_cutout(store, name, data, flare_class, attrs=None, level=4, dtype=None):
+    """
+    Writes one cutout to the store, replacing a cutout with the same name
+
+    Param:
+          store h5py File, from open_store
+          name string, the name of the cutout (see download_images.image_name)
+          data numpy array, the cutout [rows, columns]
+          flare_class string, the GOES class of the flare ('B' or 'C')
+          attrs dictionary, meta data kept with the cutout (e.g. the flare's row of the csv)
+          level integer, the gzip compression level (1 quickest - 9 smallest)
+          dtype numpy type, None keeps the data exactly (see lossless_type), an integer type (e.g. np.uint16) quantizes the cutout over its own range
+    """
+
+    group = store.require_group(flare_class + '_class')
+    if name in group:
+        del group[name]
+    data = np.asarray(data)
+    scale = 1.0
+    offset = 0.0
+    if dtype is None:
+        dtype = lossless_type(data)
+    elif np.issubdtype(dtype, np.integer) and not np.can_cast(lossless_type(data), dtype): # whole numbers that fit are kept as they are
+        data = np.nan_to_num(data.astype(np.float64))
+        offset = data.min()
+        levels = np.iinfo(dtype).max - np.iinfo(dtype).min
+        scale = (data.max() - offset) / levels if data.max() > offset else 1.0
+        data = np.rint((data - offset) / scale) + np.iinfo(dtype).min
+        offset -= np.iinfo(dtype).min * scale # so data = stored * scale + offset for signed types too
+    data = data.astype(dtype)
+    dataset = group.create_dataset(name, data=data, chunks=data.shape, compression='gzip', compression_opts=level, shuffle=True)
+    dataset.attrs['scale'] = scale
+    dataset.attrs['offset'] = offset
+    dataset.attrs['Class'] = flare_class
+    for key, value in (attrs or {}).items():
+        dataset.attrs[key] = str(value) if isinstance(value, pd.Timestamp) else value
+
+def lossless_type(data):
+    """
+    The smallest type that keeps a cutout exactly, an integer type if every value is a whole number that fits in int32, otherwise float32
+    (float64 data is kept as float32 like the original store, AIA data numbers don't need more than float32's 24 bits)
+
+    Param:
+          data numpy array, the cutout
+
+    Return:
+           numpy type
+    """
+
+    if data.size and np.all(np.isfinite(data)) and np.array_equal(data, np.rint(data)):
+        for dtype in (np.uint8, np.int16, np.uint16, np.int32):
+            if np.iinfo(dtype).min <= data.min() and data.max() <= np.iinfo(dtype).max:
+                return dtype
+    return np.float32
+
+def read_cutout(store, name):
+    """
+    Reads one cutout back as the data it was written from (exactly, or to within the quantization if it was written with an integer dtype)
+
+    Param:
+          store h5py File, from open_store
+          name string, 'class/name' of the cutout (see cutout_names)
+
+    Return:
+           data numpy array, float64 [rows, columns]
+    """
+
+    dataset = store[name]
+    return dataset[()].astype(np.float64) * dataset.attrs.get('scale', 1.0) + dataset.attrs.get('offset', 0.0)
+
+def cutout_names(store):
+    """
+    Lists the cutouts in the store
+
+    Param:
+          store h5py File, from open_store
+
+    Return:
+           names list of strings, 'class/name' for each cutout in a fixed order
+    """
+
+    return ['{}/{}'.format(group, name) for group in sorted(store.keys()) for name in sorted(store[group].keys())]
+
+def store_metadata(path=STORE_FILE):
+    """
+    The meta data of every cutout in the store as a dataframe (like hessi_goes_flare_data.csv with the offset and box size of each cutout)
+
+    Param:
+          path string, the HDF5 file
+
+    Return:
+           pandas dataframe, one row per cutout with a Name column and a column for each attribute
+    """
+
+    with open_store(path, 'r') as store:
+        rows = [{key: value for key, value in dict(store[name].attrs, Name=name).items() if key not in ('scale', 'offset')} for name in cutout_names(store)]
+    df = pd.DataFrame(rows)
+    if 'Peak_time' in df.columns:
+        df['Peak_time'] = pd.to_datetime(df['Peak_time'])
+    return df
+
+def load_store(path, img_rows, img_cols, color=False):
+    """
+    Loads every cutout in the store for the CNN, each cutout is scaled to 0-1 by its own minimum and maximum and resized
+
+    Param:
+          path string, the HDF5 file
+          img_rows integer, the number of rows of the resized images
+          img_cols integer, the number of columns of the resized images
+          color boolean, True to repeat the cutout into 3 chanels (for models trained on the colour png) or False for 1 chanel
+
+    Return:
+           images numpy array, float32 [number of cutouts, rows, columns, chanels]
+           labels numpy array, the class number of each cutout
+           classes list of strings, the class names in the order they are coded (alphabetical, e.g. 'B_class')
+    """
+
+    channels = 3 if color else 1
+    with open_store(path, 'r') as store:
+        classes = sorted(store.keys())
+        names = cutout_names(store)
+        images = np.empty((len(names), img_rows, img_cols, channels), dtype=np.float32)
+        labels = np.empty(len(names), dtype=np.int16)
+        for i, name in enumerate(names):
+            data = np.nan_to_num(store[name][()].astype(np.float32)) # the scale and offset cancel out in the min max normalisation
+            low = data.min()
+            span = data.max() - low
+            img = cv2.resize(data, (img_cols, img_rows), interpolation=cv2.INTER_AREA)
+            images[i] = ((img - low) / span if span > 0 else img * 0)[:, :, np.newaxis]
+            labels[i] = classes.index(name.split('/')[0])
+    return images, labels, classes
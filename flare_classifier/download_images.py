@@ -15,9 +15,27 @@ from astropy import units as u
 import warnings
 warnings.filterwarnings("ignore")
 
+import numpy as np
+from scipy.ndimage import affine_transform
+
 import pandas as pd
 import datetime as dt
 import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import catalog_schema
+import cutout_store
+import flare_index
+import frame_cache
+import instrument
+
+AIA_SCALE = 0.6 # arcsec per pixel of a calibrated (level 1.5) AIA image
+AIA_CADENCE = 12 # seconds between AIA images
+AIA_WAVELENGTHS = (94, 131, 171, 193, 211, 335) # the EUV channels in angstrom
+SDO_START = '2010-06-06 02:52:58' # SDO started after HESSI and GOES!!!!
 
 def get_box_coord(flare_x, flare_y, box_size):
     """
@@ -32,7 +50,7 @@ def get_box_coord(flare_x, flare_y, box_size):
     
     return [(flare_x - 0.5*box_size, flare_y + 0.5*box_size), (flare_x + 0.5*box_size, flare_y + 0.5*box_size), (flare_x - 0.5*box_size, flare_y - 0.5*box_size), (flare_x + 0.5*box_size, flare_y - 0.5*box_size)]
 
-def get_image(t, x, y):
+def get_image(t, x, y, plot=False, fetcher=None):
     """
     This function gets an AIA EUV image from the SDO (AIA = Atmospheric Imaging Assembly, EUV = Extreme UltraViolent, SDO = SOlar Dynamics Observatory)
     at a given time t, and crops the image to given location x, y.
@@ -41,71 +59,779 @@ def get_image(t, x, y):
           t datetime, the datetime of the flare
           x integer, the longitude position of the flare in arcsec
           y integer, the latitude position of the flare in arcsec
+          plot boolean, True to plot the full disk image and the cropped image (for debugging, the plots are slow for a full disk)
+          fetcher function, takes a datetime and returns the path of a FITS file instead of searching and downloading it (see local_fetcher)
     
     Return:
            aia_sub sunpy Map, the cropped image
     """
 
-    # request the data for the given time
-    result = Fido.search(a.Time(t - dt.timedelta(seconds=10), t), a.Instrument("aia"), a.Wavelength(94*u.angstrom), a.vso.Sample(12*u.second))
-    print('found result')
-    #print(result)
+    if fetcher is None:
+        # request the data for the given time
+        result = search_image(t)
+        print('found result')
 
-    # download the data
-    file_download = Fido.fetch(result[0, -1], site='ROB')
-    print('downloaded data')
-    #print(file_download)
+        # download the data
+        path = download_image(result)
+        print('downloaded data')
+    else:
+        path = fetcher(t)
 
-    # load the data to a sun map
-    aia1 = sunpy.map.Map(file_download)
-    print('loaded to sun map')
-    #print(aia1)
-
-    # calibrate it
-    aia = aiaprep(aia1)
+    # load the data to a sun map and calibrate it
+    aia = calibrate_image(path)
     print('calibrated')
     
-    # plot it
+    # crop it
+    aia_sub = cutout_image(aia, x, y, 100)
+    print('made sub map')
+    
+    if plot:
+        plot_images(aia, aia_sub)
+
+    return aia_sub
+
+def get_cutout(t, x, y, box_size=100, plot=False, fetcher=None, calibration='full'):
+    """
+    Gets the cropped AIA image around a flare as a numpy array without making any plots
+    
+    Param:
+          t datetime, the datetime of the flare
+          x integer, the longitude position of the flare in arcsec
+          y integer, the latitude position of the flare in arcsec
+          box_size number, the length of the sides of the box in arcsec
+          plot boolean, True to also plot the images (for debugging)
+          fetcher function, takes a datetime and returns the path of a FITS file instead of searching and downloading it (see local_fetcher)
+          calibration string, 'full' to calibrate the full disk with aiaprep or 'cutout' to only calibrate around the flare (see calibrate_cutout)
+    
+    Return:
+           data numpy array, the cropped image
+           meta dictionary, the WCS of the cropped image and the time, wavelength and exposure time of the observation
+    """
+    
+    path = fetcher(t) if fetcher is not None else download_image(search_image(t))
+    if calibration == 'cutout':
+        aia = sunpy.map.Map(path)
+        aia_sub = calibrate_cutout(aia, x, y, box_size)
+    else:
+        aia = calibrate_image(path)
+        aia_sub = cutout_image(aia, x, y, box_size)
+    
+    if plot:
+        plot_images(aia, aia_sub)
+    
+    return aia_sub.data, cutout_meta(aia_sub)
+
+def plot_images(aia, aia_sub):
+    """
+    Plots a full disk image and its cutout in two figures (for debugging, call plt.show() to see them)
+    
+    Param:
+          aia sunpy Map, the calibrated full disk image
+          aia_sub sunpy Map, the cropped image
+    """
+    
+    plt.figure()
     aia.plot()
     plt.colorbar()
-    #plt.show()
+    plt.figure()
+    aia_sub.plot_settings['cmap'] = plt.get_cmap('Greys_r')
+    ax = plt.subplot(projection=aia_sub)
+    aia_sub.plot()
+
+def cutout_meta(aia_sub):
+    """
+    The meta data kept with a cutout, enough to put it back on the sky
     
-    # get the co-ordinates of the top right and bottom left of the crop box
-    co_ords = get_box_coord(x, y, 100)
+    Param:
+          aia_sub sunpy Map, the cropped image
+    
+    Return:
+           meta dictionary
+    """
+    
+    meta = dict(aia_sub.wcs.to_header())
+    meta['date-obs'] = str(aia_sub.date)
+    meta['wavelnth'] = aia_sub.wavelength.to_value(u.angstrom)
+    meta['exptime'] = aia_sub.exposure_time.to_value(u.s)
+    return meta
+
+def search_image(t, wavelength=94):
+    """
+    Searches for the AIA image closest to and before a given time
+    
+    Param:
+          t datetime, the datetime of the flare
+          wavelength integer, the AIA channel in angstrom
+    
+    Return:
+           result, the Fido search result
+    """
+    
+    return Fido.search(a.Time(t - dt.timedelta(seconds=10), t), a.Instrument("aia"), a.Wavelength(wavelength*u.angstrom), a.vso.Sample(12*u.second))
+
+def download_image(result, directory=None):
+    """
+    Downloads the last image in a Fido search result
+    
+    Param:
+          result, the Fido search result from search_image
+          directory string, where to save the file (None for the sunpy download directory)
+    
+    Return:
+           path string, the path of the downloaded FITS file
+    """
+    
+    if directory is None:
+        return Fido.fetch(result[0, -1], site='ROB')[0]
+    return Fido.fetch(result[0, -1], site='ROB', path=os.path.join(directory, '{file}'))[0]
+
+def search_and_download(directory=None, wavelength=94):
+    """
+    Makes a fetcher that searches for and downloads the frame for a time (the default when no fetcher is given)
+    
+    Param:
+          directory string, where to save the files (None for the sunpy download directory)
+          wavelength integer, the AIA channel in angstrom
+    
+    Return:
+           fetcher function, takes a datetime and returns the path of the downloaded FITS file
+    """
+    
+    def fetcher(t):
+        return download_image(search_image(t, wavelength), directory)
+    
+    return fetcher
+
+def local_fetcher(directory):
+    """
+    Makes a fetcher that uses FITS files that are already on disk instead of searching and downloading them (for testing and offline runs).
+    The file named after the flare (see image_name) is used if there is one, otherwise the first FITS file in the directory stands in for every flare.
+    
+    Param:
+          directory string, the directory with the FITS files
+    
+    Return:
+           fetcher function, takes a datetime and returns the path of a FITS file
+    """
+    
+    files = sorted(f for f in os.listdir(directory) if f.endswith('.fits'))
+    if not files:
+        raise FileNotFoundError('no FITS files in {}'.format(directory))
+    
+    def fetcher(t):
+        name = image_name(t, '.fits')
+        return os.path.join(directory, name if name in files else files[0])
+    
+    return fetcher
+
+def calibrate_image(path):
+    """
+    Loads a downloaded AIA image and calibrates it
+    
+    Param:
+          path string, the FITS file
+    
+    Return:
+           aia sunpy Map, the calibrated full disk image
+    """
+    
+    return aiaprep(sunpy.map.Map(path))
+
+def cutout_image(aia, x, y, box_size=100):
+    """
+    Crops a calibrated image to a box around a flare
+    
+    Param:
+          aia sunpy Map, the calibrated image
+          x integer, the longitude position of the flare in arcsec
+          y integer, the latitude position of the flare in arcsec
+          box_size number, the length of the sides of the box in arcsec
+    
+    Return:
+           aia_sub sunpy Map, the cropped image
+    """
+    
+    co_ords = get_box_coord(x, y, box_size)
     tr = co_ords[1]
     bl = co_ords[2]
-    
-    # sub-map
     top_right = SkyCoord(tr[0]*u.arcsec, tr[1]*u.arcsec, frame=aia.coordinate_frame)
-    bottom_left = SkyCoord(bl[0]* u.arcsec, bl[1]* u.arcsec, frame=aia.coordinate_frame)
-    aia_sub = aia.submap(top_right, bottom_left)
-    aia_sub.plot_settings['cmap'] = plt.get_cmap('Greys_r')
-    ax = plt.subplot(projection=aia_sub)
-    aia_sub.plot()
-    #plt.show()
-    print('made sub map')
+    bottom_left = SkyCoord(bl[0]*u.arcsec, bl[1]*u.arcsec, frame=aia.coordinate_frame)
+    
+    return aia.submap(top_right, bottom_left)
 
-    return aia_sub
+def calibrate_cutout(path, x, y, box_size=100, order=3, cval=None):
+    """
+    Calibrates only the part of a level 1 AIA image around a flare instead of the full disk and then crops it.
+    aiaprep rotates, rescales and recenters all ~16 million pixels to keep a box of ~170x170 pixels, this does the same registration
+    (north up, 0.6 arcsec per pixel, on the full disk grid) but only interpolates a slightly padded window around the box.
+    
+    The result matches cropping the output of aiaprep to within the interpolation: the box can start one 0.6 arcsec pixel away
+    from the full disk crop (the full disk grid is only reproduced to within a pixel) and the pixel values differ by the difference between
+    spline interpolation of the window and aiaprep's interpolation of the whole image (well under 1% of the box's range for on disk flares).
+    benchmarks.compare_calibration measures both for a given image.
+    
+    Param:
+          path string, the level 1 FITS file (or a sunpy Map of it)
+          x integer, the longitude position of the flare in arcsec
+          y integer, the latitude position of the flare in arcsec
+          box_size number, the length of the sides of the box in arcsec
+          order integer, the order of the spline interpolation (3 like aiaprep)
+          cval number, the value of pixels that fall off the image (aiaprep uses the minimum of the image), None to only work out
+               the minimum of the image when the box reaches its edge (otherwise no pixel can fall off the window so the full image is never scanned)
+    
+    Return:
+           aia_sub sunpy Map, the calibrated cropped image
+    """
+    
+    aia1 = sunpy.map.Map(path) if isinstance(path, str) else path
+    
+    # pixel -> world for the raw image is world = cdelt * PC (p - crpix) and for the calibrated image it is world = AIA_SCALE (q - crpix),
+    # both share the reference coordinate so a calibrated pixel q is the raw pixel crpix + A (q - centre)
+    raw_ref = np.array([aia1.meta['crpix1'], aia1.meta['crpix2']]) - 1 # FITS pixels start at 1
+    raw_scale = np.array([aia1.scale[0].to_value(u.arcsec/u.pix), aia1.scale[1].to_value(u.arcsec/u.pix)])
+    A = np.linalg.inv(np.asarray(aia1.rotation_matrix)) @ np.diag(AIA_SCALE / raw_scale)
+    centre = (np.array(aia1.data.shape[::-1]) - 1) / 2.0 # aiaprep puts the reference coordinate in the middle of the image
+    ref = np.array([aia1.reference_coordinate.Tx.to_value(u.arcsec), aia1.reference_coordinate.Ty.to_value(u.arcsec)])
+    
+    # calibrated pixels of the box, padded so cropping it afterwards works the same way as for a full disk image
+    half = 0.5 * box_size / AIA_SCALE + 2
+    box_centre = centre + (np.array([x, y]) - ref) / AIA_SCALE
+    q0 = np.floor(box_centre - half).astype(int)
+    shape = (np.ceil(box_centre + half).astype(int) - q0 + 1)
+    
+    # the window of the raw image those pixels come from, padded for the interpolation
+    corners = np.array([[0, 0], [shape[0], 0], [0, shape[1]], [shape[0], shape[1]]]) + q0
+    raw_corners = raw_ref + (corners - centre) @ A.T
+    pad = 2 * order + 2 # the spline prefilter of the window is affected a few pixels in from its edges
+    w0 = np.maximum(np.floor(raw_corners.min(axis=0)).astype(int) - pad, 0)
+    w1 = np.minimum(np.ceil(raw_corners.max(axis=0)).astype(int) + pad, np.array(aia1.data.shape[::-1]) - 1)
+    window = aia1.data[w0[1]:w1[1] + 1, w0[0]:w1[0] + 1].astype(np.float64)
+    if cval is None:
+        clipped = (np.floor(raw_corners.min(axis=0)) - pad < 0).any() or (np.ceil(raw_corners.max(axis=0)) + pad > np.array(aia1.data.shape[::-1]) - 1).any()
+        cval = np.nanmin(aia1.data) if clipped else np.nanmin(window)
+    
+    # numpy arrays are indexed (y, x) so flip everything for affine_transform
+    matrix = A[::-1, ::-1]
+    offset = (raw_ref - w0)[::-1] + matrix @ (q0 - centre)[::-1]
+    data = affine_transform(window, matrix, offset=offset, output_shape=tuple(shape[::-1]), order=order, cval=cval)
+    
+    meta = aia1.meta.copy()
+    for key in ['crota1', 'crota2', 'pc1_1', 'pc1_2', 'pc2_1', 'pc2_2']:
+        meta.pop(key, None)
+    meta['naxis1'] = shape[0]
+    meta['naxis2'] = shape[1]
+    meta['cdelt1'] = AIA_SCALE
+    meta['cdelt2'] = AIA_SCALE
+    meta['crpix1'] = centre[0] - q0[0] + 1
+    meta['crpix2'] = centre[1] - q0[1] + 1
+    meta['crval1'] = ref[0]
+    meta['crval2'] = ref[1]
+    meta['r_sun'] = meta['rsun_obs'] / meta['cdelt1']
+    meta['lvl_num'] = 1.5
+    meta['bitpix'] = -64
+    
+    return cutout_image(sunpy.map.Map(data, meta), x, y, box_size)
+
+def image_name(t, extension='.png'):
+    """
+    The file name used for the image of a flare
+    
+    Param:
+          t datetime, the peak time of the flare
+          extension string, the file extension
+    
+    Return:
+           name string
+    """
+    
+    return str(t).replace(' ', '_').replace(':', '_').replace('-', '_') + extension
+
+def save_image(data, flare_class, t, out_dir='data', suffix=''):
+    """
+    Saves a cutout as a greyscale png in the directory for its class
+    
+    Param:
+          data numpy array, the cutout
+          flare_class string, the GOES class of the flare ('B' or 'C')
+          t datetime, the peak time of the flare
+          out_dir string, the directory with a sub directory for each class
+          suffix string, added to the end of the name (see cutout_suffix)
+    
+    Return:
+           path string, where the image was saved
+    """
+    
+    path = os.path.join(out_dir, flare_class + '_class', image_name(t, suffix + '.png'))
+    plt.imsave(fname=path, arr=data, cmap=plt.cm.gray)
+    return path
+
+def store_cutout(store, lock, data, row):
+    """
+    Writes a cutout and its flare's meta data to an open cutout store (HDF5 can only be written by one thread at a time)
+    
+    Param:
+          store h5py File, from cutout_store.open_store
+          lock threading lock, shared by the workers
+          data numpy array, the cutout
+          row pandas series, the cutout's row of the plan (see plan_batches)
+    """
+    
+    attrs = {'Peak_time': row['Peak_time'], 'X_pos': row['X_pos'], 'Y_pos': row['Y_pos'], 'Offset': row['Offset'], 'Box_size': row['Box_size']}
+    with lock:
+        cutout_store.write_cutout(store, image_name(row['Peak_time'], cutout_suffix(row['Offset'], row['Box_size'])), data, row['Class'], attrs)
+
+def load_manifest(manifest):
+    """
+    Reads the peak times of the flares that have already been downloaded
+    
+    Param:
+          manifest string, the manifest file (one peak time per line)
+    
+    Return:
+           done set of strings
+    """
+    
+    if manifest is None or not os.path.exists(manifest):
+        return set()
+    with open(manifest) as f:
+        return set(line.strip() for line in f if line.strip())
+
+def add_stage_time(stats, lock, stage, seconds):
+    """
+    Adds the time taken by one item to the counters for a pipeline stage
+    
+    Param:
+          stats dictionary, stage name -> {'count': number of items, 'seconds': total time}
+          lock threading lock, shared by the workers
+          stage string, the name of the stage
+          seconds float, the time the stage took for the item
+    """
+    
+    with lock:
+        counter = stats.setdefault(stage, {'count': 0, 'seconds': 0.0})
+        counter['count'] += 1
+        counter['seconds'] += seconds
+
+def plan_batches(data, offsets=(0,), box_sizes=(100,), cadence=AIA_CADENCE):
+    """
+    Works out which cutouts can share an AIA frame so each frame is only downloaded and calibrated once.
+    A cutout is wanted for every flare, offset before its peak time and box size. The wanted times are sorted and a new frame is started
+    whenever a time is more than one AIA cadence after the first time of the current frame, the frame is then searched for at that first time.
+    So every cutout in a frame comes from an image at most cadence + 10 seconds (the search window) before its wanted time.
+    
+    Param:
+          data pandas dataframe, flares with Peak_time, X_pos, Y_pos and Class columns (see hessi_goes_flare_data.csv)
+          offsets iterable of numbers, seconds before the peak time to get images for (0 is the peak)
+          box_sizes iterable of numbers, lengths of the sides of the boxes in arcsec
+          cadence number, seconds between AIA images
+    
+    Return:
+           plan pandas dataframe, one row per cutout with the flare columns, Offset, Box_size, Key (for the manifest),
+           Frame (a number for each frame) and Frame_time (the time to search for the frame at)
+    """
+    
+    plan = []
+    for offset in offsets:
+        for box_size in box_sizes:
+            cutouts = data.copy()
+            cutouts['Offset'] = offset
+            cutouts['Box_size'] = box_size
+            plan.append(cutouts)
+    plan = pd.concat(plan, ignore_index=True)
+    plan['Key'] = [manifest_key(t, offset, box_size) for t, offset, box_size in zip(plan['Peak_time'], plan['Offset'], plan['Box_size'])]
+    
+    wanted = plan['Peak_time'] - pd.to_timedelta(plan['Offset'], unit='s')
+    plan = plan.iloc[np.argsort(wanted.to_numpy(), kind='mergesort')].reset_index(drop=True)
+    wanted = (wanted.sort_values(kind='mergesort').to_numpy() - np.datetime64(0, 's')) / np.timedelta64(1, 's')
+    
+    # greedy grouping has to be done in order, it is a single pass over the sorted times
+    frame = np.zeros(len(wanted), dtype=np.int64)
+    first = np.zeros(len(wanted))
+    current = -1
+    start = -np.inf
+    for i, t in enumerate(wanted):
+        if t - start > cadence:
+            current += 1
+            start = t
+        frame[i] = current
+        first[i] = start
+    plan['Frame'] = frame
+    plan['Frame_time'] = pd.to_datetime(first, unit='s')
+    
+    return plan
+
+def manifest_key(t, offset=0, box_size=100):
+    """
+    The key for a cutout in the manifest, just the peak time for the default cutout (so old manifests still work)
+    
+    Param:
+          t datetime, the peak time of the flare
+          offset number, seconds before the peak time
+          box_size number, the length of the sides of the box in arcsec
+    
+    Return:
+           key string
+    """
+    
+    if offset == 0 and box_size == 100:
+        return str(t)
+    return '{} -{}s {}arcsec'.format(t, offset, box_size)
+
+def cutout_suffix(offset=0, box_size=100):
+    """
+    The end added to the image name of a cutout that isn't the default one (so the cutouts of a flare don't overwrite each other)
+    """
+    
+    if offset == 0 and box_size == 100:
+        return ''
+    return '_m{}s_{}arcsec'.format(offset, box_size)
+
+def run_pipeline(data, out_dir='data', workers=4, manifest='downloaded.txt', fetcher=None, limit=None, calibration='full', offsets=(0,), box_sizes=(100,), store=None):
+    """
+    Downloads, calibrates, crops and saves images for many flares at once.
+    The cutouts are first grouped by the AIA frame they come from (see plan_batches) so each frame is only searched for, downloaded and calibrated once.
+    Each frame goes through the stages search -> fetch -> calibrate -> cutout -> save, a pool of workers each take a frame
+    so while one worker is waiting on a download others are calibrating or cropping.
+    The key of each finished cutout is added to the manifest so an interrupted run carries on where it stopped.
+    
+    Param:
+          data pandas dataframe, flares with Peak_time, X_pos, Y_pos and Class columns (see hessi_goes_flare_data.csv)
+          out_dir string, the directory with a sub directory for each class
+          workers integer, the number of frames worked on at the same time
+          manifest string, the file keeping the keys of finished cutouts (None to not keep one)
+          fetcher function, takes a datetime and returns the path of a FITS file, replaces the search and fetch stages (see local_fetcher)
+          limit integer, the most frames to do in this run (None for all of them)
+          calibration string, 'full' to calibrate the full disk with aiaprep or 'cutout' to only calibrate around the flare (see calibrate_cutout)
+          offsets iterable of numbers, seconds before the peak time to get images for (0 is the peak)
+          box_sizes iterable of numbers, lengths of the sides of the boxes in arcsec
+          store string, an HDF5 file to keep the raw cutouts in (see cutout_store) instead of saving png in out_dir (None for png)
+    
+    Return:
+           stats dictionary, for each stage the number of items, total time and items per second of stage time,
+           'total' has the wall time and the number of frames that failed and 'batching' the downloads and calibrations saved by sharing frames
+    """
+    
+    plan = plan_batches(data, offsets, box_sizes)
+    done = load_manifest(manifest)
+    todo = plan[~plan['Key'].isin(done)]
+    print('{} cutouts already done, {} to do'.format(len(plan.index) - len(todo.index), len(todo.index)))
+    frames = [batch for frame, batch in todo.groupby('Frame', sort=True)]
+    if limit is not None:
+        frames = frames[:limit]
+    
+    stats = {}
+    lock = threading.Lock()
+    failed = []
+    
+    def timed(stage, function, *args):
+        with instrument.timer(stage) as record:
+            result = function(*args)
+            if isinstance(result, str) and os.path.isfile(result): # a fetched frame
+                record['bytes'] = os.path.getsize(result)
+        add_stage_time(stats, lock, stage, record['seconds'])
+        return result
+    
+    def process(batch):
+        t = batch['Frame_time'].iloc[0]
+        try:
+            if fetcher is None:
+                result = timed('search', search_image, t)
+                path = timed('fetch', download_image, result)
+            else:
+                path = timed('fetch', fetcher, t)
+            if calibration == 'cutout':
+                aia = timed('load', sunpy.map.Map, path)
+            else:
+                aia = timed('calibrate', calibrate_image, path)
+            for idx, row in batch.iterrows():
+                if calibration == 'cutout':
+                    aia_sub = timed('calibrate', calibrate_cutout, aia, row['X_pos'], row['Y_pos'], row['Box_size'])
+                else:
+                    aia_sub = timed('cutout', cutout_image, aia, row['X_pos'], row['Y_pos'], row['Box_size'])
+                if h5 is not None:
+                    timed('save', store_cutout, h5, lock, aia_sub.data, row)
+                else:
+                    timed('save', save_image, aia_sub.data, row['Class'], row['Peak_time'], out_dir, cutout_suffix(row['Offset'], row['Box_size']))
+                if manifest is not None:
+                    with lock:
+                        with open(manifest, 'a') as f:
+                            f.write(row['Key'] + '\n')
+        except Exception as error:
+            print('failed frame at {}: {}'.format(t, error))
+            with lock:
+                failed.append(t)
+    
+    h5 = cutout_store.open_store(store) if store is not None else None
+    for flare_class in todo['Class'].unique():
+        if h5 is None:
+            os.makedirs(os.path.join(out_dir, flare_class + '_class'), exist_ok=True)
+    
+    t0 = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(process, frames))
+    finally:
+        if h5 is not None:
+            h5.close()
+    
+    for counter in stats.values():
+        counter['per second'] = counter['count'] / counter['seconds'] if counter['seconds'] else 0.0
+    stats['total'] = {'count': len(frames) - len(failed), 'failed': len(failed), 'seconds': time.perf_counter() - t0}
+    stats['total']['per second'] = stats['total']['count'] / stats['total']['seconds'] if stats['total']['seconds'] else 0.0
+    cutouts = sum(len(batch.index) for batch in frames)
+    stats['batching'] = {'cutouts': cutouts, 'frames': len(frames), 'downloads saved': cutouts - len(frames),
+                         'calibrations saved': cutouts - len(frames) if calibration == 'full' else 0}
+    
+    return stats
+
+def get_time_series(t, x, y, leads, box_size=100, fetcher=None, calibration='cutout'):
+    """
+    Gets cutouts around a flare at several lead times before its peak and stacks them into one cube
+    
+    Param:
+          t datetime, the peak time of the flare
+          x integer, the longitude position of the flare in arcsec
+          y integer, the latitude position of the flare in arcsec
+          leads iterable of numbers, seconds before the peak time (0 is the peak)
+          box_size number, the length of the sides of the box in arcsec
+          fetcher function, takes a datetime and returns the path of a FITS file (see frame_cache.cached_fetcher)
+          calibration string, 'cutout' to only calibrate around the flare or 'full' to calibrate the full disk with aiaprep
+    
+    Return:
+           cube numpy array, float32 [rows, columns, number of leads] with the earliest image first
+    """
+    
+    leads = sorted(leads, reverse=True)
+    images = [get_cutout(t - dt.timedelta(seconds=lead), x, y, box_size, fetcher=fetcher, calibration=calibration)[0] for lead in leads]
+    return stack_cutouts(images)
+
+def stack_cutouts(images):
+    """
+    Stacks cutouts from different frames along the last axis, submap can make boxes a pixel different in size so they are cropped to the smallest
+    
+    Param:
+          images list of numpy arrays, the cutouts
+    
+    Return:
+           cube numpy array, float32 [rows, columns, number of images]
+    """
+    
+    rows = min(img.shape[0] for img in images)
+    cols = min(img.shape[1] for img in images)
+    return np.stack([img[:rows, :cols] for img in images], axis=-1).astype(np.float32)
+
+def series_key(t, leads, box_size=100):
+    """
+    The key for a time series in the manifest
+    """
+    
+    return '{} series {} {}arcsec'.format(t, '/'.join(str(lead) for lead in sorted(leads, reverse=True)), box_size)
+
+def run_time_series(data, leads, out_dir='series', box_size=100, workers=4, manifest='series_downloaded.txt', fetcher=None, limit=None,
+                    calibration='cutout', cache_dir=frame_cache.FRAME_CACHE_DIR, max_bytes=frame_cache.MAX_BYTES, snap=AIA_CADENCE):
+    """
+    Saves a cube of cutouts at several lead times before the peak of each flare (see get_time_series) as a .npy file in the directory for its class.
+    Frames go through an on-disk cache with a size cap (see frame_cache), the flares are done in order of peak time so flares close together
+    are worked on at the same time and the frames their windows share are only downloaded once.
+    Frames are searched for at the start of their snap slot so a lead time can be up to snap + 10 seconds before the image used.
+    
+    Param:
+          data pandas dataframe, flares with Peak_time, X_pos, Y_pos and Class columns (see hessi_goes_flare_data.csv)
+          leads iterable of numbers, seconds before the peak time (0 is the peak)
+          out_dir string, the directory with a sub directory for each class
+          box_size number, the length of the sides of the box in arcsec
+          workers integer, the number of flares worked on at the same time
+          manifest string, the file keeping the keys of finished flares (None to not keep one)
+          fetcher function, takes a datetime and returns the path of a FITS file, it is copied into the cache (None to search and download into the cache)
+          limit integer, the most flares to do in this run (None for all of them)
+          calibration string, 'cutout' to only calibrate around the flare or 'full' to calibrate the full disk with aiaprep
+          cache_dir string, the frame cache directory
+          max_bytes integer, the size cap of the frame cache
+          snap number, seconds, lead times in the same slot share a frame
+    
+    Return:
+           stats dictionary, 'total' has the wall time and the number of flares done and failed, 'frames' the number of frames wanted
+           and the cache hits, misses (downloads) and evictions
+    """
+    
+    leads = sorted(leads, reverse=True)
+    data = data.sort_values('Peak_time', kind='mergesort')
+    done = load_manifest(manifest)
+    keys = [series_key(t, leads, box_size) for t in data['Peak_time']]
+    todo = data[[key not in done for key in keys]]
+    print('{} flares already done, {} to do'.format(len(data.index) - len(todo.index), len(todo.index)))
+    if limit is not None:
+        todo = todo.iloc[:limit]
+    
+    if fetcher is None:
+        cached, cache_stats = frame_cache.cached_fetcher(search_and_download(cache_dir), cache_dir, max_bytes, snap=snap, move=True)
+    else:
+        cached, cache_stats = frame_cache.cached_fetcher(fetcher, cache_dir, max_bytes, snap=snap)
+    lock = threading.Lock()
+    failed = []
+    
+    def process(row):
+        key = series_key(row['Peak_time'], leads, box_size)
+        try:
+            cube = get_time_series(row['Peak_time'], row['X_pos'], row['Y_pos'], leads, box_size, cached, calibration)
+            np.save(os.path.join(out_dir, row['Class'] + '_class', image_name(row['Peak_time'], '_series.npy')), cube)
+            if manifest is not None:
+                with lock:
+                    with open(manifest, 'a') as f:
+                        f.write(key + '\n')
+        except Exception as error:
+            print('failed time series at {}: {}'.format(row['Peak_time'], error))
+            with lock:
+                failed.append(row['Peak_time'])
+    
+    for flare_class in todo['Class'].unique():
+        os.makedirs(os.path.join(out_dir, flare_class + '_class'), exist_ok=True)
+    with open(os.path.join(out_dir, 'series.json'), 'w') as f:
+        json.dump({'leads': leads, 'box_size': box_size, 'snap': snap, 'calibration': calibration}, f)
+    
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(process, [row for idx, row in todo.iterrows()]))
+    
+    stats = {'total': {'count': len(todo.index) - len(failed), 'failed': len(failed), 'seconds': time.perf_counter() - t0},
+             'frames': dict(cache_stats, wanted=len(todo.index) * len(leads))}
+    return stats
+
+def get_channels(t, x, y, wavelengths=AIA_WAVELENGTHS, box_size=100, fetchers=None, stats=None, lock=None, dtype=np.float32):
+    """
+    Gets cutouts around a flare in several AIA channels and stacks them into one tensor.
+    The frames of all the channels are fetched at the same time, then each channel is calibrated straight onto the same level 1.5 grid
+    (north up, 0.6 arcsec per pixel) with calibrate_cutout so the channels are co-registered by the one interpolation of each window.
+    
+    Param:
+          t datetime, the datetime of the flare
+          x integer, the longitude position of the flare in arcsec
+          y integer, the latitude position of the flare in arcsec
+          wavelengths iterable of integers, the AIA channels in angstrom (the order of the channels in the tensor)
+          box_size number, the length of the sides of the box in arcsec
+          fetchers dictionary, wavelength -> function that takes a datetime and returns the path of a FITS file (None searches and downloads each channel)
+          stats dictionary, stage name -> counters (see add_stage_time), 'fetch 94', 'calibrate 94' etc. are added for each channel (None to not record them)
+          lock threading lock, for stats when it is shared between threads
+          dtype numpy type, float32 or float16 for the tensor
+    
+    Return:
+           tensor numpy array, [rows, columns, number of channels]
+    """
+    
+    wavelengths = list(wavelengths)
+    fetchers = fetchers or {wavelength: search_and_download(wavelength=wavelength) for wavelength in wavelengths}
+    stats = {} if stats is None else stats
+    lock = lock or threading.Lock()
+    
+    def timed(stage, function, *args):
+        with instrument.timer(stage) as record:
+            result = function(*args)
+            if isinstance(result, str) and os.path.isfile(result): # a fetched frame
+                record['bytes'] = os.path.getsize(result)
+        add_stage_time(stats, lock, stage, record['seconds'])
+        return result
+    
+    with ThreadPoolExecutor(max_workers=len(wavelengths)) as executor:
+        paths = list(executor.map(lambda wavelength: timed('fetch {}'.format(wavelength), fetchers[wavelength], t), wavelengths))
+    images = [timed('calibrate {}'.format(wavelength), calibrate_cutout, path, x, y, box_size).data for wavelength, path in zip(wavelengths, paths)]
+    
+    return stack_cutouts(images).astype(dtype)
+
+def channels_key(t, wavelengths):
+    """
+    The key for a multi channel tensor in the manifest
+    """
+    
+    return '{} channels {}'.format(t, '/'.join(str(wavelength) for wavelength in wavelengths))
+
+def run_channels(data, wavelengths=AIA_WAVELENGTHS, out_dir='channels', box_size=100, workers=4, manifest='channels_downloaded.txt', fetchers=None, limit=None,
+                 dtype=np.float32, cache_dir=frame_cache.FRAME_CACHE_DIR, max_bytes=frame_cache.MAX_BYTES):
+    """
+    Saves a multi channel tensor (see get_channels) for each flare as a .npy file in the directory for its class,
+    the values are kept as they are (not scaled to 8 bits like the png) so cnn.data_prep can normalise each channel.
+    
+    Param:
+          data pandas dataframe, flares with Peak_time, X_pos, Y_pos and Class columns (see hessi_goes_flare_data.csv)
+          wavelengths iterable of integers, the AIA channels in angstrom
+          out_dir string, the directory with a sub directory for each class
+          box_size number, the length of the sides of the box in arcsec
+          workers integer, the number of flares worked on at the same time (each fetches all its channels at the same time)
+          manifest string, the file keeping the keys of finished flares (None to not keep one)
+          fetchers dictionary, wavelength -> function that takes a datetime and returns the path of a FITS file (None to search and download into the frame cache)
+          limit integer, the most flares to do in this run (None for all of them)
+          dtype numpy type, float32 or float16 for the tensors
+          cache_dir string, the frame cache directory (when fetchers is None)
+          max_bytes integer, the size cap of the frame cache
+    
+    Return:
+           stats dictionary, for each channel the fetch and calibrate counters (count, seconds and per second) and 'total' with the wall time and failures
+    """
+    
+    wavelengths = list(wavelengths)
+    done = load_manifest(manifest)
+    keys = [channels_key(t, wavelengths) for t in data['Peak_time']]
+    todo = data[[key not in done for key in keys]]
+    print('{} flares already done, {} to do'.format(len(data.index) - len(todo.index), len(todo.index)))
+    if limit is not None:
+        todo = todo.iloc[:limit]
+    if fetchers is None:
+        fetchers = {wavelength: frame_cache.cached_fetcher(search_and_download(cache_dir, wavelength), cache_dir, max_bytes, wavelength=wavelength, move=True)[0]
+                    for wavelength in wavelengths}
+    
+    stats = {}
+    lock = threading.Lock()
+    failed = []
+    
+    def process(row):
+        try:
+            tensor = get_channels(row['Peak_time'], row['X_pos'], row['Y_pos'], wavelengths, box_size, fetchers, stats, lock, dtype)
+            np.save(os.path.join(out_dir, row['Class'] + '_class', image_name(row['Peak_time'], '_channels.npy')), tensor)
+            if manifest is not None:
+                with lock:
+                    with open(manifest, 'a') as f:
+                        f.write(channels_key(row['Peak_time'], wavelengths) + '\n')
+        except Exception as error:
+            print('failed channels at {}: {}'.format(row['Peak_time'], error))
+            with lock:
+                failed.append(row['Peak_time'])
+    
+    for flare_class in todo['Class'].unique():
+        os.makedirs(os.path.join(out_dir, flare_class + '_class'), exist_ok=True)
+    
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(process, [row for idx, row in todo.iterrows()]))
+    
+    for counter in stats.values():
+        counter['per second'] = counter['count'] / counter['seconds'] if counter['seconds'] else 0.0
+    stats['total'] = {'count': len(todo.index) - len(failed), 'failed': len(failed), 'seconds': time.perf_counter() - t0}
+    return stats
 
 if __name__ == '__main__':
     
     # get the flare data
-    data = pd.read_csv('hessi_goes_flare_data.csv')
-    data['Peak_time'] = pd.to_datetime(data['Peak_time'], format='%Y-%m-%d %H:%M:%S')
-    data = data[data['Peak_time'] >= dt.datetime.strptime('2010-06-06 02:52:58', '%Y-%m-%d %H:%M:%S')] # SDO started after HESSI and GOES!!!!
+    data = catalog_schema.read_flare_data('hessi_goes_flare_data.csv')
+    index = flare_index.build_index(data) # flare_index.near and in_region pick out flares by position or active region the same way
+    data = flare_index.select(index, flare_index.time_range(index, SDO_START))
     print(data.head())
     print('number of valid flares = {}'.format(len(data.index)))
     
-    # save the images to their respective directories
-    for idx, row in data.head().iterrows():
-        print('getting image {}/{}'.format(idx, len(data.index)))
-        img = get_image(row['Peak_time'], row['X_pos'], row['Y_pos'])
-        img.plot()
-        img_name = str(row['Peak_time']).replace(' ', '_').replace(':', '_').replace('-', '_') + '.png'
-        if row['Class'] == 'B':
-            img_name = os.path.join('B_class', img_name)
-        elif row['Class'] == 'C':
-            img_name = os.path.join('C_class', img_name)
-        plt.imsave(fname = os.path.join('data', img_name), arr=img.data, cmap = plt.cm.gray)
-        print('image saved\n')
-    print('Done')
\ No newline at end of file
+    # save the images to their respective directories, run again to carry on if it gets interrupted
+    stats = run_pipeline(data, out_dir='data', workers=4, manifest='downloaded.txt') # store='cutouts.h5' keeps the raw cutouts instead of png
+    for stage, counter in stats.items():
+        print(stage, counter)
+    
+    # cubes of images before each flare, e.g. [3600, 1800, 600, 0] for an hour, half an hour and ten minutes before and the peak (None to skip)
+    series_leads = None
+    if series_leads is not None:
+        stats = run_time_series(data, series_leads, out_dir='series', workers=4, manifest='series_downloaded.txt')
+        for stage, counter in stats.items():
+            print(stage, counter)
+    
+    # tensors of several AIA channels for each flare, e.g. AIA_WAVELENGTHS (None to skip)
+    channel_wavelengths = None
+    if channel_wavelengths is not None:
+        stats = run_channels(data, channel_wavelengths, out_dir='channels', workers=4, manifest='channels_downloaded.txt')
+        for stage, counter in stats.items():
+            print(stage, counter)
+    print('Done')
@@ -0,0 +1,311 @@
+"""
+Synthetic stand ins for the data this project downloads, so the pipeline can be benchmarked (and run) offline.
+
+    HESSI flare list text in the layout of hessi_flare_list.txt (parsed by hessi_df.parse_hessi_flare_list)
+    GOES XRS report text in the layout of the goes-xrs-report_YYYY.txt files (parsed by goes_df.parse_goes_text)
+    matched catalogs, GOES flares made around some of the HESSI peaks so intersect_hessi_goes.join_flares finds flares, written as a mirror for FLARE_CATALOG_MIRROR
+    cutouts, a few bright gaussian loops on a noisy background, as arrays, as png in <Class>_class directories (like download_images.save_image) for cnn.data_prep,
+    or as small level 1 like AIA FITS frames named like download_images.image_name for download_images.local_fetcher
+
+Everything is made from a seed so the same arguments always give the same data.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import hessi_df as hdf
+import goes_df as gdf
+
+FIXTURE_DIR = 'fixture_data'
+HESSI_FLAGS = ['A0', 'A1', 'DF', 'DR', 'ED', 'EE', 'ES', 'GD', 'GE', 'GS', 'NS', 'P1', 'PE', 'PS', 'Q1', 'SD', 'SE', 'SS', 'a0', 'a1']
+GOES_CLASSES = ['A', 'B', 'C', 'M', 'X']
+GOES_CLASS_P = [0.1, 0.4, 0.4, 0.08, 0.02]
+
+def synthetic_hessi_flares(n, seed=0):
+    """
+    Makes the fields of n fake HESSI flares (spread over 2002 - 2017 like the real list)
+
+    Param:
+          n integer, the number of flares
+          seed integer, seed for the random number generator
+
+    Return:
+           flares pandas dataframe, Flare, Start_time, Peak_time, End_time, Dur, Peak, Total, Energy, X, Y, Radial, AR and Flags
+    """
+
+    rng = np.random.RandomState(seed)
+    start = pd.Timestamp('2002-02-12') + pd.to_timedelta(np.sort(rng.randint(0, 15*365*86400, n)), unit='s')
+    duration = rng.randint(20, 3600, n)
+    peak = start + pd.to_timedelta(rng.randint(0, 20, n) * duration // 20, unit='s')
+    end = start + pd.to_timedelta(duration, unit='s')
+    x = rng.randint(-1000, 1000, n)
+    y = rng.randint(-1000, 1000, n)
+
+    flags, counts, totals, regions = [], [], [], []
+    for i in range(n):
+        flags.append(' '.join(sorted(rng.choice(HESSI_FLAGS, rng.randint(1, 5), replace=False))))
+        counts.append(rng.randint(0, 5000))
+        totals.append(rng.randint(0, 10**7))
+        regions.append(rng.randint(0, 12000))
+
+    return pd.DataFrame({'Flare': 2021213 + np.arange(n), 'Start_time': start, 'Peak_time': peak, 'End_time': end, 'Dur': duration,
+                         'Peak': counts, 'Total': totals, 'Energy': '6-12', 'X': x, 'Y': y, 'Radial': np.hypot(x, y).astype(int),
+                         'AR': regions, 'Flags': flags})
+
+def hessi_text(flares):
+    """
+    Writes flares (as made by synthetic_hessi_flares) in the layout of hessi_flare_list.txt, 6 header lines, a line per flare and the 39 lines of flag codes
+    """
+
+    lines = [' ', ' RHESSI flare list (synthetic)', ' ', 'Flare     Start       Peak     End        Dur  Peak Total   Energy   X      Y      Radial AR   Flags', '                                          s    c/s  Counts  keV      arcsec arcsec arcsec', ' ']
+    for row in flares.itertuples(index=False):
+        lines.append('{:8d} {} {} {} {} {:5d} {:6d} {:8d} {:>8} {:6d} {:6d} {:6d} {:5d} {}'.format(
+            row.Flare, row.Start_time.strftime('%d-%b-%Y'), row.Start_time.strftime('%H:%M:%S'), row.Peak_time.strftime('%H:%M:%S'), row.End_time.strftime('%H:%M:%S'),
+            row.Dur, row.Peak, row.Total, row.Energy, row.X, row.Y, row.Radial, row.AR, row.Flags))
+    lines += [' Flag code {}'.format(i) for i in range(39)]
+    return '\n'.join(lines) + '\n'
+
+def synthetic_hessi_text(n, seed=0):
+    """
+    Makes a fake HESSI flare list with n flares in the same layout as hessi_flare_list.txt
+
+    Param:
+          n integer, the number of flares
+          seed integer, seed for the random number generator
+
+    Return:
+           text string, the contents of the flare list
+    """
+
+    return hessi_text(synthetic_hessi_flares(n, seed))
+
+def goes_text(flares, rng):
+    """
+    Writes GOES flares in the layout of a goes-xrs-report_YYYY.txt file, the position, sub class and region are made up with rng
+
+    Param:
+          flares pandas dataframe, Start_time, End_time, Peak_time and Class
+          rng numpy RandomState
+
+    Return:
+           text string, the contents of the report
+    """
+
+    lines = []
+    for row in flares.itertuples(index=False):
+        lines.append('31777{}  {} {} {} N{:02d}W{:02d} {} {:5d}   GOES15  {:5d}'.format(
+            row.Start_time.strftime('%y%m%d'), row.Start_time.strftime('%H%M'), row.End_time.strftime('%H%M'), row.Peak_time.strftime('%H%M'),
+            rng.randint(0, 40), rng.randint(0, 90), row.Class, rng.randint(10, 99), rng.randint(10000, 12000)))
+    return '\n'.join(lines) + '\n'
+
+def synthetic_goes_text(n, year=2010, seed=0):
+    """
+    Makes a fake GOES XRS report with n flares in the same layout as the goes-xrs-report_YYYY.txt files
+
+    Param:
+          n integer, the number of flares
+          year integer, the year of the report
+          seed integer, seed for the random number generator
+
+    Return:
+           text string, the contents of the report
+    """
+
+    rng = np.random.RandomState(seed)
+    start = pd.Timestamp(year=year, month=1, day=1) + pd.to_timedelta(np.sort(rng.randint(0, 365*1440, n)), unit='m')
+    duration = rng.randint(4, 120, n)
+    peak = start + pd.to_timedelta(rng.randint(1, 4, n) * duration // 4, unit='m')
+    end = start + pd.to_timedelta(duration, unit='m')
+    classes = rng.choice(GOES_CLASSES, n, p=GOES_CLASS_P)
+
+    return goes_text(pd.DataFrame({'Start_time': start, 'End_time': end, 'Peak_time': peak, 'Class': classes}), rng)
+
+def synthetic_catalogs(n, goes_fraction=0.25, seed=0):
+    """
+    Makes a HESSI flare list and GOES reports that go together, a GOES flare is made around the peak of a random goes_fraction of the HESSI flares
+    (the real catalogs have ~4 HESSI flares for each GOES flare), so joining them matches flares like the real catalogs do
+
+    Param:
+          n integer, the number of HESSI flares
+          goes_fraction float, the number of GOES flares as a fraction of n
+          seed integer, seed for the random number generator
+
+    Return:
+           hessi string, the text of the HESSI flare list
+           goes dictionary, year -> the text of the GOES report for that year (only years with flares)
+    """
+
+    hessi = synthetic_hessi_flares(n, seed)
+    rng = np.random.RandomState(seed + 1)
+    chosen = np.sort(rng.choice(n, int(n * goes_fraction), replace=False))
+    peak = hessi['Peak_time'].iloc[chosen].dt.floor('min').reset_index(drop=True) # GOES times are to the minute
+    goes = pd.DataFrame({'Start_time': peak - pd.to_timedelta(rng.randint(1, 10, len(chosen)), unit='m'),
+                         'End_time': peak + pd.to_timedelta(rng.randint(2, 30, len(chosen)), unit='m'),
+                         'Peak_time': peak,
+                         'Class': rng.choice(GOES_CLASSES, len(chosen), p=GOES_CLASS_P)})
+
+    reports = {year: goes_text(flares, rng) for year, flares in goes.groupby(goes['Start_time'].dt.year)}
+    return hessi_text(hessi), reports
+
+def write_catalog_mirror(directory, n, goes_fraction=0.25, seed=0):
+    """
+    Writes synthetic catalogs (see synthetic_catalogs) under the file names of the real sources, set catalog_cache.MIRROR_DIR
+    (or FLARE_CATALOG_MIRROR) to the directory and hessi_df.hessi_flare_dataframe and goes_df.goes_dataframe read them instead of the web
+
+    Param:
+          directory string, the mirror directory
+          n integer, the number of HESSI flares
+          goes_fraction float, the number of GOES flares as a fraction of n
+          seed integer, seed for the random number generator
+
+    Return:
+           years list of integers, the years there are GOES reports for (pass to goes_dataframe)
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    hessi, reports = synthetic_catalogs(n, goes_fraction, seed)
+    with open(os.path.join(directory, hdf.HESSI_URL.split('/')[-1]), 'w') as f:
+        f.write(hessi)
+    for year, text in reports.items():
+        with open(os.path.join(directory, gdf.goes_url(year).split('/')[-1]), 'w') as f:
+            f.write(text)
+    return sorted(reports)
+
+def synthetic_cutout(rng, size=167, brightness=1.0):
+    """
+    Makes one fake AIA cutout, a few bright gaussian loops on a noisy background in data numbers (float64 like calibrated AIA data)
+
+    Param:
+          rng numpy RandomState
+          size integer, the number of rows and columns
+          brightness float, scales the loops (C class flares are made brighter than B class so a model has something to learn)
+
+    Return:
+           img numpy array, [size, size]
+    """
+
+    y, x = np.mgrid[0:size, 0:size]
+    img = rng.poisson(20, (size, size)).astype(np.float64)
+    for j in range(rng.randint(1, 4)):
+        cx, cy, width = rng.uniform(0.3, 0.7) * size, rng.uniform(0.3, 0.7) * size, rng.uniform(3, 15) * (size / 167)
+        img += brightness * rng.uniform(100, 5000) * np.exp(-((x - cx)**2 + (y - cy)**2) / (2 * width**2))
+    return img
+
+def synthetic_cutouts(n, size=167, seed=0):
+    """
+    Makes fake AIA cutouts (see synthetic_cutout)
+
+    Param:
+          n integer, the number of cutouts
+          size integer, the number of rows and columns of each cutout
+          seed integer, seed for the random number generator
+
+    Return:
+           cutouts list of numpy arrays
+    """
+
+    rng = np.random.RandomState(seed)
+    return [synthetic_cutout(rng, size) for i in range(n)]
+
+def write_png_cutouts(directory, n, size=64, classes=('B', 'C'), seed=0):
+    """
+    Writes fake cutouts as png in a sub directory for each class, the same 8 bit grey RGBA images plt.imsave(cmap=gray) makes in download_images.save_image.
+    A directory that was already written completely with the same arguments is reused (writing 100k cutouts takes a while).
+
+    Param:
+          directory string, the directory to write the class directories to
+          n integer, the number of cutouts
+          size integer, the number of rows and columns of each cutout
+          classes tuple of strings, the GOES classes, cutouts are split between them at random and each class is brighter than the one before
+          seed integer, seed for the random number generator
+
+    Return:
+           directory string
+    """
+
+    import cv2
+
+    done = os.path.join(directory, 'fixture.txt')
+    description = 'png {} {} {} {}'.format(n, size, ','.join(classes), seed)
+    if os.path.exists(done):
+        with open(done) as f:
+            if f.read() == description:
+                return directory
+
+    for flare_class in classes:
+        os.makedirs(os.path.join(directory, flare_class + '_class'), exist_ok=True)
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, len(classes), n)
+    for i, label in enumerate(labels):
+        img = synthetic_cutout(rng, size, brightness=2.0**label)
+        grey = np.minimum((img - img.min()) / (img.max() - img.min()) * 256, 255).astype(np.uint8) # how matplotlib maps 0-1 onto a 256 colour map
+        rgba = np.dstack([grey, grey, grey, np.full_like(grey, 255)])
+        cv2.imwrite(os.path.join(directory, classes[label] + '_class', '{:06d}.png'.format(i)), rgba)
+
+    with open(done, 'w') as f:
+        f.write(description)
+    return directory
+
+def write_fits_frames(directory, times, size=512, wavelength=94, seed=0):
+    """
+    Writes small fake level 1 AIA frames, a noisy disk with a few loops, with the header keywords sunpy and download_images.calibrate_cutout use.
+    The frames are size x size pixels covering the same field of view as a 4096 x 4096 AIA frame (so each pixel is 4096 / size AIA pixels),
+    slightly rotated and off centre like real level 1 data, and named like download_images.image_name so local_fetcher finds them.
+
+    Param:
+          directory string, the directory to write the frames to
+          times iterable of datetimes, the time of each frame
+          size integer, the number of rows and columns of each frame
+          wavelength integer, the AIA channel in angstrom
+          seed integer, seed for the random number generator
+
+    Return:
+           paths list of strings, the FITS files
+    """
+
+    from astropy.io import fits # only needed for the FITS fixtures
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    scale = 0.6 * 4096 / size
+    y, x = np.mgrid[0:size, 0:size]
+    centre = (size - 1) / 2.0
+    rsun_obs = 960.0
+    paths = []
+    for t in times:
+        t = pd.Timestamp(t)
+        disk = np.hypot(x - centre, y - centre) * scale < rsun_obs
+        data = rng.poisson(5, (size, size)) + disk * (40 + synthetic_cutout(rng, size, brightness=0.2))
+        crota2 = rng.uniform(-0.2, 0.2)
+        header = fits.Header()
+        header['TELESCOP'] = 'SDO/AIA'
+        header['INSTRUME'] = 'AIA_4'
+        header['DETECTOR'] = 'AIA'
+        header['WAVELNTH'] = wavelength
+        header['WAVEUNIT'] = 'angstrom'
+        header['DATE-OBS'] = t.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        header['T_OBS'] = header['DATE-OBS'] + 'Z'
+        header['EXPTIME'] = 2.9
+        header['LVL_NUM'] = 1.0
+        header['CTYPE1'] = 'HPLN-TAN'
+        header['CTYPE2'] = 'HPLT-TAN'
+        header['CUNIT1'] = 'arcsec'
+        header['CUNIT2'] = 'arcsec'
+        header['CDELT1'] = scale * 1.002
+        header['CDELT2'] = scale * 0.998
+        header['CRPIX1'] = centre + 1 + rng.uniform(-2, 2) # FITS pixels start at 1
+        header['CRPIX2'] = centre + 1 + rng.uniform(-2, 2)
+        header['CRVAL1'] = 0.0
+        header['CRVAL2'] = 0.0
+        header['CROTA2'] = crota2
+        header['RSUN_OBS'] = rsun_obs
+        header['RSUN_REF'] = 696000000.0
+        header['DSUN_OBS'] = 1.496e11 * 0.985
+        header['HGLN_OBS'] = 0.0
+        header['HGLT_OBS'] = rng.uniform(-7, 7)
+        path = os.path.join(directory, str(t).replace(' ', '_').replace(':', '_').replace('-', '_') + '.fits') # download_images.image_name
+        fits.writeto(path, data.astype(np.float32), header, overwrite=True)
+        paths.append(path)
+    return paths
@@ -0,0 +1,263 @@
+"""
+An index over a flare catalog (the HESSI dataframe from hessi_df or the matched flares in hessi_goes_flare_data.csv) for quick time, position and active region queries.
+
+    time     the peak times sorted once, a time range is two binary searches and a slice
+    position the flares bucketed into a grid of square cells on X/Y (cell arcsec wide) and sorted by cell, a circle only looks at the cells it covers
+    region   the flares of each active region (HESSI only, the matched flares don't keep the AR) in time order
+
+Queries return the positions of the matching rows in time order (pass them to select for the rows), so nothing scans the whole frame once the index is built.
+
+    index = flare_index.build_index(catalog_schema.read_flare_data())
+    flare_index.select(index, flare_index.near(index, -300, 400, 50, '2012-01-01', '2013-01-01'))
+
+Run from the flare_classifier directory to time some queries against a scan of the csv:
+    python flare_index.py [hessi_goes_flare_data.csv]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+CELL = 100 # arcsec, the disk is ~2000 arcsec across so ~400 cells
+COLUMNS = {'hessi': ('Peak_time', 'X Pos (asec)', 'Y Pos (asec)', 'AR'),
+           'matched': ('Peak_time', 'X_pos', 'Y_pos', None)}
+
+def to_ns(t):
+    """
+    A time (datetime, pandas timestamp, numpy datetime64 or string) as integer nanoseconds, None stays None
+    """
+
+    return None if t is None else pd.Timestamp(t).value
+
+def build_index(df, cell=CELL):
+    """
+    Builds the index for a catalog, the columns are found from the names used by hessi_df and intersect_hessi_goes
+
+    Param:
+          df pandas dataframe, the HESSI flares (Peak_time, X Pos (asec), Y Pos (asec) and AR) or the matched flares (Peak_time, X_pos and Y_pos)
+          cell number, the width of the grid cells in arcsec (about the radius of a typical query is a good size)
+
+    Return:
+           index dictionary, the sorted times, the grid and the regions along with the dataframe
+    """
+
+    kind = 'hessi' if 'X Pos (asec)' in df.columns else 'matched'
+    time_column, x_column, y_column, region_column = COLUMNS[kind]
+
+    times = df[time_column].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    order = np.argsort(times, kind='mergesort')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) # where each row is in time order
+    x = df[x_column].to_numpy(dtype=np.float64)
+    y = df[y_column].to_numpy(dtype=np.float64)
+
+    # rows sorted by cell and then time, so each cell is a run of rows that are already in time order
+    cx = np.floor(x / cell).astype(np.int64)
+    cy = np.floor(y / cell).astype(np.int64)
+    keys = cell_key(cx, cy)
+    by_cell = np.lexsort((rank, keys))
+
+    index = {'frame': df, 'kind': kind, 'cell': cell,
+             'times': times[order], 'order': order, 'rank': rank, 'x': x, 'y': y,
+             'cell_keys': keys[by_cell], 'by_cell': by_cell, 'regions': None}
+    if region_column is not None:
+        regions = df[region_column].to_numpy()
+        index['regions'] = group_regions(regions, rank)
+    return index
+
+def cell_key(cx, cy):
+    """
+    One integer for a grid cell so the cells can be sorted and searched (cells cover +-2^31 cells on each axis)
+    """
+
+    return (np.asarray(cx, dtype=np.int64) << 32) + (np.asarray(cy, dtype=np.int64) + 2**31)
+
+def group_regions(regions, rank):
+    """
+    The rows of each active region in time order
+
+    Param:
+          regions numpy array, the active region of each row
+          rank numpy array, where each row is in time order
+
+    Return:
+           dictionary, region -> numpy array of row positions
+    """
+
+    by_region = np.lexsort((rank, regions))
+    sorted_regions = regions[by_region]
+    starts = np.flatnonzero(np.r_[True, sorted_regions[1:] != sorted_regions[:-1]])
+    ends = np.r_[starts[1:], len(by_region)]
+    return {sorted_regions[start].item(): by_region[start:end] for start, end in zip(starts, ends)}
+
+def time_slice(index, t0=None, t1=None):
+    """
+    The slice of the time ordered rows that peak in [t0, t1)
+    """
+
+    start = 0 if t0 is None else np.searchsorted(index['times'], to_ns(t0), side='left')
+    stop = len(index['times']) if t1 is None else np.searchsorted(index['times'], to_ns(t1), side='left')
+    return slice(start, max(start, stop))
+
+def time_range(index, t0=None, t1=None):
+    """
+    The flares that peak from t0 up to (not including) t1
+
+    Param:
+          index dictionary, from build_index
+          t0 datetime or string, the start (None for the first flare)
+          t1 datetime or string, the end (None for after the last flare)
+
+    Return:
+           positions numpy array, the rows in time order
+    """
+
+    return index['order'][time_slice(index, t0, t1)]
+
+def near(index, x, y, radius, t0=None, t1=None):
+    """
+    The flares within radius arcsec of (x, y), and peaking in [t0, t1) if they are given.
+    Only the grid cells the circle covers are looked at, or only the time range if it holds fewer flares than those cells.
+
+    Param:
+          index dictionary, from build_index
+          x, y numbers, the centre in arcsec
+          radius number, in arcsec
+          t0 datetime or string, the start (None for no start)
+          t1 datetime or string, the end (None for no end)
+
+    Return:
+           positions numpy array, the rows in time order
+    """
+
+    cell = index['cell']
+    keys = index['cell_keys']
+    ranges = []
+    for cx in range(int(np.floor((x - radius) / cell)), int(np.floor((x + radius) / cell)) + 1):
+        first = np.searchsorted(keys, cell_key(cx, np.floor((y - radius) / cell)), side='left')
+        last = np.searchsorted(keys, cell_key(cx, np.floor((y + radius) / cell)), side='right')
+        if last > first:
+            ranges.append((first, last))
+    spatial = sum(last - first for first, last in ranges)
+
+    window = time_slice(index, t0, t1)
+    if t0 is not None or t1 is not None:
+        if window.stop - window.start <= spatial: # fewer flares in the time range than in the cells
+            rows = index['order'][window]
+            return rows[np.hypot(index['x'][rows] - x, index['y'][rows] - y) <= radius]
+
+    if not ranges:
+        return np.empty(0, dtype=np.int64)
+    rows = np.concatenate([index['by_cell'][first:last] for first, last in ranges])
+    keep = np.hypot(index['x'][rows] - x, index['y'][rows] - y) <= radius
+    rank = index['rank'][rows]
+    keep &= (rank >= window.start) & (rank < window.stop)
+    rows = rows[keep]
+    return rows[np.argsort(index['rank'][rows], kind='mergesort')] # each cell is in time order but the cells have to be merged
+
+def in_region(index, region, t0=None, t1=None):
+    """
+    The flares in an active region, and peaking in [t0, t1) if they are given
+
+    Param:
+          index dictionary, from build_index (of the HESSI flares, the matched flares don't have the AR)
+          region integer, the active region number
+          t0 datetime or string, the start (None for no start)
+          t1 datetime or string, the end (None for no end)
+
+    Return:
+           positions numpy array, the rows in time order
+    """
+
+    if index['regions'] is None:
+        raise ValueError('the index has no active regions, build it from the HESSI flares')
+    rows = index['regions'].get(region, np.empty(0, dtype=np.int64))
+    window = time_slice(index, t0, t1)
+    rank = index['rank'][rows]
+    return rows[np.searchsorted(rank, window.start):np.searchsorted(rank, window.stop)]
+
+def region_counts(index):
+    """
+    The number of flares in each active region, most active first
+
+    Return:
+           pandas series, region -> number of flares
+    """
+
+    if index['regions'] is None:
+        raise ValueError('the index has no active regions, build it from the HESSI flares')
+    return pd.Series({region: len(rows) for region, rows in index['regions'].items()}).sort_values(ascending=False, kind='mergesort')
+
+def select(index, positions):
+    """
+    The rows of the indexed dataframe at positions (from a query)
+
+    Return:
+           pandas dataframe
+    """
+
+    return index['frame'].iloc[positions]
+
+def time_queries(df, queries=1000, seed=0):
+    """
+    Times random time range and circle queries on an index against a boolean scan of the dataframe and checks they find the same flares
+
+    Param:
+          df pandas dataframe, a catalog (see build_index)
+          queries integer, the number of random queries of each kind
+          seed integer, seed for the random number generator
+
+    Return:
+           dictionary, the time to build the index and the mean time of each kind of query in microseconds
+    """
+
+    t0 = time.perf_counter()
+    index = build_index(df)
+    results = {'flares': len(df.index), 'build (ms)': (time.perf_counter() - t0) * 1e3}
+
+    rng = np.random.RandomState(seed)
+    time_column, x_column, y_column, region_column = COLUMNS[index['kind']]
+    peaks = df[time_column].to_numpy()
+    starts = pd.to_datetime(rng.choice(peaks, queries))
+    ends = starts + pd.to_timedelta(rng.randint(1, 30, queries), unit='D')
+    centres = rng.uniform(-900, 900, (queries, 2))
+
+    t0 = time.perf_counter()
+    found = [time_range(index, start, end) for start, end in zip(starts, ends)]
+    results['time range (us)'] = (time.perf_counter() - t0) / queries * 1e6
+    t0 = time.perf_counter()
+    scanned = [np.flatnonzero((peaks >= start.to_datetime64()) & (peaks < end.to_datetime64())) for start, end in zip(starts, ends)]
+    results['time range scan (us)'] = (time.perf_counter() - t0) / queries * 1e6
+    assert all(np.array_equal(np.sort(a), b) for a, b in zip(found, scanned))
+
+    t0 = time.perf_counter()
+    found = [near(index, cx, cy, 50, start, end + pd.Timedelta(days=365)) for (cx, cy), start, end in zip(centres, starts, ends)]
+    results['circle + time (us)'] = (time.perf_counter() - t0) / queries * 1e6
+    x = df[x_column].to_numpy(dtype=np.float64)
+    y = df[y_column].to_numpy(dtype=np.float64)
+    t0 = time.perf_counter()
+    scanned = [np.flatnonzero((np.hypot(x - cx, y - cy) <= 50) & (peaks >= start.to_datetime64()) & (peaks < (end + pd.Timedelta(days=365)).to_datetime64()))
+               for (cx, cy), start, end in zip(centres, starts, ends)]
+    results['circle + time scan (us)'] = (time.perf_counter() - t0) / queries * 1e6
+    assert all(np.array_equal(np.sort(a), b) for a, b in zip(found, scanned))
+
+    if index['regions'] is not None:
+        regions = rng.choice(list(index['regions']), queries)
+        t0 = time.perf_counter()
+        found = [in_region(index, region) for region in regions]
+        results['region (us)'] = (time.perf_counter() - t0) / queries * 1e6
+        codes = df[region_column].to_numpy()
+        t0 = time.perf_counter()
+        scanned = [np.flatnonzero(codes == region) for region in regions]
+        results['region scan (us)'] = (time.perf_counter() - t0) / queries * 1e6
+        assert all(np.array_equal(np.sort(a), b) for a, b in zip(found, scanned))
+
+    return results
+
+if __name__ == '__main__':
+
+    import catalog_schema
+
+    print(time_queries(catalog_schema.read_flare_data(sys.argv[1] if len(sys.argv) > 1 else catalog_schema.FLARE_DATA_FILE)))
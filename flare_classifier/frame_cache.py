@@ -0,0 +1,150 @@
+"""
+An on-disk cache of downloaded AIA frames (level 1 FITS files) that is kept under a size cap by removing the least recently used frames.
+
+Frames are keyed by the wavelength and the time they are wanted at rounded down to a grid (snap seconds, one AIA cadence by default),
+so cutouts of nearby flares or of the same flare at different lead times that fall in the same slot share one download.
+The index (key -> file, size, last used) is a json file in the cache directory so the cache carries on between runs.
+The cap should hold comfortably more frames than there are workers using the cache, a frame that is evicted while it is still being read would have to be downloaded again.
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+FRAME_CACHE_DIR = 'frame_cache'
+MAX_BYTES = 20 * 2**30 # a level 1 AIA frame is ~10 MB compressed so this is ~2000 frames
+
+def frame_key(t, wavelength=94, snap=12):
+    """
+    The key of the frame for a time, the time is rounded down to a multiple of snap seconds
+
+    Param:
+          t datetime, the time an image is wanted at
+          wavelength integer, the AIA channel in angstrom
+          snap number, the width of the time slots in seconds
+
+    Return:
+           key string
+           frame_time pandas timestamp, the start of the slot (the time to search for the frame at)
+    """
+
+    seconds = pd.Timestamp(t).value / 1e9
+    frame_time = pd.Timestamp(np.floor(seconds / snap) * snap, unit='s')
+    return '{}_{}'.format(frame_time.strftime('%Y_%m_%d_%H_%M_%S'), wavelength), frame_time
+
+def load_index(cache_dir=FRAME_CACHE_DIR):
+    """
+    The index of the cache, key -> {'file', 'size', 'used'} in order of last use (oldest first), only entries whose file is still there are kept
+    """
+
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        index = json.load(f)
+    keys = sorted(index, key=lambda key: index[key]['used'])
+    return {key: index[key] for key in keys if os.path.exists(os.path.join(cache_dir, index[key]['file']))}
+
+def save_index(index, cache_dir=FRAME_CACHE_DIR):
+    """
+    Writes the index of the cache (replaces the old file in one go so a crash can't leave half a file)
+    """
+
+    index_path = os.path.join(cache_dir, 'index.json')
+    with open(index_path + '.tmp', 'w') as f:
+        f.write(json.dumps(index)) # dumps uses the C encoder, dump writes piece by piece and is much slower for a big index
+    os.replace(index_path + '.tmp', index_path)
+
+def evict(index, max_bytes, cache_dir=FRAME_CACHE_DIR, keep=()):
+    """
+    Removes the least recently used frames until the cache is under its size cap
+
+    Param:
+          index dictionary, the index of the cache in order of last use (changed in place)
+          max_bytes integer, the size cap
+          cache_dir string, the cache directory
+          keep iterable of strings, keys that mustn't be removed (e.g. the frame just added)
+
+    Return:
+           removed integer, the number of frames removed
+    """
+
+    total = sum(entry['size'] for entry in index.values())
+    removed = 0
+    for key in list(index):
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        entry = index.pop(key)
+        path = os.path.join(cache_dir, entry['file'])
+        if os.path.exists(path):
+            os.remove(path)
+        total -= entry['size']
+        removed += 1
+    return removed
+
+def cached_fetcher(download, cache_dir=FRAME_CACHE_DIR, max_bytes=MAX_BYTES, wavelength=94, snap=12, move=False):
+    """
+    Wraps a way of getting frames in the cache, the returned fetcher can be passed to download_images.get_cutout, run_pipeline or run_time_series.
+    It is safe to use from several threads, a frame that is already being downloaded by one thread is waited for by the others rather than downloaded twice.
+
+    Param:
+          download function, takes a datetime and returns the path of a FITS file (e.g. a local_fetcher or a search and download)
+          cache_dir string, the cache directory
+          max_bytes integer, the size cap of the cache
+          wavelength integer, the AIA channel in angstrom (part of the key)
+          snap number, the width of the time slots in seconds, times in the same slot share a frame
+          move boolean, True to move the downloaded file into the cache (when download makes a new file) or False to copy it (when it is someone else's file)
+
+    Return:
+           fetcher function, takes a datetime and returns the path of the cached FITS file
+           stats dictionary, counts of hits, misses and evictions (updated as the fetcher is used)
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    index = load_index(cache_dir)
+    lock = threading.Lock()
+    in_flight = {}
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def fetcher(t):
+        key, frame_time = frame_key(t, wavelength, snap)
+        while True:
+            with lock:
+                if key in index:
+                    index[key] = index.pop(key) # moves it to the end, the index is kept in order of use
+                    index[key]['used'] = time.time()
+                    stats['hits'] += 1 # the index is saved with the new use time when the next frame is added
+                    return os.path.join(cache_dir, index[key]['file'])
+                event = in_flight.get(key)
+                if event is None:
+                    in_flight[key] = threading.Event()
+                    break
+            event.wait() # another thread is downloading this frame, it is in the index once it is done (or failed)
+
+        try:
+            source = download(frame_time.to_pydatetime())
+            name = key + '.fits'
+            target = os.path.join(cache_dir, name)
+            if move:
+                shutil.move(source, target + '.tmp')
+            else:
+                shutil.copyfile(source, target + '.tmp')
+            os.replace(target + '.tmp', target)
+            with lock:
+                index[key] = {'file': name, 'size': os.path.getsize(target), 'used': time.time()}
+                stats['misses'] += 1
+                stats['evictions'] += evict(index, max_bytes, cache_dir, keep=[key])
+                save_index(index, cache_dir)
+            return target
+        finally:
+            with lock:
+                in_flight.pop(key).set()
+
+    return fetcher, stats
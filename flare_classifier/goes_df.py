@@ -1,69 +1,141 @@
+import io
 import pandas as pd
-import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 
-def goes_dataframe():
+import catalog_cache
+import catalog_schema
+import instrument
+
+GOES_URL = 'https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_'
+YEARS = range(2002, 2018)
+PARSER_VERSION = 2 # change this whenever parse_goes_text gives a different dataframe so old cached frames aren't used
+
+def goes_dataframe(years=YEARS, workers=4, processes=False, cache=True, max_age=None):
     """
     Uses the web to make a dataframe for the GOES flare data (2002 - 2017)
-    
+    Each year is a seperate report so they are downloaded and parsed concurrently.
+
+    Param:
+          years iterable of integers, the years to get the reports for
+          workers integer, the number of reports to load at the same time (1 loads them one after another)
+          processes boolean, True to use a pool of processes instead of threads (parsing the reports uses the GIL)
+          cache boolean, True to use the local catalog cache (reports are only downloaded and parsed again when they have changed)
+          max_age number, seconds before a cached report is checked for changes (None never checks)
+
     Return:
            df pandas dataframe
     """
-    
-    df = pd.DataFrame()
-    
-    for y in range(2, 18, 1):
-    
-        """
-        2006
-        https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_2006.txt
-        https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_2008.txt
-        """
-        
-        year = 2000 + y
-        
-        if year == 2015:
-            url = 'https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_' + str(year) + '_modifiedreplacedmissingrows.txt'
-        elif year == 2017:
-            url = 'https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_' + str(year) + '-ytd.txt'
-        else:
-            url = 'https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_' + str(year) + '.txt'
-        
-        #clean
-        goes = pd.read_fwf(url, sep='\t', lineterminator='\n', header=None)
-        header = ['Date', 'Start_time', 'End_time', 'Peak_time', 'Class']
-        d = pd.Series([str(code)[5:11] for code in goes.iloc[:, 0].values])
-        s = pd.Series(goes_times(goes, 1))
-        e = pd.Series(goes_times(goes, 2))
-        p = pd.Series(goes_times(goes, 3))
-        c = goes.iloc[:, 5]
-        #i = pd.Series(goes.iloc[:, 6].values / 10)
-        goes = pd.concat([d, s, e, p, c], axis=1)
-        goes.columns = header
-        goes.dropna(inplace=True)
-        goes = goes[goes['Peak_time'] != '////'] # revome this row in 2011, its strange and throws and error
-        goes['Date'] = pd.to_datetime(goes['Date'], format='%y%m%d')
-        for i in range(1, 4):
-            goes[header[i]] = pd.to_datetime(goes[header[i]], format='%H%M')
-            for idx, row in goes.iterrows():
-                date = row['Date']
-                goes.iat[idx-1, i] = row[header[i]].replace(day = date.day, month=date.month, year=date.year)
-        for idx, row in goes.iterrows():
-            if row['End_time'] < row['Start_time']:
-                row.loc['End_time'] = row['End_time'] + dt.timedelta(days=1)
-            if row['Peak_time'] < row['Start_time']:
-                row.loc['Peak_time'] = row['Peak_time'] + dt.timedelta(days=1)
-        goes.drop(columns='Date', inplace=True)
-        
-        df = pd.concat([df, goes])
-        
-    return df
+
+    years = list(years)
+    load = partial(goes_year_dataframe, cache=cache, max_age=max_age)
+    if workers <= 1:
+        frames = [load(year) for year in years]
+    else:
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with pool(max_workers=workers) as executor:
+            frames = list(executor.map(load, years)) # map keeps the years in order
+
+    return catalog_schema.compact(pd.concat(frames), catalog_schema.GOES_SCHEMA) # each year has its own classes so they are made categorical again
+
+def goes_url(year):
+    """
+    The web address of the GOES XRS report for a year
+
+    Param:
+          year integer, the year of the report
+
+    Return:
+           url string
+    """
+
+    """
+    2006
+    https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_2006.txt
+    https://www.ngdc.noaa.gov/stp/space-weather/solar-data/solar-features/solar-flares/x-rays/goes/xrs/goes-xrs-report_2008.txt
+    """
+
+    if year == 2015:
+        return GOES_URL + str(year) + '_modifiedreplacedmissingrows.txt'
+    elif year == 2017:
+        return GOES_URL + str(year) + '-ytd.txt'
+    else:
+        return GOES_URL + str(year) + '.txt'
+
+def goes_year_dataframe(year, cache=True, max_age=None):
+    """
+    Downloads and parses the GOES XRS report for one year
+
+    Param:
+          year integer, the year of the report
+          cache boolean, True to use the local catalog cache
+          max_age number, seconds before a cached report is checked for changes (None never checks)
+
+    Return:
+           goes pandas dataframe
+    """
+
+    if cache:
+        goes = catalog_cache.cached_frame(goes_url(year), parse_goes_text, PARSER_VERSION, max_age)
+        return catalog_schema.compact(goes, catalog_schema.GOES_SCHEMA)
+
+    text, validators = catalog_cache.read_source(catalog_cache.mirrored(goes_url(year)))
+    return parse_goes_text(text)
+
+@instrument.timed('goes parse')
+def parse_goes_text(text):
+    """
+    Parses the text of a GOES XRS report
+
+    Param:
+          text string, the contents of the report
+
+    Return:
+           goes pandas dataframe, columns are Start_time, End_time, Peak_time and Class
+    """
+
+    goes = pd.read_fwf(io.StringIO(text), sep='\t', lineterminator='\n', header=None)
+    return parse_goes_report(goes)
+
+def parse_goes_report(goes):
+    """
+    Turns a GOES XRS report (as read by pandas read_fwf) into a dataframe with the start, end and peak time and class of each flare.
+    The times in the report are HHMM numbers so the datetimes are made with array arithmetic on the whole column.
+
+    Param:
+          goes pandas dataframe, the report with no header
+
+    Return:
+           goes pandas dataframe, columns are Start_time, End_time, Peak_time and Class (categorical)
+    """
+
+    #clean
+    date = pd.to_datetime(goes.iloc[:, 0].astype(str).str[5:11], format='%y%m%d', errors='coerce')
+    df = pd.DataFrame({'Start_time': date + goes_times(goes, 1),
+                       'End_time': date + goes_times(goes, 2),
+                       'Peak_time': date + goes_times(goes, 3),
+                       'Class': goes.iloc[:, 5]})
+    #i = pd.Series(goes.iloc[:, 6].values / 10)
+    df.dropna(inplace=True) # also removes the rows with a time of '////' (there is one in 2011, its strange and throws and error)
+
+    # times are only given for the day the flare started so fix times that went over midnight
+    for column in ['End_time', 'Peak_time']:
+        df[column] = df[column].where(df[column] >= df['Start_time'], df[column] + pd.Timedelta(days=1))
+
+    return catalog_schema.compact(df, catalog_schema.GOES_SCHEMA)
 
 def goes_times(goes, idx):
-    e = []
-    for code in goes.iloc[:, idx].values:
-        time_string = str(code).split('.')[0]
-        if time_string != 'nan':
-            while len(time_string) < 4:
-                time_string = '0' + time_string
-        e.append(time_string)
-    return e
\ No newline at end of file
+    """
+    Converts a column of HHMM times in a GOES report to the time since midnight
+
+    Param:
+          goes pandas dataframe, the report
+          idx integer, the position of the column
+
+    Return:
+           pandas series of timedeltas, NaT where the time is missing or not a number
+    """
+
+    hhmm = pd.to_numeric(goes.iloc[:, idx], errors='coerce')
+    minutes = (hhmm // 100) * 60 + hhmm % 100
+    return pd.to_timedelta(minutes, unit='m')
@@ -6,61 +6,264 @@ Script for reading and processing HESSI flare data as a pandas dataframe, can re
 from matplotlib import pyplot as plt
 import pandas as pd
 import numpy as np
-import datetime as dt
 
-def hessi_flare_dataframe(web=True):
+import catalog_cache
+import catalog_schema
+import flare_index
+import instrument
+
+HESSI_URL = 'https://hesperia.gsfc.nasa.gov/hessidata/dbase/hessi_flare_list.txt'
+HESSI_FILE = 'hessi_flare_list.txt'
+PARSER_VERSION = 3 # change this whenever parse_hessi_flare_list gives a different dataframe so old cached frames aren't used
+
+# header line in the file isn't on the first row and the variable units were in the line underneith so had to fix the header line for the dataframe
+HEADER = ['Flare', 'Start_time', 'Peak_time', 'End_time', 'Dur (s)', 'Peak (c/s)', 'Total (Counts)', 'Energy (keV)', 'X Pos (asec)', 'Y Pos (asec)', 'Radial (asec)', 'AR', 'Flags']
+INT_COLUMNS = ['Flare', 'Dur (s)', 'Peak (c/s)', 'Total (Counts)', 'X Pos (asec)', 'Y Pos (asec)', 'Radial (asec)', 'AR']
+INT_FIELDS = [0, 5, 6, 7, 9, 10, 11, 12] # positions of INT_COLUMNS in a row of the file (the date is a seperate field)
+NUM_FIELDS = 13 # the flare number, date, 3 times, 7 numbers and the energy range, the flags come after
+SKIP_ROWS = 6
+SKIP_FOOTER = 39
+
+# one bit of Flag_bits for each flag code in flag_meaning, the An, Pn and Qn flags have a number so they are kept as A_level, P_level and Q_level (-1 if missing)
+FLAG_CODES = ['a0', 'a1', 'a2', 'a3', 'DF', 'DR', 'ED', 'EE', 'ES', 'FE', 'FR', 'FS', 'GD', 'GE', 'GS', 'MR', 'NS', 'PE', 'PS', 'SD', 'SE', 'SS']
+FLAG_BITS = {code: 1 << i for i, code in enumerate(FLAG_CODES)}
+LEVEL_FLAGS = ['A', 'P', 'Q']
+
+def hessi_flare_dataframe(web=True, cache=True, max_age=None):
     """
     Uses flare data from HESSI webpage to make a pandas dataframe (can use downloaded txt file).
     
     Param:
           web boolean, True to use web address or False to use downloaded txt file
+          cache boolean, True to use the local catalog cache (the flare list is only downloaded and parsed again when it has changed)
+          max_age number, seconds before the cached copy of the web page is checked for changes (None never checks)
           
     Return:
            df pandas dataframe, Dataframe containing HESSI flare data
     """
     
-    # header line in the file isn't on the first row and the variable units were in the line underneith so had to fix the header line for the dataframe
-    header = ['Flare', 'Start_time', 'Peak_time', 'End_time', 'Dur (s)', 'Peak (c/s)', 'Total (Counts)', 'Energy (keV)', 'X Pos (asec)', 'Y Pos (asec)', 'Radial (asec)', 'AR', 'Flags']
-    int_indexes = [0, 4, 5, 6, 8, 9, 10, 11]
-    dt_indexes = [1, 2, 3]
+    source = HESSI_URL if web else HESSI_FILE
+    if cache:
+        df = catalog_cache.cached_frame(source, parse_hessi_flare_list, PARSER_VERSION, max_age)
+        return catalog_schema.compact(df, catalog_schema.HESSI_SCHEMA) # parquet doesn't keep every categorical (e.g. AR)
     
-    if web:
-        df = pd.read_csv('https://hesperia.gsfc.nasa.gov/hessidata/dbase/hessi_flare_list.txt', sep='\t', header=None, skiprows=6, engine='python', skipfooter=39)
-    else:
-        df = pd.read_csv('hessi_flare_list.txt', sep='\t', header=None, skiprows=6, engine='python', skipfooter=39)
-    
-    """
-    pandas read_csv reads all the data into a dataframe with one column (as a string) and lots of rows
-    each column is seperated by a space in the .txt file but some columns contain spaces in the values such as the time and flag columns (also spaces in some column names!),
-    reformat to make start time, end time and peak time columns datetime objects and number columns ints
-    """
-    
-    # split the string into columns and make new dataframe
-    data = []
-    for row_index in range(len(df)):
-        row_data = df.iat[row_index, 0].split()
-        not_flag_col = row_data[:13]
-        flag_col = '-'.join(row_data[13:]) # want flags to be seperated by a dash -
-        start_date = not_flag_col.pop(1) # add date to times, if a flare occures close to midnight this method may cause issues
-        for i in dt_indexes:
-            not_flag_col[i] = start_date + ' ' + not_flag_col[i]
-        data.append(not_flag_col+[flag_col])
-    df = pd.DataFrame(np.array(data), columns=header)
-    
-    # sort types
-    for i in int_indexes:
-        df[header[i]] = pd.to_numeric(df[header[i]])
-    for i in dt_indexes:
-        df[header[i]] = pd.to_datetime(df[header[i]])
-    
-    # fix bug: End_time had the wrong date when the flare started around midnight because I used the start date to make the datetime object
-    for idx, row in df.iterrows():
-        if row['End_time'] < row['Start_time']:
-            row.loc['End_time'] = row['End_time'] + dt.timedelta(days=1)
-        if row['Peak_time'] < row['Start_time']:
-            row.loc['Peak_time'] = row['Peak_time'] + dt.timedelta(days=1)
+    text, validators = catalog_cache.read_source(catalog_cache.mirrored(source))
+    return parse_hessi_flare_list(text)
+
+@instrument.timed('hessi parse')
+def parse_hessi_flare_list(text):
+    """
+    Parses the text of the HESSI flare list into a pandas dataframe.
+    The table is tokenised as one array of bytes with numpy (see tokenise), numbers are then read straight from the bytes a column at a time
+    and only the few different dates, energy ranges and flag combinations are ever made into python strings.
+    The columns are returned in the compact types from catalog_schema.HESSI_SCHEMA.
+    
+    Param:
+          text string, the contents of hessi_flare_list.txt
+    
+    Return:
+           df pandas dataframe, Dataframe containing HESSI flare data
+    """
+    
+    # the table sits between a 6 line header and a 39 line footer explaining the flags
+    data, starts, ends, first, count = tokenise(text, SKIP_ROWS, SKIP_FOOTER)
+    tokens = first[:, np.newaxis] + np.arange(NUM_FIELDS)
+    field_starts = starts[tokens]
+    field_ends = ends[tokens]
+    field = lambda i: (field_starts[:, i], field_ends[:, i])
+    
+    # sort types, a column at a time as the columns have different widths
+    numbers = np.column_stack([read_ints(data, *field(i)) for i in INT_FIELDS])
+    
+    df = pd.DataFrame({'Flare': numbers[:, 0]})
+    
+    # add the start date to the times then fix the date of times that are after midnight (they are before the start time)
+    # there are only a few thousand different dates so only the unique ones are parsed
+    dates, codes = np.unique(read_bytes(data, *field(1)), return_inverse=True)
+    date = pd.to_datetime(dates.astype('U'), format='%d-%b-%Y').values[codes]
+    start = date + time_of_day(read_bytes(data, *field(2)))
+    df['Start_time'] = start
+    for i, column in [(3, 'Peak_time'), (4, 'End_time')]:
+        times = date + time_of_day(read_bytes(data, *field(i)))
+        df[column] = np.where(times >= start, times, times + np.timedelta64(1, 'D'))
+    
+    for i, column in enumerate(HEADER[4:12]):
+        if column in INT_COLUMNS:
+            df[column] = numbers[:, INT_COLUMNS.index(column)]
+        else:
+            values, codes = np.unique(read_bytes(data, *field(i + 5)), return_inverse=True)
+            df[column] = pd.Categorical.from_codes(codes, np.char.decode(values, 'utf-8'))
+    
+    # the flags are the rest of the line, want them to be seperated by a dash -, there are not many different combinations of flags so do each one once
+    last = first + count - 1
+    rest = np.where(count > NUM_FIELDS, starts[np.minimum(first + NUM_FIELDS, last)], ends[last])
+    flags, codes = np.unique(read_bytes(data, rest, ends[last]), return_inverse=True)
+    flags = np.char.decode(flags, 'utf-8')
+    df['Flags'] = np.array(['-'.join(f.split()) for f in flags], dtype=object)[codes]
+    for column, values in flag_columns(flags).items():
+        df[column] = values[codes]
            
-    return df
+    return catalog_schema.compact(df, catalog_schema.HESSI_SCHEMA)
+
+def tokenise(text, skip_rows=0, skip_footer=0):
+    """
+    Splits a whitespace seperated table into tokens with numpy instead of making a python string for every field.
+    Lines with fewer than NUM_FIELDS tokens (e.g. blank lines) are left out.
+    
+    Param:
+          text string, the table
+          skip_rows integer, lines to skip at the start
+          skip_footer integer, lines to skip at the end
+    
+    Return:
+           data numpy array, the bytes of the table (uint8)
+           starts numpy array, where each token starts in data
+           ends numpy array, where each token ends in data (one past its last byte)
+           first numpy array, for each line the index of its first token
+           count numpy array, for each line the number of tokens
+    """
+    
+    data = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    line_starts = np.r_[0, np.flatnonzero(data == ord('\n')) + 1]
+    if line_starts[-1] == len(data):
+        line_starts = line_starts[:-1] # like splitlines, a newline at the end doesn't start another line
+    line_starts = np.r_[line_starts, len(data)] # line i is from line_starts[i] up to line_starts[i + 1]
+    lines = len(line_starts) - 1
+    top = min(skip_rows, lines)
+    bottom = max(lines - skip_footer, top)
+    data = data[line_starts[top]:line_starts[bottom]]
+    line_starts = line_starts[top:bottom] - line_starts[top]
+    
+    # tokens are runs of bytes that aren't spaces, tabs or line ends
+    space = np.r_[True, data <= ord(' '), True].view(np.int8)
+    edges = np.diff(space)
+    starts = np.flatnonzero(edges == -1)
+    ends = np.flatnonzero(edges == 1)
+    
+    first = np.searchsorted(starts, line_starts)
+    count = np.diff(np.r_[first, len(starts)])
+    keep = count >= NUM_FIELDS
+    return data, starts, ends, first[keep], count[keep]
+
+def read_bytes(data, starts, ends):
+    """
+    The tokens from starts to ends as a numpy bytes array (one fixed width 'S' string per token)
+    """
+    
+    if not len(starts):
+        return np.empty(0, dtype='S1')
+    width = max(int((ends - starts).max()), 1)
+    index = starts[:, np.newaxis] + np.arange(width)
+    chars = np.where(index < ends[:, np.newaxis], data[np.minimum(index, len(data) - 1)], 0).astype(np.uint8)
+    return np.ascontiguousarray(chars).view('S{}'.format(width)).ravel()
+
+def read_ints(data, starts, ends):
+    """
+    Reads integer tokens (with an optional minus sign) straight from the bytes, anything else is left to pandas
+    
+    Return:
+           numpy array of int64
+    """
+    
+    if not len(starts):
+        return np.empty(0, dtype=np.int64)
+    # the tokens are lined up on their last digit and padded with zeros in front, so each column of digits has the same power of ten
+    width = int((ends - starts).max())
+    index = ends[:, np.newaxis] - width + np.arange(width)
+    chars = np.where(index >= starts[:, np.newaxis], data[np.maximum(index, 0)], np.uint8(ord('0')))
+    negative = chars == ord('-')
+    chars[negative] = ord('0')
+    digits = chars - np.uint8(ord('0')) # the bytes that aren't digits wrap round past 9
+    if (digits > 9).any() or (negative & (index != starts[:, np.newaxis])).any(): # a minus sign can only be the first byte
+        return pd.to_numeric(read_bytes(data, starts, ends).astype('U')) # not all plain integers
+    values = digits.astype(np.int64) @ 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return np.where(negative.any(axis=1), -values, values)
+
+def split_flag(flag):
+    """
+    Splits a flag into its code and level, 'Q11' -> ('Q', 11), 'NS' -> ('NS', None)
+    
+    Param:
+          flag string, a flag from the Flags column
+    
+    Return:
+           code string, the flag code (one of FLAG_CODES or LEVEL_FLAGS)
+           level integer, the number of an An, Pn or Qn flag or None
+    """
+    
+    if flag[:1] in LEVEL_FLAGS and flag[1:].isdigit():
+        return flag[0], int(flag[1:])
+    return flag, None
+
+def flag_columns(flags):
+    """
+    Turns flag strings into a bitmask of the flag codes and the levels of the An, Pn and Qn flags
+    
+    Param:
+          flags array of strings, flags seperated by spaces or dashes (usually the unique values so each one is only split once)
+    
+    Return:
+           dictionary of numpy arrays, Flag_bits (int32, see FLAG_BITS) and A_level, P_level and Q_level (int8, -1 if the flag is missing)
+    """
+    
+    bits = np.zeros(len(flags), dtype=np.int32)
+    levels = {code: np.full(len(flags), -1, dtype=np.int8) for code in LEVEL_FLAGS}
+    for i, f in enumerate(flags):
+        for flag in f.replace('-', ' ').split():
+            code, level = split_flag(flag)
+            if level is not None:
+                levels[code][i] = level
+            else:
+                bits[i] |= FLAG_BITS.get(code, 0)
+    columns = {'Flag_bits': bits}
+    for code in LEVEL_FLAGS:
+        columns[code + '_level'] = levels[code]
+    return columns
+
+def time_of_day(times):
+    """
+    Converts an array of 'HH:MM:SS' strings to timedeltas by doing arithmetic on the character codes rather than parsing each string
+    
+    Param:
+          times numpy array, strings (or bytes) of the time of day
+    
+    Return:
+           numpy array of timedelta64
+    """
+    
+    values = times if times.dtype.kind == 'S' else times.astype('U')
+    if values.dtype not in (np.dtype('S8'), np.dtype('U8')) or not (np.char.str_len(values) == 8).all():
+        return pd.to_timedelta(values.astype('U')).values # not all in the usual format so let pandas deal with it
+    digits = values.view(np.uint8 if values.dtype.kind == 'S' else np.uint32).reshape(-1, 8).astype(np.int64) - ord('0')
+    seconds = (digits[:, 0]*10 + digits[:, 1])*3600 + (digits[:, 3]*10 + digits[:, 4])*60 + digits[:, 6]*10 + digits[:, 7]
+    return seconds.astype('timedelta64[s]').astype('timedelta64[ns]')
+
+def flag_mask(df, flags):
+    """
+    Finds the rows that contain any of the given flags, this only uses the Flag_bits and level columns so it is a few array operations
+    
+    Param:
+          df pandas dataframe, hessi data as returned by hessi_flare_dataframe (older frames without the flag columns have them made from Flags)
+          flags list of strings, the flags to find, codes like 'NS' or levelled flags like 'Q11' or 'P0'
+          
+    Return:
+           mask numpy array of booleans, True for rows that contain at least one of the flags
+    """
+    
+    columns = df if 'Flag_bits' in df.columns else flag_columns(df['Flags'].values)
+    bits = 0
+    mask = np.zeros(len(df.index), dtype=bool)
+    for flag in flags:
+        code, level = split_flag(flag)
+        if level is not None:
+            mask |= np.asarray(columns[code + '_level']) == level
+        elif code in FLAG_BITS:
+            bits |= FLAG_BITS[code]
+        else:
+            raise ValueError('unknown flag {}'.format(flag))
+    if bits:
+        mask |= (np.asarray(columns['Flag_bits']) & bits) != 0
+    return mask
 
 def find_flags(df, flags):
     """
@@ -71,45 +274,58 @@ def find_flags(df, flags):
           flags list of strings, the flags to find in the dataframe
           
     Return:
-           indexes list of integers, a list of integers of row indexes that contain the given flag
+           indexes pandas index, the row indexes that contain at least one of the given flags (each index only once)
+    """
+    
+    return df.index[flag_mask(df, flags)]
+
+def radial_limit(df, percentile=99):
     """
+    The radial distance above which flares are treated as outliers by filter
     
-    indexes = []
-    for idx, row in df.iterrows():
-        split_flags = row['Flags'].split('-')
-        for f in split_flags:
-            if f in flags:
-                indexes.append(idx)
+    Param:
+          df pandas dataframe, hessi data as returned by hessi_flare_dataframe
+          percentile number, the percentile of the radial distances to use
+    
+    Return:
+           limit float, in arcsec
+    """
     
-    return indexes
+    return float(np.percentile(df['Radial (asec)'].values, percentile)) # remove outliers as done here https://www.kaggle.com/lesagesj/solar-flares-from-rhessi-mission/notebook
 
-def filter(df, remove_flags):
+def filter(df, remove_flags, limit=None):
     """
     Removes bad radial values, bad flags and strange active regions (shouldn't be 0 but a lot are 0)
     
     Param:
           df pandas dataframe, the dataframe to find the flag in (expected to contain hessi data with flag column as returned by hessi_flare_dataframe function)
           flags list of strings, the flags to find in the dataframe
+          limit float, the largest radial distance to keep (None uses radial_limit of df), give the same limit to filter parts of the catalog the same way as the whole
           
     Return:
            df pandas dataframe, the same dataframe without rows that contain given flags or strange results such as location or active region
     """
     
-    df = df[df['Radial (asec)'] <= np.percentile(df['Radial (asec)'].values, 99)] # remove outliers as done here https://www.kaggle.com/lesagesj/solar-flares-from-rhessi-mission/notebook
-    bad_indexes = find_flags(df, remove_flags)
-    df.drop(bad_indexes)
-    df = df[df['AR'] > 0]
+    if limit is None:
+        limit = radial_limit(df)
+    keep = df['Radial (asec)'].values <= limit
+    keep &= ~flag_mask(df, remove_flags)
+    keep &= df['AR'].to_numpy() > 0 # AR is categorical so compare the values not the categories
     
-    return df
+    return df[keep]
 
-def plot_flare_locations(hessi):
+def plot_flare_locations(hessi, t0=None, t1=None):
     """
     A function that uses the HESSI database to plot the locations of flares
     
     Param:
           hessi, the HESSI database as a pandas dataframe
+          t0, t1 datetimes or strings, only plot the flares that peak between them (None plots every flare)
     """
     
+    if t0 is not None or t1 is not None:
+        index = flare_index.build_index(hessi)
+        hessi = flare_index.select(index, flare_index.time_range(index, t0, t1))
     plt.scatter(hessi['X Pos (asec)'].values, hessi['Y Pos (asec)'].values, color='r', s=0.5)
     plt.show()
     
@@ -184,7 +400,7 @@ def flag_meaning(flag):
     return meaning
 
 if __name__ == '__main__':
-    print('Reading HESSI data - this can take some time with current implementation')
+    print('Reading HESSI data')
     hessi = hessi_flare_dataframe()
     bad_flags = ['NS','SD']
     for flag in bad_flags:
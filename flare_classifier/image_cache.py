@@ -0,0 +1,214 @@
+"""
+A cache of the training images after they have been decoded and resized, so they don't have to be decoded from png again every time the CNN is trained.
+
+The images for each source directory and (rows, columns, colour) are kept as one uint8 file that is memory mapped, with a label for each image and an index of the source files.
+The index has a content hash of every source file (only recalculated for files whose size or modification time changed) and the hash of the whole directory.
+When new images are added to the class directories (e.g. by download_images) only the new images are decoded and appended,
+if any cached image changed or was removed or the classes changed the cache is rebuilt.
+Use cached_batches to train from the memory map a batch at a time (cnn.data_prep(cache_dir=...) returns the memory map and a shuffled order of the rows for it),
+nothing is copied into memory apart from the batch being trained on.
+"""
+
+import os
+import json
+import hashlib
+
+import cv2
+import numpy as np
+
+IMAGE_CACHE_DIR = 'image_cache'
+
+def store_dir(path, img_rows, img_cols, color, cache_dir=IMAGE_CACHE_DIR):
+    """
+    The directory of the cache for one source directory, image size and colour (the source is part of the name so different directories never share a cache)
+
+    Param:
+          path string, the directory with a sub directory of images for each class
+          img_rows integer, the number of rows of the resized images
+          img_cols integer, the number of columns of the resized images
+          color boolean, True for colour (BGR) or False for greyscale
+          cache_dir string, the directory with all the caches
+
+    Return:
+           path string
+    """
+
+    source = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, '{}_{}x{}_{}'.format(source, img_rows, img_cols, 'BGR' if color else 'grey'))
+
+def file_hash(path):
+    """
+    sha1 of the contents of a file
+    """
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def scan_sources(path, known=None):
+    """
+    Lists the images in each class directory with their content hashes, files that haven't changed size or modification time since they were
+    last hashed keep their old hash so only new or changed files are read
+
+    Param:
+          path string, the directory with a sub directory of images for each class
+          known dictionary, relative path -> [size, mtime, sha1] from a previous scan
+
+    Return:
+           classes list of strings, the class names in the order they are coded (alphabetical)
+           files list, [relative path, label, size, mtime, sha1] for every image in a fixed order
+           digest string, content hash of the whole directory
+    """
+
+    known = known or {}
+    classes = sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+    files = []
+    for label, image_class in enumerate(classes):
+        for img_name in sorted(os.listdir(os.path.join(path, image_class))):
+            relative = os.path.join(image_class, img_name)
+            stat = os.stat(os.path.join(path, relative))
+            old = known.get(relative)
+            if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+                sha1 = old[2]
+            else:
+                sha1 = file_hash(os.path.join(path, relative))
+            files.append([relative, label, stat.st_size, stat.st_mtime_ns, sha1])
+    digest = hashlib.sha1(json.dumps([[f[0], f[4]] for f in files]).encode('utf-8')).hexdigest()
+    return classes, files, digest
+
+def load_index(directory):
+    """
+    The index of a cache, None if there isn't one
+    """
+
+    index_path = os.path.join(directory, 'index.json')
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+def prepare_image(path, img_rows, img_cols, color):
+    """
+    Reads an image and resizes it like cnn.resize_image (INTER_AREA) but keeps it as uint8,
+    data_prep resizes the float image so the cached pixels can differ from it by the rounding to uint8 (at most half a grey level, 0.002 once normalised)
+
+    Param:
+          path string, the image file
+          img_rows integer, the number of rows of the resized image
+          img_cols integer, the number of columns of the resized image
+          color boolean, True for colour (BGR) or False for greyscale
+
+    Return:
+           img numpy array, uint8 [rows, columns, chanels]
+    """
+
+    img = cv2.imread(path, 1 if color else 0)
+    img = cv2.resize(img, (img_cols, img_rows), interpolation=cv2.INTER_AREA)
+    return img.reshape(img_rows, img_cols, 3 if color else 1)
+
+def cache_images(path, img_rows, img_cols, color, cache_dir=IMAGE_CACHE_DIR):
+    """
+    Makes sure the cache for the images in path is up to date, new images are appended and the cache is rebuilt if old ones changed
+
+    Param:
+          path string, the directory with a sub directory of images for each class
+          img_rows integer, the number of rows of the resized images
+          img_cols integer, the number of columns of the resized images
+          color boolean, True for colour (BGR) or False for greyscale
+          cache_dir string, the directory with all the caches
+
+    Return:
+           index dictionary, the index of the cache (count, classes, files and the directory hash)
+    """
+
+    directory = store_dir(path, img_rows, img_cols, color, cache_dir)
+    os.makedirs(directory, exist_ok=True)
+    images_path = os.path.join(directory, 'images.u8')
+    channels = 3 if color else 1
+    image_bytes = img_rows * img_cols * channels
+
+    index = load_index(directory)
+    if index is not None and index.get('source') != os.path.abspath(path):
+        index = None # a cache from before the source was in the name, or a clash of the short hash
+    known = {f[0]: f[2:] for f in index['files']} if index is not None else {}
+    classes, files, digest = scan_sources(path, known)
+    if index is not None and index['digest'] == digest:
+        return index
+
+    # everything that is already cached has to be unchanged and in the same classes to just append the new images
+    cached = []
+    if index is not None and index['classes'] == classes:
+        current = {f[0]: f for f in files}
+        if all(f[0] in current and current[f[0]][4] == f[4] for f in index['files']):
+            cached = index['files']
+    cached_names = set(f[0] for f in cached)
+    new = [f for f in files if f[0] not in cached_names]
+
+    print('caching {} new images ({} already cached)'.format(len(new), len(cached)))
+    with open(images_path, 'r+b' if cached else 'wb') as f:
+        f.truncate(len(cached) * image_bytes) # drops anything left over from an interrupted append
+        f.seek(len(cached) * image_bytes)
+        for relative, label, size, mtime, sha1 in new:
+            f.write(prepare_image(os.path.join(path, relative), img_rows, img_cols, color).tobytes())
+
+    files = cached + new
+    np.save(os.path.join(directory, 'labels.npy'), np.array([f[1] for f in files], dtype=np.int16))
+    index = {'source': os.path.abspath(path), 'rows': img_rows, 'cols': img_cols, 'channels': channels, 'count': len(files), 'classes': classes, 'files': files, 'digest': digest}
+    with open(os.path.join(directory, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(directory, 'index.json.tmp'), os.path.join(directory, 'index.json')) # the index is written last so it only ever describes complete images
+
+    return index
+
+def load_image_cache(path, img_rows, img_cols, color, cache_dir=IMAGE_CACHE_DIR, update=True):
+    """
+    Memory maps the cached images, slicing the images doesn't copy or read anything until the pixels are used
+
+    Param:
+          path string, the directory with a sub directory of images for each class
+          img_rows integer, the number of rows of the resized images
+          img_cols integer, the number of columns of the resized images
+          color boolean, True for colour (BGR) or False for greyscale
+          cache_dir string, the directory with all the caches
+          update boolean, True to check the source directory and cache any new images first
+
+    Return:
+           images numpy memmap, read only uint8 [number of images, rows, columns, chanels]
+           labels numpy array, the class number of each image
+           classes list of strings, the class names in the order they are coded
+    """
+
+    directory = store_dir(path, img_rows, img_cols, color, cache_dir)
+    index = cache_images(path, img_rows, img_cols, color, cache_dir) if update else load_index(directory)
+    shape = (index['count'], img_rows, img_cols, index['channels'])
+    if index['count'] == 0:
+        images = np.zeros(shape, dtype=np.uint8)
+    else:
+        images = np.memmap(os.path.join(directory, 'images.u8'), dtype=np.uint8, mode='r', shape=shape)
+    labels = np.load(os.path.join(directory, 'labels.npy'))
+    return images, labels, index['classes']
+
+def cached_batches(images, labels, num_classes, batch_size=50, shuffle=True, seed=None, rows=None):
+    """
+    Yields float32 batches from cached images forever (for fit with steps_per_epoch), only one batch is normalised in memory at a time
+
+    Param:
+          images numpy array, uint8 images from load_image_cache
+          labels numpy array, the class number of each image (or one hot labels, e.g. from cnn.data_prep)
+          num_classes integer, the number of classes
+          batch_size integer, the number of images in a batch
+          shuffle boolean, True to shuffle the images every epoch
+          seed integer, seed for the shuffling
+          rows numpy array, only use the images at these positions (e.g. one fold of a cross validation), None for every image
+
+    Return:
+           generator of (images, one hot labels), images normalised to 0-1
+    """
+
+    rng = np.random.RandomState(seed)
+    one_hot = np.eye(num_classes, dtype=np.float32)
+    rows = np.arange(len(labels)) if rows is None else np.asarray(rows)
+    while True:
+        order = rng.permutation(rows) if shuffle else rows
+        for start in range(0, len(order), batch_size):
+            batch = np.sort(order[start:start + batch_size]) # reading the memory map in order is quicker
+            yield images[batch].astype(np.float32) / 255.0, labels[batch] if labels.ndim == 2 else one_hot[labels[batch]]
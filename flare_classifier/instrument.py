@@ -0,0 +1,244 @@
+"""
+Lightweight timing and memory instrumentation for the pipeline, from parsing the catalogs to training and scoring the CNN.
+
+Wrap a stage in a timer (a context manager) or decorate a function with timed, each run of a stage makes a record with its wall time,
+the rows and bytes it handled, the process memory when it started and the peak memory while it ran (sampled by a background thread).
+Records are kept in memory (see summary) and, if a log file is set, appended to it as json lines so a whole run can be read back with read_log.
+Counters add up numbers that aren't tied to one stage (e.g. cache hits).
+
+Set the FLARE_METRICS_LOG environment variable (or call set_log) to write the log and FLARE_PROFILE_DIR (or set_profile_dir)
+to also save a cProfile dump of every stage run (open them with pstats or snakeviz), profiling slows everything down so only use it to look into a stage.
+
+    with instrument.timer('download', bytes=size) as record:
+        ...
+        record['rows'] = len(rows)
+
+    @instrument.timed('hessi parse')
+    def parse_hessi_flare_list(text):
+        ...
+"""
+
+import os
+import json
+import time
+import resource
+import threading
+import functools
+import cProfile
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+LOG_FILE = os.environ.get('FLARE_METRICS_LOG')
+PROFILE_DIR = os.environ.get('FLARE_PROFILE_DIR')
+SAMPLE_INTERVAL = 0.01 # seconds between memory samples
+
+RECORDS = []
+COUNTERS = {}
+_lock = threading.Lock()
+_active = []
+_sampler = None
+
+def set_log(path):
+    """
+    Sets the json lines file records are appended to (None to only keep them in memory)
+    """
+
+    global LOG_FILE
+    LOG_FILE = path
+
+def set_profile_dir(directory):
+    """
+    Sets the directory cProfile dumps of each stage are saved to (None to not profile)
+    """
+
+    global PROFILE_DIR
+    PROFILE_DIR = directory
+
+def rss():
+    """
+    The resident memory of the process in MB (the peak so far if the current value can't be read)
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on linux
+
+def sample_memory():
+    """
+    Samples the memory of the process while any timer is running and keeps the peak of each running timer (runs in a daemon thread)
+    """
+
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        with _lock:
+            if not _active:
+                continue
+            current = rss()
+            for record in _active:
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], current)
+
+def start_sampler():
+    """
+    Starts the memory sampling thread once
+    """
+
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = threading.Thread(target=sample_memory, daemon=True)
+            _sampler.start()
+
+def write_record(record):
+    """
+    Keeps a record and appends it to the log if there is one
+    """
+
+    with _lock:
+        RECORDS.append(record)
+        if LOG_FILE is not None:
+            with open(LOG_FILE, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+@contextmanager
+def timer(stage, rows=None, bytes=None, profile=None, **extra):
+    """
+    Times a stage and samples its peak memory, the record is yielded so rows, bytes or anything else can be filled in inside the block
+
+    Param:
+          stage string, the name of the stage
+          rows integer, the number of rows or items the stage handled (can be set on the record later)
+          bytes integer, the number of bytes the stage read or wrote (can be set on the record later)
+          profile boolean, True to save a cProfile dump of the stage (None profiles if a profile directory is set)
+          extra, anything else to keep in the record (must be json serialisable)
+
+    Return:
+           record dictionary, stage, start, seconds, rows, bytes, rss_mb (at the start), peak_rss_mb, thread and the extra values
+    """
+
+    start_sampler()
+    start_rss = rss()
+    record = dict(extra, stage=stage, start=time.time(), seconds=None, rows=rows, bytes=bytes,
+                  rss_mb=start_rss, peak_rss_mb=start_rss, thread=threading.current_thread().name)
+    with _lock:
+        _active.append(record)
+    profiler = None
+    if profile or (profile is None and PROFILE_DIR is not None):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: # only one profiler can run at a time, e.g. a stage inside a profiled stage
+            profiler = None
+    t0 = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - t0
+        if profiler is not None:
+            profiler.disable()
+            directory = PROFILE_DIR or '.'
+            os.makedirs(directory, exist_ok=True)
+            record['profile'] = os.path.join(directory, '{}_{}.prof'.format(stage.replace(' ', '_'), int(record['start'] * 1000)))
+            profiler.dump_stats(record['profile'])
+        with _lock:
+            _active.remove(record)
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], rss())
+        write_record(record)
+
+def size_of(value):
+    """
+    The number of rows of a result (dataframes, arrays, lists, the first item of a tuple), None if it doesn't have a length
+    """
+
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray, list)):
+        return len(value)
+    return None
+
+def bytes_of(value):
+    """
+    The number of bytes of a str (utf-8 encoded), bytes or numpy array argument, 0 for anything else
+    """
+
+    if isinstance(value, str):
+        return len(value) if value.isascii() else len(value.encode('utf-8')) # isascii doesn't scan the string, so ascii text isn't encoded
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return 0
+
+def timed(stage):
+    """
+    Decorator that runs every call of a function in a timer, rows are the length of the result and bytes the size of any str, bytes or array arguments (see bytes_of)
+
+    Param:
+          stage string, the name of the stage
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            size = sum(bytes_of(arg) for arg in args)
+            with timer(stage, bytes=size or None) as record:
+                result = function(*args, **kwargs)
+                record['rows'] = size_of(result)
+            return result
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    """
+    Adds n to a counter
+    """
+
+    with _lock:
+        COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+def summary(records=None):
+    """
+    Totals the records of each stage
+
+    Param:
+          records list of dictionaries or a dataframe (None for the records of this process)
+
+    Return:
+           pandas dataframe, one row per stage with the number of runs, total and mean seconds, rows, bytes, peak memory and the share of the total time
+    """
+
+    df = pd.DataFrame(RECORDS if records is None else records)
+    if df.empty:
+        return df
+    for column in ['rows', 'bytes']:
+        df[column] = pd.to_numeric(df[column])
+    table = df.groupby('stage').agg(runs=('seconds', 'size'), seconds=('seconds', 'sum'), mean_seconds=('seconds', 'mean'),
+                                    rows=('rows', 'sum'), bytes=('bytes', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
+    table['share'] = table['seconds'] / table['seconds'].sum()
+    return table.sort_values('seconds', ascending=False)
+
+def read_log(path=None):
+    """
+    Reads a json lines log back into a dataframe
+
+    Param:
+          path string, the log file (None for LOG_FILE)
+
+    Return:
+           pandas dataframe, one row per record
+    """
+
+    with open(path or LOG_FILE) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+def reset():
+    """
+    Forgets the records and counters kept in memory
+    """
+
+    with _lock:
+        del RECORDS[:]
+        COUNTERS.clear()
@@ -5,30 +5,48 @@ the dataset is exported to a csv file so it can be read into a pandas dataframe
 
 """
 
+import os
+import sys
 import hessi_df as hdf
 import goes_df as gdf
-import datetime as dt
+import catalog_cache
+import catalog_schema
+import instrument
 import pandas as pd
+import numpy as np
 
-def intersect_hessi_goes(to_csv=False):
+FLARE_DATA_FILE = catalog_schema.FLARE_DATA_FILE
+BAD_FLAGS = ['NS','SD'] # NS non solar event, SD spacecraft in South Atlantic Anomaly where magnetic data is weird https://image.gsfc.nasa.gov/poetry/ask/q525.html
+MARGIN = pd.Timedelta(days=1) # flares this close to the last update are joined again in case the catalogs changed (e.g. a flare that was still going)
+
+def intersect_hessi_goes(to_csv=False, candidates=False, incremental=False, filename=FLARE_DATA_FILE, margin=MARGIN):
     """
     Groups the datetime, location and class of each solar flare in one dataframe (GOES mass missing location data and isn't as accurate)
     
     Param:
           to_csv boolean, if True -> export the datframe to csv
+          candidates boolean, if True -> also return the GOES flares that matched more than one HESSI flare as ranked candidates (exported to hessi_goes_candidates.csv)
+          incremental boolean, if True -> only join the flares since the last run and update the csv (see update_flare_data), does a full build if there hasn't been one
+          filename string, the csv file
+          margin pandas timedelta, how far before the last update to join again when incremental
     
     Return:
-           data pandas dataframe, this contains the matched flares with their date, location and class
+           data pandas dataframe, this contains the matched flares with their date, location and class (in order of peak time)
+           multiple pandas dataframe, only if candidates is True, the ranked candidates from candidate_flares (only for the joined window when incremental)
     """
     
+    state = load_state(filename) if incremental else None
+    if state is not None and os.path.exists(filename):
+        return update_flare_data(filename, state, candidates, margin)
+    
     # HESSI mission has good locations for flares with their dates
     print('Getting HESSI flare data')
     hessi = hdf.hessi_flare_dataframe(web=False)
     
     # filtering
     print('Filtering')
-    bad_flags = ['NS','SD'] # NS non solar event, SD spacecraft in South Atlantic Anomaly where magnetic data is weird https://image.gsfc.nasa.gov/poetry/ask/q525.html
-    hessi = hdf.filter(hessi, bad_flags)
+    limit = hdf.radial_limit(hessi)
+    hessi = hdf.filter(hessi, BAD_FLAGS, limit)
     print(hessi.head())
     
     # GOES mission is used to classify flares with their dates
@@ -38,24 +56,215 @@ def intersect_hessi_goes(to_csv=False):
     
     # Combine, for each flare in GOES find the flare in HESSI for the accurate location
     print('Using dates to match flares in each dataset and create a new dataframe')
-    data = {'Peak_time': [], 'X_pos': [], 'Y_pos': [], 'Class': []}
-    for idx, row in goes.iterrows():        
-        match = hessi[hessi['Peak_time'].between(row['Start_time'], row['End_time'])]
-        # currently only find flares where there was one match (multiple flares happening together are ignored)
-        if len(match.index) == 1:
-            hessi_idx = match.index
-            data['Peak_time'].append(match['Peak_time'].to_numpy()[0]) # use to_numpy!!
-            data['X_pos'].append(match['X Pos (asec)'].to_numpy()[0])
-            data['Y_pos'].append(match['Y Pos (asec)'].to_numpy()[0])
-            data['Class'].append(row['Class'])
-    data = pd.DataFrame.from_dict(data)
+    data = sort_flares(join_flares(hessi, goes))
     print('total flares = {}, num B class = {}, num C class = {}'.format(len(data.index), len(data[data['Class'] == 'B'].index), len(data[data['Class'] == 'C'].index)))
     print(data.head())
-    if to_csv:
-        data.to_csv('hessi_goes_flare_data.csv', index=False)
+    if to_csv or incremental:
+        write_flare_data(data, filename, {'radial_limit': limit, 'bad_flags': BAD_FLAGS})
+    
+    if candidates:
+        multiple = candidate_flares(hessi, goes)
+        print('GOES flares with more than one HESSI match = {}'.format(multiple['Event'].nunique()))
+        if to_csv:
+            multiple.to_csv('hessi_goes_candidates.csv', index=False)
+        return data, multiple
+    
+    return data
+
+def state_path(filename):
+    """
+    The json file next to the csv that remembers how far it has been updated
+    """
+    
+    return os.path.splitext(filename)[0] + '_state.json'
+
+def load_state(filename):
+    """
+    Reads the state of the csv (high water mark of Peak_time, the radial limit and flags it was filtered with), None if there isn't one
+    """
+    
+    state = catalog_cache.load_meta(state_path(filename))
+    if state is None or state['high_water_mark'] is None:
+        return None
+    state['high_water_mark'] = pd.Timestamp(state['high_water_mark'])
+    return state
+
+def sort_flares(data):
+    """
+    Puts matched flares in order of peak time so the rows of a full build and of incremental updates are in the same order
+    """
+    
+    return data.sort_values('Peak_time', kind='mergesort').reset_index(drop=True)
+
+def write_flare_data(data, filename, state):
+    """
+    Writes the matched flares to csv and then the state with the new high water mark (both replace the old files in one go)
+    
+    Param:
+          data pandas dataframe, the matched flares in order of peak time
+          filename string, the csv file
+          state dictionary, radial_limit and bad_flags used to filter HESSI
+    """
+    
+    data.to_csv(filename + '.tmp', index=False)
+    os.replace(filename + '.tmp', filename)
+    hwm = str(data['Peak_time'].max()) if len(data.index) else None # no flares means the next update has to be a full build
+    catalog_cache.save_meta(state_path(filename), dict(state, high_water_mark=hwm))
+
+@instrument.timed('incremental join')
+def incremental_join(old, hessi, goes, cutoff):
+    """
+    Updates matched flares with the flares that peak after a cutoff.
+    Every GOES flare that ends after the cutoff is joined again (with all the HESSI flares that could peak inside it)
+    and replaces the old rows after the cutoff, the rows before the cutoff can't change so they are kept.
+    Gives the same rows as joining everything at once as long as the catalogs didn't change before the cutoff.
+    
+    Param:
+          old pandas dataframe, the matched flares from the last update
+          hessi pandas dataframe, filtered HESSI flares (at least every flare that peaks after the first GOES flare that ends after the cutoff)
+          goes pandas dataframe, GOES flares (at least every flare that ends after the cutoff)
+          cutoff pandas timestamp, the time after which flares are joined again
+    
+    Return:
+           data pandas dataframe, the matched flares in order of peak time
+           hessi, goes pandas dataframes, the flares in the joined window
+    """
+    
+    goes = goes[goes['End_time'].to_numpy() >= cutoff]
+    if len(goes.index):
+        hessi = hessi[hessi['Peak_time'].to_numpy() >= goes['Start_time'].min()]
+    else:
+        hessi = hessi.iloc[:0]
+    new = join_flares(hessi, goes)
+    new = new[new['Peak_time'].to_numpy() >= cutoff]
+    old = old[old['Peak_time'].to_numpy() < cutoff]
+    data = catalog_schema.compact(pd.concat([old, new], ignore_index=True), catalog_schema.FLARE_SCHEMA)
+    
+    return sort_flares(data), hessi, goes
+
+def update_flare_data(filename=FLARE_DATA_FILE, state=None, candidates=False, margin=MARGIN, max_age=0):
+    """
+    Updates the csv of matched flares with the flares since the last update instead of building it again.
+    Only the GOES reports from the year of the last update onwards are loaded and HESSI flares are filtered with the same radial limit as the full build.
+    
+    Param:
+          filename string, the csv file
+          state dictionary, from load_state (read from the file next to the csv if None)
+          candidates boolean, if True -> also return the ranked candidates in the joined window
+          margin pandas timedelta, how far before the high water mark to join again
+          max_age number, seconds before the cached GOES reports are checked for changes (0 always checks, with a conditional request, so new flares are seen)
+    
+    Return:
+           data pandas dataframe, all the matched flares in order of peak time
+           multiple pandas dataframe, only if candidates is True
+    """
+    
+    state = state or load_state(filename)
+    cutoff = state['high_water_mark'] - margin
+    print('Updating {} from {}'.format(filename, cutoff))
+    
+    hessi = hdf.hessi_flare_dataframe(web=False)
+    hessi = hdf.filter(hessi, state['bad_flags'], state['radial_limit'])
+    first_year = max((cutoff - pd.Timedelta(days=1)).year, gdf.YEARS[0]) # a flare ending after the cutoff could have started the year before
+    goes = gdf.goes_dataframe(years=[year for year in gdf.YEARS if year >= first_year], max_age=max_age)
     
+    old = catalog_schema.read_flare_data(filename)
+    data, hessi, goes = incremental_join(old, hessi, goes, cutoff)
+    print('new flares = {}, total flares = {}'.format(len(data.index) - len(old.index), len(data.index)))
+    write_flare_data(data, filename, state)
+    
+    if candidates:
+        return data, candidate_flares(hessi, goes)
     return data
 
+def match_windows(hessi, goes):
+    """
+    Finds the HESSI flares that peak inside each GOES flare (between the start and end time inclusive).
+    HESSI peak times are sorted once and each GOES window is found with a binary search, so the matches for every window are found in one pass.
+    
+    Param:
+          hessi pandas dataframe, HESSI flares with a Peak_time column
+          goes pandas dataframe, GOES flares with Start_time and End_time columns
+    
+    Return:
+           order numpy array, positions of the HESSI flares in order of peak time
+           first numpy array, for each GOES flare the position in order of its first match
+           counts numpy array, for each GOES flare the number of matches
+    """
+    
+    peaks = hessi['Peak_time'].to_numpy()
+    order = np.argsort(peaks, kind='mergesort')
+    peaks = peaks[order]
+    first = np.searchsorted(peaks, goes['Start_time'].to_numpy(), side='left')
+    last = np.searchsorted(peaks, goes['End_time'].to_numpy(), side='right')
+    
+    return order, first, np.maximum(last - first, 0)
+
+@instrument.timed('join')
+def join_flares(hessi, goes):
+    """
+    Matches GOES flares to HESSI flares, only GOES flares that match exactly one HESSI flare are kept (multiple flares happening together are ignored)
+    
+    Param:
+          hessi pandas dataframe, HESSI flares as returned by hessi_df.hessi_flare_dataframe
+          goes pandas dataframe, GOES flares as returned by goes_df.goes_dataframe
+    
+    Return:
+           data pandas dataframe, the peak time and location from HESSI with the class from GOES
+    """
+    
+    order, first, counts = match_windows(hessi, goes)
+    single = counts == 1
+    match = order[first[single]]
+    
+    data = pd.DataFrame({'Peak_time': hessi['Peak_time'].to_numpy()[match],
+                         'X_pos': hessi['X Pos (asec)'].to_numpy()[match],
+                         'Y_pos': hessi['Y Pos (asec)'].to_numpy()[match],
+                         'Class': goes['Class'].to_numpy()[single]})
+    
+    return catalog_schema.compact(data, catalog_schema.FLARE_SCHEMA)
+
+@instrument.timed('candidates')
+def candidate_flares(hessi, goes):
+    """
+    Lists the HESSI flares for the GOES flares that matched more than one HESSI flare.
+    Candidates are ranked by how close the HESSI peak is to the GOES peak (rank 0 is the closest).
+    
+    Param:
+          hessi pandas dataframe, HESSI flares as returned by hessi_df.hessi_flare_dataframe
+          goes pandas dataframe, GOES flares as returned by goes_df.goes_dataframe
+    
+    Return:
+           candidates pandas dataframe, one row per candidate with the position of the GOES flare (Event), the number of matches and the rank
+    """
+    
+    order, first, counts = match_windows(hessi, goes)
+    events = np.flatnonzero(counts > 1)
+    counts = counts[events]
+    
+    # expand each window into the positions of its matches
+    event = np.repeat(events, counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    match = order[np.repeat(first[events], counts) + offset]
+    
+    peak = hessi['Peak_time'].to_numpy()[match]
+    distance = np.abs(peak - goes['Peak_time'].to_numpy()[event])
+    ranked = np.lexsort((distance, event)) # windows stay in the same order so offset is now the rank within each window
+    event = event[ranked]
+    match = match[ranked]
+    
+    candidates = pd.DataFrame({'Event': event,
+                               'Start_time': goes['Start_time'].to_numpy()[event],
+                               'End_time': goes['End_time'].to_numpy()[event],
+                               'Class': goes['Class'].to_numpy()[event],
+                               'Peak_time': hessi['Peak_time'].to_numpy()[match],
+                               'X_pos': hessi['X Pos (asec)'].to_numpy()[match],
+                               'Y_pos': hessi['Y Pos (asec)'].to_numpy()[match],
+                               'Matches': np.repeat(counts, counts),
+                               'Rank': offset})
+    
+    return catalog_schema.compact(candidates, catalog_schema.FLARE_SCHEMA)
+
 if __name__ == '__main__':
-    together = intersect_hessi_goes(to_csv=True)
+    together = intersect_hessi_goes(to_csv=True, incremental='--incremental' in sys.argv) # run with --incremental to only add the flares since the last run
     
\ No newline at end of file
@@ -0,0 +1,342 @@
+"""
+Scores images of solar flares with a saved CNN (see cnn.py), the model is loaded once and images are scored in fixed size batches.
+
+The class names are the sub directories of the directory the model was trained on (or the classes of its cutout store), see cnn.class_names,
+pass it with --classes (the default is data, the directory cnn.py trains on).
+
+Score a directory (or a list of files) and write the predictions to csv or parquet:
+    python score.py flare_cnn_RGB.h5 data predictions.csv [--classes data]
+
+Or serve the model over HTTP, requests that arrive close together are scored as one batch:
+    python score.py flare_cnn_RGB.h5 --serve 8000 [--classes data]
+    curl --data-binary @image.png http://localhost:8000/score
+the body of a request can be a png (or any image cv2 can decode) or a .npy cutout (e.g. from download_images.get_cutout).
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import cv2
+import numpy as np
+import pandas as pd
+import tensorflow.keras as keras
+
+import cnn
+import instrument
+
+CLASSES_PATH = 'data'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.npy')
+
+def load_model(model_filename):
+    """
+    Loads a saved model and reads the image size it expects
+
+    Param:
+          model_filename string, the .h5 file saved by cnn.py
+
+    Return:
+           model keras model
+           shape tuple, (rows, columns, chanels) of the input images
+    """
+
+    model = keras.models.load_model(model_filename)
+    return model, tuple(model.input_shape[1:])
+
+def check_classes(model, class_names):
+    """
+    Checks there is a class name for each output of the model
+
+    Param:
+          model keras model, from load_model
+          class_names list of strings, the class names in the order they were coded (see cnn.class_names)
+
+    Return:
+           class_names list of strings
+    """
+
+    class_names = list(class_names)
+    if len(class_names) != model.output_shape[-1]:
+        raise ValueError('the model has {} outputs but there are {} class names ({})'.format(model.output_shape[-1], len(class_names), ', '.join(class_names)))
+    return class_names
+
+def prepare_image(img, shape):
+    """
+    Turns a decoded image or a raw cutout into the input the model was trained on.
+    8 bit images are scaled to 0-1, anything else (e.g. raw AIA data) is scaled by its own minimum and maximum like the greyscale png the training images were saved as.
+    Greyscale data is repeated into 3 chanels for a colour model (the training png were grey saved in colour).
+    Multi channel tensors (see download_images.run_channels) are normalised a channel at a time.
+
+    Param:
+          img numpy array, [rows, columns] or [rows, columns, chanels]
+          shape tuple, (rows, columns, chanels) of the model input
+
+    Return:
+           img numpy array, float32 with the model input shape
+    """
+
+    rows, cols, channels = shape
+    if img.dtype == np.uint8:
+        img = img.astype(np.float32) / 255.0
+    else:
+        img = np.nan_to_num(img.astype(np.float32))
+        axes = (0, 1) if img.ndim == 3 and img.shape[2] == channels else None # multi channel tensors are normalised a channel at a time like cnn.load_tensor
+        low = img.min(axis=axes, keepdims=True)
+        span = img.max(axis=axes, keepdims=True) - low
+        img = (img - low) / np.where(span > 0, span, 1)
+    if img.ndim == 3 and img.shape[2] == 4 and channels == 3:
+        img = img[:, :, :3]
+    if img.ndim == 3 and img.shape[2] == 3 and channels == 1:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.ndim == 3 and img.shape[2] > 4: # cv2 can only resize up to 4 channels at once
+        img = np.stack([cv2.resize(img[:, :, c], (cols, rows), interpolation=cv2.INTER_AREA) for c in range(img.shape[2])], axis=-1)
+    else:
+        img = cv2.resize(img, (cols, rows), interpolation=cv2.INTER_AREA)
+    if img.ndim == 2:
+        img = np.repeat(img[:, :, np.newaxis], channels, axis=2)
+    return img.reshape(rows, cols, channels)
+
+def read_image(path, shape):
+    """
+    Reads an image file (png etc. or .npy) and prepares it for the model
+
+    Param:
+          path string, the file
+          shape tuple, (rows, columns, chanels) of the model input
+
+    Return:
+           img numpy array, float32 with the model input shape
+    """
+
+    if path.endswith('.npy'):
+        return prepare_image(np.load(path), shape)
+    return prepare_image(cv2.imread(path, 1 if shape[2] == 3 else 0), shape)
+
+def decode_bytes(body, shape):
+    """
+    Decodes the body of a request (an encoded image or a .npy file) and prepares it for the model
+    """
+
+    if body[:6] == b'\x93NUMPY':
+        return prepare_image(np.load(io.BytesIO(body)), shape)
+    img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), 1 if shape[2] == 3 else 0)
+    if img is None:
+        raise ValueError('could not decode image')
+    return prepare_image(img, shape)
+
+def list_files(source):
+    """
+    The image files to score
+
+    Param:
+          source, a directory (searched recursively) or a list of files
+
+    Return:
+           files list of strings
+    """
+
+    if isinstance(source, str):
+        files = []
+        for root, dirs, names in os.walk(source):
+            dirs.sort()
+            files += [os.path.join(root, name) for name in sorted(names) if name.lower().endswith(IMAGE_EXTENSIONS)]
+        return files
+    return list(source)
+
+def batches(source, shape, batch_size=64, workers=4):
+    """
+    Reads images in fixed size batches, the images in a batch are decoded in parallel
+
+    Param:
+          source, a directory, a list of files or an iterable of (name, numpy array) cutouts
+          shape tuple, (rows, columns, chanels) of the model input
+          batch_size integer, the number of images in a batch
+          workers integer, the number of threads decoding images
+
+    Return:
+           generator of (names, float32 images [batch size, rows, columns, chanels])
+    """
+
+    if isinstance(source, str) or (isinstance(source, (list, tuple)) and all(isinstance(item, str) for item in source)):
+        items = ((path, path) for path in list_files(source))
+        load = lambda item: read_image(item[1], shape)
+    else:
+        items = iter(source)
+        load = lambda item: prepare_image(np.asarray(item[1]), shape)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield [name for name, data in batch], np.stack(list(executor.map(load, batch)))
+                batch = []
+        if batch:
+            yield [name for name, data in batch], np.stack(list(executor.map(load, batch)))
+
+def predictions_frame(names, probabilities, class_names):
+    """
+    Makes a dataframe of predictions with the probability of each class
+
+    Param:
+          names list, the name of each image
+          probabilities numpy array, the output of the model [number of images, number of classes]
+          class_names list of strings, the class names in the order they were coded
+
+    Return:
+           pandas dataframe with Image, Prediction and a P(class) column for each class
+    """
+
+    probabilities = np.asarray(probabilities).reshape(len(names), len(class_names))
+    df = pd.DataFrame({'Image': names, 'Prediction': np.array(class_names)[np.argmax(probabilities, axis=1)]})
+    for i, name in enumerate(class_names):
+        df['P({})'.format(name)] = probabilities[:, i]
+    return df
+
+def score(model, shape, source, class_names, batch_size=64, workers=4):
+    """
+    Scores every image from a source in fixed size batches
+
+    Param:
+          model keras model, from load_model
+          shape tuple, (rows, columns, chanels) of the model input
+          source, a directory, a list of files or an iterable of (name, numpy array) cutouts
+          class_names list of strings, the class names in the order they were coded (see cnn.class_names)
+          batch_size integer, the number of images the model scores at once
+          workers integer, the number of threads decoding images
+
+    Return:
+           predictions pandas dataframe, see predictions_frame
+    """
+
+    class_names = check_classes(model, class_names)
+    frames = []
+    for names, images in batches(source, shape, batch_size, workers):
+        with instrument.timer('inference', rows=len(names), bytes=images.nbytes):
+            probabilities = model.predict(images, batch_size=batch_size, verbose=0)
+        frames.append(predictions_frame(names, probabilities, class_names))
+    if not frames:
+        return predictions_frame([], np.zeros((0, len(class_names))), class_names)
+    return pd.concat(frames, ignore_index=True)
+
+def write_predictions(predictions, filename):
+    """
+    Writes predictions to a .csv or .parquet file (chosen by the extension)
+    """
+
+    if filename.endswith('.parquet'):
+        predictions.to_parquet(filename, index=False)
+    else:
+        predictions.to_csv(filename, index=False)
+
+def micro_batcher(model, requests, class_names, batch_size=64, max_wait=0.01):
+    """
+    Scores requests from a queue in batches, waits at most max_wait seconds after the first request for more to fill the batch.
+    Runs forever so start it in a daemon thread.
+
+    Param:
+          model keras model, from load_model
+          requests queue, of (image, reply) where reply is a dictionary with a threading Event under 'done', the result is put under 'result'
+          class_names list of strings, the class names in the order they were coded
+          batch_size integer, the most requests scored at once
+          max_wait float, seconds to wait for a batch to fill
+    """
+
+    while True:
+        pending = [requests.get()]
+        deadline = time.perf_counter() + max_wait
+        while len(pending) < batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            with instrument.timer('served inference', rows=len(pending)):
+                probabilities = model.predict(np.stack([img for img, reply in pending]), batch_size=batch_size, verbose=0)
+            results = predictions_frame(list(range(len(pending))), probabilities, class_names)
+            for (img, reply), (idx, row) in zip(pending, results.iterrows()):
+                reply['result'] = {'prediction': row['Prediction'], 'probabilities': {name: float(row['P({})'.format(name)]) for name in class_names}}
+        except Exception as error:
+            for img, reply in pending:
+                reply['error'] = str(error)
+        for img, reply in pending:
+            reply['done'].set()
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(model, shape, class_names, host='127.0.0.1', port=8000, batch_size=64, max_wait=0.01):
+    """
+    Serves the model over HTTP, POST an image to /score to get the predicted class and probabilities back as json.
+    Each request is handled in its own thread and queued for the micro batcher so requests that arrive together are scored together.
+
+    Param:
+          model keras model, from load_model
+          shape tuple, (rows, columns, chanels) of the model input
+          class_names list of strings, the class names in the order they were coded (see cnn.class_names)
+          host string, the address to listen on
+          port integer, the port to listen on
+          batch_size integer, the most requests scored at once
+          max_wait float, seconds to wait for a batch to fill
+    """
+
+    class_names = check_classes(model, class_names)
+    requests = queue.Queue()
+    threading.Thread(target=micro_batcher, args=(model, requests, class_names, batch_size, max_wait), daemon=True).start()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/score':
+                return self.reply(404, {'error': 'POST images to /score'})
+            try:
+                img = decode_bytes(self.rfile.read(int(self.headers.get('Content-Length', 0))), shape)
+            except ValueError as error:
+                return self.reply(400, {'error': str(error)})
+            reply = {'done': threading.Event()}
+            requests.put((img, reply))
+            reply['done'].wait()
+            if 'error' in reply:
+                return self.reply(500, {'error': reply['error']})
+            self.reply(200, reply['result'])
+
+        def log_message(self, format, *args):
+            pass
+
+    print('serving on http://{}:{}/score'.format(host, port))
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    classes_path = CLASSES_PATH
+    if '--classes' in args:
+        classes_path = args.pop(args.index('--classes') + 1)
+        args.remove('--classes')
+    names = cnn.class_names(classes_path)
+
+    model, shape = load_model(args[0])
+    if args[1] == '--serve':
+        serve(model, shape, names, port=int(args[2]) if len(args) > 2 else 8000)
+    else:
+        predictions = score(model, shape, args[1], names)
+        write_predictions(predictions, args[2] if len(args) > 2 else 'predictions.csv')
+        print(predictions['Prediction'].value_counts())
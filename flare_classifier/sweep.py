@@ -0,0 +1,181 @@
+"""
+Evaluates CNN configurations (image size, colour or grey, batch size, architecture and width) with stratified k-fold cross validation,
+running the folds of every configuration in parallel in a pool of processes.
+
+Each worker is its own process with its own tensorflow session, pinned to its own CPU cores with a fixed number of threads
+so the workers don't fight over the cores. The images are decoded and resized once for each image size and colour into the image cache
+(see image_cache) before the workers start, the workers then memory map the cache read only, so every worker shares the one copy
+in the page cache instead of loading the images again. The folds are made once so every configuration is scored on the same splits.
+
+Each configuration is scored with the F1 score (the mean of the B and C class F1, which isn't flattered by the skew of B over C like accuracy is)
+and the accuracy, averaged over the folds, along with the wall time of its folds.
+
+Run from the flare_classifier directory (the grid is set in __main__):
+    python sweep.py data [workers] [folds]
+"""
+
+import os
+import sys
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold
+
+import image_cache
+
+RESULTS_FILE = 'sweep_results.csv'
+
+def grid(**options):
+    """
+    Every combination of the options as a list of configurations
+
+    Param:
+          options, name -> list of values, e.g. img_size=[64, 150], color=[True, False], batch_size=[50], architecture=['pooled'], filters=[10, 20]
+
+    Return:
+           configs list of dictionaries
+    """
+
+    names = list(options)
+    return [dict(zip(names, values)) for values in itertools.product(*(options[name] for name in names))]
+
+def config_name(config):
+    """
+    A short name for a configuration, e.g. 'img_size=64 color=True batch_size=50 architecture=pooled filters=20'
+    """
+
+    return ' '.join('{}={}'.format(name, value) for name, value in config.items())
+
+def init_worker(counter, intra_op, inter_op, pin):
+    """
+    Sets up a worker process, pins it to its own cores and sets the tensorflow threads before any model is built
+
+    Param:
+          counter multiprocessing Value, the number of workers started so far (gives each worker its own cores)
+          intra_op integer, threads used inside one operation
+          inter_op integer, operations run at the same time
+          pin boolean, True to pin the worker to intra_op cores (linux only)
+    """
+
+    with counter.get_lock():
+        worker = counter.value
+        counter.value += 1
+    if pin and hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, [cores[(worker * intra_op + i) % len(cores)] for i in range(intra_op)])
+
+    import cnn # tensorflow is only imported in the workers
+    cnn.configure_threads(intra_op, inter_op)
+
+def run_fold(path, cache_dir, config, fold, train, test, epochs=1, seed=0):
+    """
+    Trains one configuration on one fold and scores it on the held out images (runs in a worker)
+
+    Param:
+          path string, the directory with a sub directory of images for each class
+          cache_dir string, the image cache directory (already up to date for the configuration's image size and colour)
+          config dictionary, img_size, color, batch_size, architecture and filters
+          fold integer, the number of the fold
+          train numpy array, the positions of the training images in the cache
+          test numpy array, the positions of the held out images in the cache
+          epochs integer, the number of epochs to train for
+          seed integer, seed for the shuffling of the training batches
+
+    Return:
+           result dictionary, the configuration with the fold, F1, accuracy, seconds and the number of training and test images
+    """
+
+    import cnn
+    from sklearn.metrics import f1_score
+
+    t0 = time.perf_counter()
+    size = config['img_size']
+    images, labels, names = image_cache.load_image_cache(path, size, size, config['color'], cache_dir, update=False)
+    model = cnn.build_CNN(size, size, color=config['color'], num_classes=len(names), architecture=config['architecture'], filters=config['filters'])
+
+    batch_size = config['batch_size']
+    batches = image_cache.cached_batches(images, labels, len(names), batch_size, seed=seed, rows=train)
+    model.fit(batches, steps_per_epoch=int(np.ceil(len(train) / batch_size)), epochs=epochs, verbose=0)
+
+    test = np.sort(test) # reading the memory map in order is quicker, only a chunk of the held out images is normalised at a time
+    predicted = np.concatenate([np.argmax(model.predict(images[test[start:start + 1000]].astype(np.float32) / 255.0, batch_size=batch_size, verbose=0), axis=1)
+                                for start in range(0, len(test), 1000)])
+    real = labels[test]
+
+    return dict(config, fold=fold, f1=f1_score(real, predicted, average='macro'), accuracy=np.mean(predicted == real),
+                seconds=time.perf_counter() - t0, train=len(train), test=len(test))
+
+def sweep(path, configs, folds=5, workers=None, intra_op=None, inter_op=1, epochs=1, cache_dir=image_cache.IMAGE_CACHE_DIR, pin=True, seed=0):
+    """
+    Cross validates every configuration, the folds of all the configurations are shared out over a pool of worker processes
+
+    Param:
+          path string, the directory with a sub directory of images for each class (png, the image cache is used to share them)
+          configs list of dictionaries, from grid
+          folds integer, the number of folds (each class is split evenly between the folds)
+          workers integer, the number of worker processes (None for the number of cores / intra_op)
+          intra_op integer, threads used inside one operation in each worker (None shares the cores out between the workers)
+          inter_op integer, operations run at the same time in each worker
+          epochs integer, the number of epochs to train each fold for
+          cache_dir string, the image cache directory
+          pin boolean, True to pin each worker to its own cores
+          seed integer, seed for the folds and the shuffling
+
+    Return:
+           summary pandas dataframe, one row per configuration with the mean and standard deviation of the F1 over the folds,
+           the mean accuracy and the wall time (total seconds of its folds), best F1 first
+           results pandas dataframe, one row per configuration and fold
+    """
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if workers is None:
+        workers = max(cores // (intra_op or 2), 1)
+    intra_op = intra_op or max(cores // workers, 1)
+
+    # decode each image size and colour once here so the workers only ever read the cache
+    tasks = []
+    splits = {}
+    for config in configs:
+        key = (config['img_size'], config['color'])
+        if key not in splits:
+            images, labels, names = image_cache.load_image_cache(path, key[0], key[0], key[1], cache_dir)
+            splits[key] = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(np.zeros(len(labels)), labels))
+        for fold, (train, test) in enumerate(splits[key]):
+            tasks.append((config, fold, train, test))
+    print('{} configurations x {} folds on {} workers with {} threads each'.format(len(configs), folds, workers, intra_op))
+
+    counter = multiprocessing.get_context('spawn').Value('i', 0)
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(counter, intra_op, inter_op, pin)) as executor:
+        futures = [executor.submit(run_fold, path, cache_dir, config, fold, train, test, epochs, seed) for config, fold, train, test in tasks]
+        results = []
+        for (config, fold, train, test), future in zip(tasks, futures):
+            results.append(future.result())
+            print('{} fold {}: F1 {:.3f}'.format(config_name(config), fold, results[-1]['f1']))
+    print('sweep took {:.1f} s'.format(time.perf_counter() - t0))
+
+    results = pd.DataFrame(results)
+    summary = results.groupby(list(configs[0]), sort=False).agg(f1=('f1', 'mean'), f1_std=('f1', 'std'), accuracy=('accuracy', 'mean'),
+                                                                seconds=('seconds', 'sum')).reset_index()
+    return summary.sort_values('f1', ascending=False), results
+
+if __name__ == '__main__':
+
+    path = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    folds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    configs = grid(img_size=[64, 150],
+                   color=[True, False],
+                   batch_size=[50],
+                   architecture=['pooled'],
+                   filters=[10, 20])
+
+    summary, results = sweep(path, configs, folds=folds, workers=workers)
+    print(summary.to_string(index=False))
+    results.to_csv(RESULTS_FILE, index=False)
+    print('saved the results of every fold to {}'.format(RESULTS_FILE))